@@ -12,6 +12,7 @@ from cyth.cyth_args import WITH_CYTH, CYTH_WRITE, DYNAMIC
 from cyth.cyth_importer import import_cyth_execstr
 from cyth.cyth_script import translate, translate_all
 from cyth.cyth_decorators import macro
+from cyth.cyth_record import record_types
 
 from cyth import cyth_helpers
 from cyth import cyth_importer
@@ -0,0 +1,383 @@
+"""
+python -c "import doctest, cyth; print(doctest.testmod(cyth.cyth_analysis))"
+
+Module level analysis consumed by CythVisitor.
+
+ModuleAnalyzer gathers everything the emitter needs to know about a module in
+a single walk of its AST: the module's global symbols, which of them are used
+(and where), and the call graph of its top-level functions.
+"""
+from __future__ import absolute_import, division, print_function
+import ast
+import re
+
+# Scope name used for code outside of any function
+MODULE_SCOPE = '<module>'
+# An identifier optionally followed by attribute accesses, e.g. 'np.linalg.det'
+DOTTED_IDENT_REGEX = re.compile(r'[A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z_][A-Za-z0-9_]*)*')
+# A (possibly dotted) name immediately followed by an open paren
+CALL_REGEX = re.compile(r'(?<![A-Za-z0-9_.])([A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z_][A-Za-z0-9_]*)?)\(')
+
+
+def is_docstring(node):
+    return isinstance(node, ast.Expr) and isinstance(node.value, ast.Str)
+
+
+def assignment_targets(node):
+    """
+    Assign nodes have a list of multiple targets, which is used for
+    'a = b = c' (a and b are both targets)
+
+    'x, y = y, x' has a tuple as the only element of the targets array,
+    (likewise for '[x, y] = [y, x]', but with lists)
+    """
+    assert isinstance(node, (ast.Assign, ast.AugAssign)), type(node)
+    if isinstance(node, ast.AugAssign):
+        assign_targets = [node.target]
+        return assign_targets
+    elif isinstance(node, ast.Assign):
+        assign_targets = []
+        for target in node.targets:
+            if isinstance(target, (ast.Tuple, ast.List)):
+                assign_targets.extend(target.elts)
+            else:
+                assign_targets.append(target)
+        return assign_targets
+    else:
+        raise AssertionError('unexpected node type %r' % type(node))
+
+
+def tokenize_dotted_names(text):
+    """
+    Returns the set of every identifier and dotted-name prefix in text, so a
+    docstring is scanned once regardless of how many globals a module has.
+
+    >>> from cyth.cyth_analysis import *  # NOQA
+    >>> sorted(tokenize_dotted_names('out = np.linalg.det(x) + SCALE_2'))
+    ['SCALE_2', 'np', 'np.linalg', 'np.linalg.det', 'out', 'x']
+    """
+    tokens = set([])
+    for match in DOTTED_IDENT_REGEX.finditer(text):
+        parts = match.group(0).split('.')
+        for ix in range(1, len(parts) + 1):
+            tokens.add('.'.join(parts[:ix]))
+    return tokens
+
+
+def get_cyth_code_calls(line):
+    """
+    Returns the names called on a line of cyth code
+
+    >>> from cyth.cyth_analysis import *  # NOQA
+    >>> sorted(get_cyth_code_calls('out[ix] = helper(np.sqrt(x), (y))'))
+    ['helper', 'np.sqrt']
+    """
+    return set(CALL_REGEX.findall(line))
+
+
+def get_callee_name(call):
+    """ 'func' or 'mod.func' for calls through plain names, otherwise None """
+    if isinstance(call.func, ast.Name):
+        return call.func.id
+    elif isinstance(call.func, ast.Attribute) and isinstance(call.func.value, ast.Name):
+        return call.func.value.id + '.' + call.func.attr
+    return None
+
+
+def get_function_base_name(name):
+    """
+    The top-level function a call refers to; cyth code may call the cython
+    version of foo as foo_cyth or _foo_cyth.
+
+    >>> from cyth.cyth_analysis import *  # NOQA
+    >>> get_function_base_name('_foo_cyth'), get_function_base_name('foo_cyth')
+    ('foo', 'foo')
+    """
+    if name.endswith('_cyth'):
+        name = name[:-len('_cyth')]
+        if name.startswith('_'):
+            name = name[1:]
+    return name
+
+
+def get_reverse_call_graph(call_graph):
+    """
+    Inverts a call graph into callee -> set of callers
+
+    >>> from cyth.cyth_analysis import *  # NOQA
+    >>> call_graph = {'foo': set(['bar', 'baz']), 'bar': set(['baz'])}
+    >>> reverse_graph = get_reverse_call_graph(call_graph)
+    >>> sorted(reverse_graph['baz'])
+    ['bar', 'foo']
+    """
+    reverse_graph = {}
+    for caller, callees in call_graph.items():
+        for callee in callees:
+            reverse_graph.setdefault(callee, set([])).add(caller)
+    return reverse_graph
+
+
+def get_global_name(target):
+    """
+    Returns the name a global assignment target is referred to by ('x' or
+    'x.attr'), or None for targets that do not define a name.
+    """
+    if isinstance(target, ast.Name):
+        return target.id
+    elif isinstance(target, ast.Attribute) and isinstance(target.value, ast.Name):
+        return target.value.id + '.' + target.attr
+    return None
+
+
+def get_toplevel_sources(module_node, py_text):
+    """
+    Returns {node: its source} for the top-level functions and classes of
+    module_node. Their source runs from the first decorator to the line
+    before the next top-level statement.
+
+    >>> from cyth.cyth_analysis import *  # NOQA
+    >>> py_text = '\\n'.join(['@dec', 'def foo():', '    pass', '# bar', 'x = 1'])
+    >>> module_node = ast.parse(py_text)
+    >>> print(get_toplevel_sources(module_node, py_text)[module_node.body[0]])
+    @dec
+    def foo():
+        pass
+    # bar
+    """
+    lines = py_text.split('\n')
+
+    def first_lineno(node):
+        decorator_list = getattr(node, 'decorator_list', [])
+        return min([node.lineno] + [decorator.lineno for decorator in decorator_list])
+    sources = {}
+    body = module_node.body
+    for ix, node in enumerate(body):
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+            stop = first_lineno(body[ix + 1]) - 1 if ix + 1 < len(body) else len(lines)
+            sources[node] = '\n'.join(lines[first_lineno(node) - 1:stop])
+    return sources
+
+
+def get_toplevel_source_hashes(module_node, py_text):
+    """
+    Returns {node: hash of its source} for the top-level functions and classes
+    of module_node (see get_toplevel_sources)
+
+    >>> from cyth.cyth_analysis import *  # NOQA
+    >>> py_text = '\\n'.join(['def foo():', '    pass', 'def bar():', '    pass'])
+    >>> module_node = ast.parse(py_text)
+    >>> source_hashes = get_toplevel_source_hashes(module_node, py_text)
+    >>> source_hashes[module_node.body[0]] == source_hashes[module_node.body[1]]
+    False
+    """
+    from cyth import cyth_cache
+    return {node: cyth_cache.hash_text(source)
+            for node, source in get_toplevel_sources(module_node, py_text).items()}
+
+
+def new_facts():
+    """ what ModuleAnalyzer learns from the code of one scope """
+    return {
+        'callees': set([]),  # names called ('func' or 'mod.func')
+        'loads': set([]),    # names loaded ('x' or 'x.attr')
+        'tokens': set([]),   # dotted names mentioned in docstrings
+        'cyth': False,       # has #if CYTH markup
+    }
+
+
+class ModuleAnalyzer(ast.NodeVisitor):
+    """
+    Single pass analysis of a module.
+
+    The facts gathered from each top-level function only depend on its own
+    source, so when source_hashes and facts_cache are given, functions whose
+    source hash is in facts_cache are not walked again.
+
+    Attributes:
+        global_names (list): assignment target nodes of module level globals
+        symbol_index (dict): global name ('x' or 'x.attr') -> list of the
+            target nodes that assign it
+        globals_used (dict): global target node -> True if a docstring
+            mentions the global or the code of a cyth function loads it (the
+            emitter copies those into the pyx)
+        global_loads (dict): global name -> set of scopes that load it
+        cyth_funcs (set): top-level functions (and classes) with #if CYTH markup
+        call_graph (dict): top-level function name -> set of the names it
+            calls ('func' or 'mod.func'), from its python code and from the
+            cyth code in its docstrings. Nested functions count as part of
+            their enclosing top-level function.
+        used_facts (dict): source hash -> facts of every top-level function
+            seen (in the JSON friendly form stored in facts_cache)
+        function_callers (dict): top-level function name -> set of the scopes
+            that call it
+        function_value_refs (dict): top-level function name -> set of the
+            scopes that use it other than by calling it
+
+    Example:
+        >>> from cyth.cyth_analysis import *  # NOQA
+        >>> import utool
+        >>> source = utool.unindent('''
+        ...     X = 1
+        ...     def foo(a):
+        ...         \"\"\" uses X \"\"\"
+        ...         return bar(baz(a))
+        ...     ''')
+        >>> analysis = ModuleAnalyzer()
+        >>> analysis.visit(ast.parse(source))
+        >>> sorted(analysis.call_graph['foo'])
+        ['bar', 'baz']
+        >>> list(analysis.globals_used.values())
+        [True]
+    """
+    def __init__(self, source_hashes=None, facts_cache=None):
+        self.global_names = []
+        self.symbol_index = {}
+        self.globals_used = {}
+        self.global_loads = {}
+        self.call_graph = {}
+        self.cyth_funcs = set([])
+        self.toplevel_funcs = set([])
+        self.function_callers = {}
+        self.function_value_refs = {}
+        self.source_hashes = {} if source_hashes is None else source_hashes
+        self.facts_cache = {} if facts_cache is None else facts_cache
+        self.used_facts = {}
+        self.current_scope = MODULE_SCOPE
+        self.current_facts = new_facts()
+        # mirrors the #if CYTH / #endif state of the emitter
+        self.in_cyth_code = False
+
+    def visit_Module(self, node):
+        # The symbol table only needs the top level statements and has to be
+        # complete before the walk, since functions may use globals that are
+        # assigned further down the module.
+        for subnode in node.body:
+            if isinstance(subnode, ast.FunctionDef):
+                self.toplevel_funcs.add(subnode.name)
+            if isinstance(subnode, (ast.Assign, ast.AugAssign)):
+                assign_targets = assignment_targets(subnode)
+                for target in assign_targets:
+                    self.global_names.append(target)
+                    self.globals_used[target] = False
+                    global_name = get_global_name(target)
+                    if global_name is not None:
+                        self.symbol_index.setdefault(global_name, []).append(target)
+        self.generic_visit(node)
+        self.apply_facts(MODULE_SCOPE, self.current_facts)
+        # the python bodies of cyth functions are emitted as well
+        for global_name, scopes in self.global_loads.items():
+            if not scopes.isdisjoint(self.cyth_funcs):
+                for target in self.symbol_index[global_name]:
+                    self.globals_used[target] = True
+
+    def apply_facts(self, scope, facts):
+        """ merges the facts gathered from the code of scope """
+        if scope != MODULE_SCOPE:
+            self.call_graph[scope] = set(facts['callees'])
+            if facts['cyth']:
+                self.cyth_funcs.add(scope)
+        for global_name in facts['loads']:
+            if global_name in self.symbol_index:
+                self.global_loads.setdefault(global_name, set([])).add(scope)
+        called = set(map(get_function_base_name, facts['callees']))
+        for name in called & self.toplevel_funcs:
+            self.function_callers.setdefault(name, set([])).add(scope)
+        # the callee of a python call is loaded as well
+        for name in set(map(get_function_base_name, facts['loads'])) - called:
+            if name in self.toplevel_funcs:
+                self.function_value_refs.setdefault(name, set([])).add(scope)
+        for token in facts['tokens']:
+            for global_name_node in self.symbol_index.get(token, []):
+                self.globals_used[global_name_node] = True
+
+    def get_internal_funcs(self):
+        """
+        Returns the cyth functions that are only ever called, and only by other
+        cyth functions of the module, so python never needs their cython
+        version.
+
+        Example:
+            >>> from cyth.cyth_analysis import *  # NOQA
+            >>> import utool
+            >>> source = utool.unindent('''
+            ...     def helper(x):
+            ...         \'#if CYTH\'
+            ...     def outer(x):
+            ...         \'#if CYTH\'
+            ...         return helper(x)
+            ...     ''')
+            >>> analysis = ModuleAnalyzer()
+            >>> analysis.visit(ast.parse(source))
+            >>> sorted(analysis.get_internal_funcs())
+            ['helper']
+        """
+        internal_funcs = set([])
+        for name in self.cyth_funcs:
+            callers = self.function_callers.get(name, set([])) - set([name])
+            if (len(callers) > 0 and callers.issubset(self.cyth_funcs) and
+                    name not in self.function_value_refs):
+                internal_funcs.add(name)
+        return internal_funcs
+
+    def visit_FunctionDef(self, node):
+        if self.current_scope != MODULE_SCOPE:
+            # nested functions are attributed to their top-level function
+            self.generic_visit(node)
+            return
+        source_hash = self.source_hashes.get(node, None)
+        facts = self.facts_cache.get(source_hash, None)
+        if facts is None:
+            module_facts = self.current_facts
+            self.current_scope = node.name
+            self.current_facts = new_facts()
+            self.in_cyth_code = False
+            self.generic_visit(node)
+            facts = {key: sorted(val) if isinstance(val, set) else val
+                     for key, val in self.current_facts.items()}
+            self.current_scope = MODULE_SCOPE
+            self.current_facts = module_facts
+        if source_hash is not None:
+            self.used_facts[source_hash] = facts
+        self.apply_facts(node.name, facts)
+
+    # a class is a scope like a top-level function, its methods are part of it
+    visit_ClassDef = visit_FunctionDef
+
+    def visit_Call(self, node):
+        if self.current_scope != MODULE_SCOPE:
+            callee = get_callee_name(node)
+            if callee is not None:
+                self.current_facts['callees'].add(callee)
+        self.generic_visit(node)
+
+    def _record_cyth_code_calls(self, docstr):
+        """ adds calls made by the cyth code of a function's docstring """
+        callees = self.current_facts['callees']
+        for line in docstr.split('\n'):
+            stripped = line.strip()
+            if stripped.startswith('#if '):
+                self.in_cyth_code = stripped == '#if CYTH'
+                if self.in_cyth_code:
+                    self.current_facts['cyth'] = True
+            elif stripped.startswith('#endif'):
+                self.in_cyth_code = False
+            elif self.in_cyth_code and not stripped.startswith('#'):
+                callees.update(get_cyth_code_calls(stripped))
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Load):
+            self.current_facts['loads'].add(node.id)
+
+    def visit_Attribute(self, node):
+        if isinstance(node.value, ast.Name):
+            self.current_facts['loads'].add(node.value.id + '.' + node.attr)
+        self.generic_visit(node)
+
+    def visit_Expr(self, node):
+        if isinstance(node.value, ast.Str):
+            # for cyth strings, we don't yet have a good parser, so any
+            # identifier in the text that names a global counts as a use
+            self.current_facts['tokens'].update(tokenize_dotted_names(node.value.s))
+            if self.current_scope != MODULE_SCOPE:
+                self._record_cyth_code_calls(node.value.s)
+        self.generic_visit(node)
@@ -0,0 +1,369 @@
+"""
+python -c "import doctest, cyth; print(doctest.testmod(cyth.cyth_build))"
+
+Compiles generated pyx files into importable extension modules.
+
+Cython is driven through its compiler API and the C compiler through
+distutils, so the include paths and the -shared/-fPIC style flags come from
+the running python's own build configuration.
+
+Built extensions are also stored in a content-addressed cache shared by every
+checkout and virtualenv of the current user (see get_ext_cache_key), so a
+module that was already compiled somewhere else is copied instead of rebuilt.
+The cache directory can be overridden with the CYTH_EXT_CACHE_DIR environment
+variable.
+"""
+from __future__ import absolute_import, division, print_function
+from os.path import join, exists, splitext, getmtime, basename, dirname
+from distutils import sysconfig
+import os
+import platform
+import re
+import shutil
+import sys
+import tempfile
+import time
+import utool
+from cyth import cyth_helpers
+from cyth import cyth_cache
+
+
+def get_ext_suffix():
+    """ suffix of importable extension modules, e.g. '.so' or '.pyd' """
+    ext_suffix = sysconfig.get_config_var('EXT_SUFFIX')
+    if ext_suffix is None:
+        ext_suffix = sysconfig.get_config_var('SO')
+    return ext_suffix
+
+
+def get_ext_path(cy_pyxpath):
+    """
+    >>> from cyth.cyth_build import *  # NOQA
+    >>> cy_pyxpath = '/foo/vtool/vtool/_linalg_cyth.pyx'
+    >>> ext_fpath = get_ext_path(cy_pyxpath)
+    >>> ext_fpath.startswith('/foo/vtool/vtool/_linalg_cyth.')
+    True
+    """
+    name, ext = splitext(cy_pyxpath)
+    assert ext == '.pyx', 'not a cython file'
+    return name + get_ext_suffix()
+
+
+def get_include_dirs():
+    import numpy as np
+    return [sysconfig.get_python_inc(), np.get_include()]
+
+
+def get_library_dirs():
+    if sys.platform.startswith('win32'):
+        return [join(sys.exec_prefix, 'libs')]
+    return []
+
+
+def get_export_symbols(modname):
+    init_prefix = 'init' if sys.version_info[0] == 2 else 'PyInit_'
+    return [init_prefix + modname]
+
+
+def get_abi_tag():
+    """ identifies the python ABI extension modules are built against """
+    soabi = sysconfig.get_config_var('SOABI')
+    if soabi is not None:
+        return soabi
+    unicode_width = 'ucs4' if sys.maxunicode > 0xFFFF else 'ucs2'
+    return 'cpython-%d%d-%s-%s-%s' % (sys.version_info[0], sys.version_info[1],
+                                      unicode_width, sys.platform,
+                                      platform.machine())
+
+
+def new_c_compiler(force=False):
+    from distutils.ccompiler import new_compiler
+    compiler = new_compiler(force=force)
+    sysconfig.customize_compiler(compiler)
+    return compiler
+
+
+def get_build_flags():
+    """ every compiler/linker setting that affects the built extension """
+    compiler = new_c_compiler()
+    flags = [compiler.compiler_type]
+    flags += getattr(compiler, 'compiler_so', [])
+    flags += getattr(compiler, 'linker_so', [])
+    flags += get_include_dirs() + get_library_dirs()
+    return flags
+
+
+# cimport lines of generated pyx files
+CIMPORT_REGEX = re.compile(r'^\s*(?:cimport\s+([\w.]+)(?:\s+as\s+\w+)?|from\s+([\w.]+)\s+cimport\s+(.*))$')
+
+
+def get_cimported_modnames(pyx_text):
+    """
+    Returns the names of the cythonized modules a pyx cimports
+
+    >>> from cyth.cyth_build import *  # NOQA
+    >>> pyx_text = '\\n'.join(['cimport numpy as np', 'cimport vtool._keypoint_cyth as _kp_cyth',
+    ...                         'from vtool cimport _linalg_cyth, _trig_cyth as _t'])
+    >>> get_cimported_modnames(pyx_text)
+    ['vtool._keypoint_cyth', 'vtool._linalg_cyth', 'vtool._trig_cyth']
+    """
+    modnames = []
+    for line in pyx_text.split('\n'):
+        match = CIMPORT_REGEX.match(line)
+        if match is None:
+            continue
+        if match.group(1) is not None:
+            candidates = [match.group(1)]
+        else:
+            candidates = [match.group(2) + '.' + name.split(' as ')[0].strip()
+                          for name in match.group(3).split(',')]
+        modnames.extend(modname for modname in candidates if modname.endswith('_cyth'))
+    return modnames
+
+
+def get_cimported_pxd_paths(cy_pyxpath):
+    """ The pxd files of the cythonized modules cimported by cy_pyxpath """
+    if not exists(cy_pyxpath):
+        return []
+    pyx_text = utool.read_from(cy_pyxpath, verbose=False)
+    # cythonize_pyx resolves cimports relative to the working directory
+    pxd_fpaths = [join(os.getcwd(), *modname.split('.')) + '.pxd'
+                  for modname in get_cimported_modnames(pyx_text)]
+    return [pxd_fpath for pxd_fpath in pxd_fpaths if exists(pxd_fpath)]
+
+
+def get_ext_cache_dpath():
+    ext_cache_dpath = os.environ.get('CYTH_EXT_CACHE_DIR', None)
+    if ext_cache_dpath is None:
+        ext_cache_dpath = utool.get_app_resource_dir('cyth', 'ext_cache')
+    return ext_cache_dpath
+
+
+def get_ext_cache_key(cy_pyxpath):
+    """
+    Hashes the generated pyx/pxd text (and the pxds it cimports) together with
+    the module name, build flags, Cython and numpy versions and the python ABI
+    tag.
+    """
+    import Cython
+    import numpy as np
+    cy_pxdpath = splitext(cy_pyxpath)[0] + '.pxd'
+    cy_modname = cyth_helpers.get_py_module_name(splitext(cy_pyxpath)[0] + '.py')
+    parts = [cy_modname, Cython.__version__, np.__version__, get_abi_tag()]
+    parts += get_build_flags()
+    for src in [cy_pyxpath, cy_pxdpath] + get_cimported_pxd_paths(cy_pyxpath):
+        parts.append(utool.read_from(src, verbose=False) if exists(src) else '')
+    return cyth_cache.hash_text('\n'.join(parts))
+
+
+def get_cached_ext_fpath(cache_key):
+    return join(get_ext_cache_dpath(), cache_key[0:2], cache_key + get_ext_suffix())
+
+
+def fetch_cached_ext(cache_key, ext_fpath):
+    """ Copies a cached build to ext_fpath. Returns False on a cache miss """
+    cached_fpath = get_cached_ext_fpath(cache_key)
+    if not exists(cached_fpath):
+        return False
+    # copyfile (not copy2) gives ext_fpath a fresh mtime for is_ext_current
+    shutil.copyfile(cached_fpath, ext_fpath)
+    return True
+
+
+def store_cached_ext(cache_key, ext_fpath):
+    cached_fpath = get_cached_ext_fpath(cache_key)
+    cyth_cache.ensuredir(dirname(cached_fpath))
+    # Concurrent builders may store the same key; the rename makes that safe
+    tmp_fpath = cached_fpath + '.tmp%d' % (os.getpid(),)
+    shutil.copyfile(ext_fpath, tmp_fpath)
+    if sys.platform.startswith('win32') and exists(cached_fpath):
+        os.remove(cached_fpath)
+    os.rename(tmp_fpath, cached_fpath)
+
+
+def cythonize_pyx(cy_pyxpath, annotate=False):
+    """ Generates the c file for cy_pyxpath in process """
+    from Cython.Compiler.Main import compile as cython_compile
+    from Cython.Compiler.Main import CompilationOptions, default_options
+    options = CompilationOptions(default_options)
+    options.annotate = annotate
+    # allow cimports of other cythonized modules in the working tree
+    options.include_path = [os.getcwd()]
+    result = cython_compile(cy_pyxpath, options)
+    if result.num_errors > 0:
+        raise RuntimeError('cython reported %d errors' % (result.num_errors,))
+    return result.c_file
+
+
+def get_distutils_options(cy_pyxpath):
+    """
+    Parses the '# distutils: key = value' lines at the top of a pyx file,
+    which cythonize would otherwise turn into Extension arguments.
+
+    >>> from cyth.cyth_build import *  # NOQA
+    >>> import utool
+    >>> dpath = tempfile.mkdtemp()
+    >>> cy_pyxpath = join(dpath, 'test_options.pyx')
+    >>> utool.write_to(cy_pyxpath, '# distutils: extra_compile_args = -fopenmp -O3\\nx = 1\\n', verbose=False)
+    >>> get_distutils_options(cy_pyxpath)
+    {'extra_compile_args': ['-fopenmp', '-O3']}
+    >>> shutil.rmtree(dpath)
+    """
+    options = {}
+    with open(cy_pyxpath, 'r') as file_:
+        for line in file_:
+            if not line.startswith('#'):
+                break
+            if line.startswith('# distutils:'):
+                key, _, valstr = line[len('# distutils:'):].partition('=')
+                options[key.strip()] = valstr.split()
+    return options
+
+
+def get_openmp_args(compiler, args):
+    """ translates the gcc style OpenMP flag for the compiler in use """
+    if compiler.compiler_type == 'msvc':
+        return ['/openmp' if arg == '-fopenmp' else arg for arg in args]
+    return args
+
+
+def compile_c(c_fpath, ext_fpath, extra_compile_args=None, extra_link_args=None):
+    """ Compiles and links c_fpath into the extension module ext_fpath """
+    if extra_compile_args is None:
+        extra_compile_args = []
+    if extra_link_args is None:
+        extra_link_args = []
+    # build_pyx decides what is out of date; distutils would skip the link
+    # when the objects are not newer than ext_fpath at whole-second mtimes
+    compiler = new_c_compiler(force=True)
+    # object files would otherwise be written below the working directory
+    build_dpath = tempfile.mkdtemp(prefix='cyth_build_')
+    try:
+        obj_list = compiler.compile([c_fpath], output_dir=build_dpath,
+                                    include_dirs=get_include_dirs(),
+                                    extra_postargs=get_openmp_args(compiler, extra_compile_args))
+        modname = basename(ext_fpath).split('.')[0]
+        link_args = get_openmp_args(compiler, extra_link_args)
+        if compiler.compiler_type == 'msvc':
+            # msvc links the OpenMP runtime by itself
+            link_args = [arg for arg in link_args if arg != '/openmp']
+        compiler.link_shared_object(obj_list, ext_fpath,
+                                    library_dirs=get_library_dirs(),
+                                    export_symbols=get_export_symbols(modname),
+                                    extra_postargs=link_args)
+    finally:
+        shutil.rmtree(build_dpath, ignore_errors=True)
+    return ext_fpath
+
+
+def is_ext_current(cy_pyxpath, ext_fpath):
+    """
+    True if ext_fpath was built after its pyx, its pxd and the pxds it
+    cimports were last written
+    """
+    if not exists(ext_fpath):
+        return False
+    ext_mtime = getmtime(ext_fpath)
+    cy_pxdpath = splitext(cy_pyxpath)[0] + '.pxd'
+    src_list = [cy_pyxpath] + ([cy_pxdpath] if exists(cy_pxdpath) else [])
+    src_list += get_cimported_pxd_paths(cy_pyxpath)
+    return all(getmtime(src) <= ext_mtime for src in src_list)
+
+
+def build_pyx(cy_pyxpath, make_ext=True, annotate=False, force=False,
+              use_cache=True):
+    """
+    Runs cython (and the C compiler if make_ext is True) on cy_pyxpath.
+    Never raises; failures are reported in the returned status dict.
+
+    If use_cache is True, extensions are fetched from / stored in the shared
+    extension cache. Annotation requests always run cython so the html is
+    written.
+    """
+    ext_fpath = get_ext_path(cy_pyxpath)
+    status = {
+        'pyx_fpath': cy_pyxpath,
+        'ext_fpath': ext_fpath if make_ext else None,
+        'status': None,
+        'error': None,
+        'cython_time': 0.0,
+        'cc_time': 0.0,
+    }
+    if make_ext and not force and is_ext_current(cy_pyxpath, ext_fpath):
+        status['status'] = 'up to date'
+        return status
+    use_cache = use_cache and make_ext
+    stage = 'cython_time'
+    try:
+        tt = time.time()
+        if use_cache:
+            cache_key = get_ext_cache_key(cy_pyxpath)
+            if not annotate and fetch_cached_ext(cache_key, ext_fpath):
+                status['status'] = 'cached'
+                return status
+        c_fpath = cythonize_pyx(cy_pyxpath, annotate=annotate)
+        status[stage] = time.time() - tt
+        if make_ext:
+            stage = 'cc_time'
+            tt = time.time()
+            options = get_distutils_options(cy_pyxpath)
+            compile_c(c_fpath, ext_fpath,
+                      extra_compile_args=options.get('extra_compile_args', []),
+                      extra_link_args=options.get('extra_link_args', []))
+            status[stage] = time.time() - tt
+        if use_cache:
+            store_cached_ext(cache_key, ext_fpath)
+        status['status'] = 'built'
+    except Exception as ex:
+        status[stage] = time.time() - tt
+        status['status'] = 'failed'
+        status['error'] = '%s: %s' % (type(ex).__name__, ex)
+    return status
+
+
+def _build_pyx_star(args):
+    return build_pyx(*args)
+
+
+def build_pyx_list(cy_pyxpath_list, jobs=1, make_ext=True, annotate=False,
+                   force=False, use_cache=True):
+    """
+    Builds every pyx file in cy_pyxpath_list using up to jobs processes and
+    prints a per-module report. Returns the list of status dicts.
+    """
+    args_list = [(cy_pyxpath, make_ext, annotate, force, use_cache)
+                 for cy_pyxpath in cy_pyxpath_list]
+    jobs = min(jobs, len(args_list))
+    print('[cyth.build] building %d modules with %d processes' % (len(args_list), max(jobs, 1)))
+    if jobs <= 1:
+        status_list = list(map(_build_pyx_star, args_list))
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(jobs)
+        try:
+            status_list = pool.map(_build_pyx_star, args_list)
+        finally:
+            pool.close()
+            pool.join()
+    print_build_report(status_list)
+    return status_list
+
+
+def print_build_report(status_list):
+    lines = []
+    for status in status_list:
+        modname = cyth_helpers.get_py_module_name(
+            splitext(status['pyx_fpath'])[0] + '.py')
+        lines.append('%s : %s (cython=%.2fs, cc=%.2fs)' % (
+            modname, status['status'], status['cython_time'], status['cc_time']))
+        if status['error'] is not None:
+            lines.append('    ' + status['error'])
+    print('[cyth.build] report:')
+    print(utool.indentjoin(lines).strip('\n'))
+    num_failed = count_failed(status_list)
+    if num_failed > 0:
+        print('[cyth.build] %d of %d modules failed to build' % (num_failed, len(status_list)))
+
+
+def count_failed(status_list):
+    return sum(status['status'] == 'failed' for status in status_list)
@@ -0,0 +1,323 @@
+"""
+python -c "import doctest, cyth; print(doctest.testmod(cyth.cyth_cache))"
+
+Persistent bookkeeping that lets cyth skip work it has already done.
+
+The translation manifest lives in ``.cyth_cache/translate_manifest.json``
+relative to the working directory (the same directory module names are
+computed relative to). It maps each translated python file to the key it was
+translated with and the hashes of the outputs that were written.
+
+``.cyth_cache/untagged_index.json`` remembers the mtime and size of files
+known to have no CYTH tags (nor cython imports), so rescanning a large tree
+only costs a stat() per unchanged file (and one for its recorded types, see
+cyth_record).
+
+``.cyth_cache/functions/<modname>.json`` holds the analysis and emission
+results of each function of a module, keyed by the hash of the function's
+source, so editing one function of a large module only retranslates that
+function.
+"""
+from __future__ import absolute_import, division, print_function
+from os.path import join, exists, dirname
+from contextlib import contextmanager
+import errno
+import hashlib
+import json
+import mmap
+import os
+import re
+import sys
+import time
+import utool
+from cyth import cyth_helpers
+
+CACHE_DNAME = '.cyth_cache'
+MANIFEST_FNAME = 'translate_manifest.json'
+INDEX_FNAME = 'untagged_index.json'
+FUNCTION_CACHE_DNAME = 'functions'
+# CYTH markup, or an import of cython (modules typed by annotations)
+CYTH_TAG_REGEX = re.compile(br'CYTH|^[ \t]*(import|from)[ \t]+cython\b', re.MULTILINE)
+# Bump when has_cyth_tag starts matching files it did not match before
+UNTAGGED_INDEX_VERSION = 2
+# Bump when the layout of the manifest changes
+MANIFEST_VERSION = 1
+# Bump when the layout of the per-function cache entries or the emitted code changes
+FUNCTION_CACHE_VERSION = 8
+# Seconds to wait on the manifest lock before assuming its holder died
+LOCK_TIMEOUT = 30
+
+
+def get_cache_dpath():
+    return join(os.getcwd(), CACHE_DNAME)
+
+
+def get_manifest_fpath():
+    return join(get_cache_dpath(), MANIFEST_FNAME)
+
+
+def get_index_fpath():
+    return join(get_cache_dpath(), INDEX_FNAME)
+
+
+def get_function_cache_fpath(py_modname):
+    return join(get_cache_dpath(), FUNCTION_CACHE_DNAME, py_modname + '.json')
+
+
+def hash_text(text):
+    """
+    >>> from cyth.cyth_cache import *  # NOQA
+    >>> print(hash_text('foo'))
+    0beec7b5ea3f0fdbc95d0dd47f3c5bc275da8a33
+    """
+    if not isinstance(text, bytes):
+        text = text.encode('utf8')
+    return hashlib.sha1(text).hexdigest()
+
+
+def hash_file(fpath):
+    with open(fpath, 'rb') as file_:
+        return hash_text(file_.read())
+
+
+def get_translation_key(py_text, py_modname, options):
+    """
+    Hashes everything a translation depends on: the source text, the module
+    name it is translated as, the cyth version, and the active options.
+
+    >>> from cyth.cyth_cache import *  # NOQA
+    >>> key1 = get_translation_key('x = 1', 'foo', {'build': False})
+    >>> key2 = get_translation_key('x = 1', 'foo', {'build': True})
+    >>> key1 == key2
+    False
+    """
+    import cyth
+    parts = [
+        cyth.__version__,
+        py_modname,
+        json.dumps(sorted(options.items())),
+        py_text,
+    ]
+    return hash_text('\n'.join(parts))
+
+
+def load_manifest():
+    manifest_fpath = get_manifest_fpath()
+    if exists(manifest_fpath):
+        try:
+            with open(manifest_fpath, 'r') as file_:
+                manifest = json.load(file_)
+            if manifest.get('version') == MANIFEST_VERSION:
+                return manifest
+        except ValueError:
+            # A corrupt manifest only costs a retranslation
+            pass
+    return {'version': MANIFEST_VERSION, 'translations': {}}
+
+
+def ensuredir(dpath):
+    """ utool.ensuredir, but parallel workers may create dpath at the same time """
+    try:
+        os.makedirs(dpath)
+    except OSError as ex:
+        if ex.errno != errno.EEXIST:
+            raise
+
+
+def _save_json(fpath, data):
+    ensuredir(dirname(fpath))
+    # Write to a temporary file first so readers never see a partial file
+    tmp_fpath = fpath + '.tmp%d' % (os.getpid(),)
+    with open(tmp_fpath, 'w') as file_:
+        json.dump(data, file_, indent=1, sort_keys=True)
+    if sys.platform.startswith('win32') and exists(fpath):
+        os.remove(fpath)
+    os.rename(tmp_fpath, fpath)
+
+
+def save_manifest(manifest):
+    _save_json(get_manifest_fpath(), manifest)
+
+
+@contextmanager
+def cache_lock(fpath):
+    """
+    Serializes read-modify-write cycles on a cache file between processes
+    (e.g. parallel translation workers).
+    """
+    lock_fpath = fpath + '.lock'
+    ensuredir(dirname(lock_fpath))
+    start = time.time()
+    while True:
+        try:
+            fd = os.open(lock_fpath, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+            if time.time() - start > LOCK_TIMEOUT:
+                # stale lock
+                try:
+                    os.remove(lock_fpath)
+                except OSError:
+                    pass
+                start = time.time()
+            time.sleep(.01)
+    try:
+        yield
+    finally:
+        os.close(fd)
+        os.remove(lock_fpath)
+
+
+def is_translation_current(manifest, py_fpath, translation_key):
+    """
+    True if py_fpath was last translated with translation_key and none of the
+    outputs recorded for it in manifest have been removed or modified since.
+    """
+    entry = manifest['translations'].get(py_fpath, None)
+    if entry is None or entry['key'] != translation_key:
+        return False
+    for out_fpath, out_hash in entry['outputs'].items():
+        if not exists(out_fpath) or hash_file(out_fpath) != out_hash:
+            return False
+    return True
+
+
+def get_translation_entry(translation_key, output_fpaths):
+    """ the manifest entry of a translation that wrote output_fpaths """
+    return {
+        'key': translation_key,
+        'outputs': {fpath: hash_file(fpath) for fpath in output_fpaths},
+    }
+
+
+def record_translations(entries):
+    """ Adds {py_fpath: entry} to the manifest in one read-modify-write """
+    if len(entries) == 0:
+        return
+    with cache_lock(get_manifest_fpath()):
+        manifest = load_manifest()
+        manifest['translations'].update(entries)
+        save_manifest(manifest)
+
+
+def get_function_cache_context(py_modname, options, macro_names):
+    """
+    Hashes everything the per-function results of a module depend on besides
+    the function sources themselves.
+
+    >>> from cyth.cyth_cache import *  # NOQA
+    >>> context1 = get_function_cache_context('foo', {}, ['numpy_fancy_index'])
+    >>> context2 = get_function_cache_context('foo', {}, [])
+    >>> context1 == context2
+    False
+    """
+    return get_translation_key('\n'.join(sorted(macro_names)), py_modname, options)
+
+
+def load_function_cache(py_modname, context_key):
+    """
+    Returns {'analysis': {...}, 'emission': {...}} for py_modname. Entries
+    made under a different context are discarded.
+    """
+    fpath = get_function_cache_fpath(py_modname)
+    if exists(fpath):
+        try:
+            with open(fpath, 'r') as file_:
+                function_cache = json.load(file_)
+            if (function_cache.get('version') == FUNCTION_CACHE_VERSION and
+                    function_cache.get('context') == context_key):
+                return {'analysis': function_cache['analysis'],
+                        'emission': function_cache['emission']}
+        except (ValueError, KeyError):
+            pass
+    return {'analysis': {}, 'emission': {}}
+
+
+def save_function_cache(py_modname, context_key, function_cache):
+    data = {'version': FUNCTION_CACHE_VERSION, 'context': context_key}
+    data.update(function_cache)
+    # each module has its own file, so parallel workers never share one
+    _save_json(get_function_cache_fpath(py_modname), data)
+
+
+def write_if_changed(fpath, text, verbose=True):
+    """
+    Writes text to fpath unless fpath already holds exactly that text, so
+    unchanged outputs keep their mtimes. Returns True if a write happened.
+    """
+    if exists(fpath):
+        with open(fpath, 'r') as file_:
+            if file_.read() == text:
+                return False
+    utool.write_to(fpath, text, verbose=verbose)
+    return True
+
+
+def has_recorded_types(fpath):
+    """ True if cyth.record_types recorded argument types for fpath """
+    return exists(cyth_helpers.get_cyth_types_path(fpath))
+
+
+def has_cyth_tag(fpath):
+    """
+    Scans fpath for a CYTH tag or an import of cython (see CYTH_TAG_REGEX)
+    through mmap, without reading and decoding the whole file into a python
+    string. Files with recorded types count as tagged.
+    """
+    if has_recorded_types(fpath):
+        return True
+    with open(fpath, 'rb') as file_:
+        if os.fstat(file_.fileno()).st_size == 0:
+            # empty files cannot be mapped
+            return False
+        mapped = mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return CYTH_TAG_REGEX.search(mapped) is not None
+        finally:
+            mapped.close()
+
+
+def load_untagged_index():
+    index_fpath = get_index_fpath()
+    if exists(index_fpath):
+        try:
+            with open(index_fpath, 'r') as file_:
+                return json.load(file_)
+        except ValueError:
+            pass
+    return {}
+
+
+def filter_tagged_fpaths(fpath_list):
+    """
+    Returns the files in fpath_list that may contain CYTH tags. Files whose
+    mtime and size match the untagged index are dropped after a single stat;
+    everything else is scanned with has_cyth_tag and the index is updated.
+    """
+    index = load_untagged_index()
+    updates = {}
+    tagged_list = []
+    for fpath in fpath_list:
+        st = os.stat(fpath)
+        stamp = [st.st_mtime, st.st_size, UNTAGGED_INDEX_VERSION]
+        if index.get(fpath) == stamp and not has_recorded_types(fpath):
+            continue
+        if has_cyth_tag(fpath):
+            tagged_list.append(fpath)
+            if fpath in index:
+                updates[fpath] = None
+        else:
+            updates[fpath] = stamp
+    if len(updates) > 0:
+        index_fpath = get_index_fpath()
+        with cache_lock(index_fpath):
+            index = load_untagged_index()
+            for fpath, stamp in updates.items():
+                if stamp is None:
+                    index.pop(fpath, None)
+                else:
+                    index[fpath] = stamp
+            _save_json(index_fpath, index)
+    return tagged_list
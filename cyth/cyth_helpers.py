@@ -9,7 +9,11 @@ import utool
 import os
 import astor
 
-rrr = utool.inject_reload_function(__name__, 'cyth_helpers')
+try:
+    rrr = utool.inject_reload_function(__name__, 'cyth_helpers')
+except AttributeError:
+    # newer versions of utool (e.g. for python 3)
+    rrr = utool.inject2(__name__)[1]
 
 
 def get_py_module_name(py_fpath):
@@ -89,6 +93,36 @@ def get_cyth_pxd_path(py_fpath):
     return cy_fpath
 
 
+def get_cyth_types_path(py_fpath):
+    """
+    >>> py_fpath = '/foo/vtool/vtool/keypoint.py'
+    >>> cy_fpath = get_cyth_types_path(py_fpath)
+    >>> print(cy_fpath)
+    /foo/vtool/vtool/_keypoint_cyth_types.json
+    """
+    dpath, fname = split(py_fpath)
+    name, ext = splitext(fname)
+    assert ext == '.py', 'not a python file'
+    cy_fpath = utool.unixpath(join(dpath, get_cyth_name(name) + '_types.json'))
+    return cy_fpath
+
+
+def get_package_init_pxd_paths(py_modname, root_dpath=None):
+    """
+    The __init__.pxd paths of the packages containing py_modname, which
+    cython looks for when another module cimports its pxd
+
+    >>> py_modname = 'vtool.keypoint'
+    >>> print(get_package_init_pxd_paths(py_modname, '/foo/vtool'))
+    ['/foo/vtool/vtool/__init__.pxd']
+    """
+    if root_dpath is None:
+        root_dpath = os.getcwd()
+    components = py_modname.split('.')[:-1]
+    return [utool.unixpath(join(root_dpath, *(components[:ix] + ['__init__.pxd'])))
+            for ix in range(1, len(components) + 1)]
+
+
 def get_cyth_safe_funcname(pyth_funcname):
     return pyth_funcname + '_cyth'
 
@@ -96,4 +130,5 @@ def get_cyth_safe_funcname(pyth_funcname):
 def ast_to_sourcecode(node):
     generator = astor.codegen.SourceGenerator(' ' * 4)
     generator.visit(node)
-    return ''.join(generator.result)
+    # newer astor versions start statements with a newline
+    return ''.join(generator.result).lstrip('\n')
@@ -5,7 +5,7 @@ from __future__ import absolute_import, division, print_function
 from cyth import cyth_args
 from cyth import cyth_helpers
 from os.path import splitext, basename
-from utool.util_six import get_funcdoc, get_funcname, get_funcglobals  # NOQA
+from utool import get_funcdoc, get_funcname, get_funcglobals  # NOQA
 import imp
 import sys
 import utool
@@ -90,14 +90,34 @@ def get_cythonized_funcs(pyth_modname):
     for key, val in mod_dict.items():
         valstr = repr(val)
         # FIXME: might change in python3
-        if valstr.startswith('<built-in function '):
-            assert key.startswith("_") and key.endswith("_cyth"), key
+        # cython adds helpers of its own, e.g. __pyx_unpickle_Enum for
+        # modules that use memoryviews. Fused functions are cyfunctions.
+        is_compiled = valstr.startswith(('<built-in function ', '<cyfunction '))
+        if is_compiled and key.startswith("_") and key.endswith("_cyth"):
             cythonized_funcs[key] = val
             cythonized_funcs[key[1:]] = val
     #print(utool.dict_str(cythonized_funcs))
     return cythonized_funcs
 
 
+def get_cythonized_classes(pyth_modname):
+    """ {python class name: cdef class} (see cyth_parser.visit_toplevel_class) """
+    pkgname, fromlist, cyth_modname = pkg_submodule_split(pyth_modname)
+    cyth_mod = __import__(cyth_modname, globals(), locals(), fromlist=fromlist, level=0)
+    cythonized_classes = {}
+    for key, val in cyth_mod.__dict__.items():
+        if isinstance(val, type) and key.startswith("_") and key.endswith("_cyth"):
+            cythonized_classes[key[1:-len('_cyth')]] = val
+    return cythonized_classes
+
+
+def get_demoted_funcnames(pyth_modname):
+    """ python functions whose cython version is cdef (see cyth_parser) """
+    pkgname, fromlist, cyth_modname = pkg_submodule_split(pyth_modname)
+    cyth_mod = __import__(cyth_modname, globals(), locals(), fromlist=fromlist, level=0)
+    return getattr(cyth_mod, 'CYTH_DEMOTED_FUNCS', [])
+
+
 def import_cyth_execstr(pyth_modname):
     """
     >>> from cyth.cyth_importer import *  # NOQA
@@ -117,6 +137,14 @@ def import_cyth_execstr(pyth_modname):
         cythonized_funcs = get_cythonized_funcs(pyth_modname)
         for funcname, func in cythonized_funcs.items():
             cyth_list.append(funcname + ' = ' + cyth_modname + '.' + func.__name__)
+        # functions demoted to cdef are not visible to python
+        for funcname in get_demoted_funcnames(pyth_modname):
+            cyth_safe_funcname = cyth_helpers.get_cyth_safe_funcname(funcname)
+            cyth_list.append(cyth_safe_funcname + ' = ' + funcname)
+            cyth_list.append('_' + cyth_safe_funcname + ' = ' + funcname)
+        # the module uses the cdef classes in place of its python classes
+        for classname, class_ in get_cythonized_classes(pyth_modname).items():
+            cyth_list.append(classname + ' = ' + cyth_modname + '.' + class_.__name__)
         cyth_list2 = ['import ' + cyth_modname] + utool.align_lines(sorted(cyth_list), '=')
     except ImportError:
         cyth_list2 = ['raise ImportError("no cyth")']
@@ -235,7 +263,7 @@ def import_cyth_default(pyth_modname):
             pass
     # default to python
     def _get_cythsafe_funcname(func):
-        pyth_funcname = utool.util_six.get_funcname(func)
+        pyth_funcname = get_funcname(func)
         cythsafe_funcname = cyth_helpers.get_cyth_safe_funcname(pyth_funcname)
         return cythsafe_funcname
 
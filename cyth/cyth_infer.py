@@ -0,0 +1,363 @@
+"""
+python -c "import doctest, cyth; print(doctest.testmod(cyth.cyth_infer))"
+
+Local variable and return type inference for cythonized functions.
+
+Only a few cases are handled, and a variable is only typed when every
+assignment to it agrees:
+
+    * counters of for loops over range() / xrange() are Py_ssize_t
+    * len(x) and typed_buffer.shape[i] are Py_ssize_t
+    * fully indexing a typed buffer gives its dtype
+    * arithmetic on typed operands follows C promotion (int < float)
+
+Integer and float literals fit any type of their kind but never decide a
+type by themselves, so e.g. an accumulator that is only ever assigned 0
+stays a python object.
+"""
+from __future__ import absolute_import, division, print_function
+import ast
+import re
+import sys
+import six
+import utool
+from cyth import cyth_helpers
+
+INT_TYPES = ['Py_ssize_t', 'size_t', 'int', 'long', 'short', 'char',
+             'unsigned int', 'unsigned long', 'np.intp_t', 'np.int8_t',
+             'np.int16_t', 'np.int32_t', 'np.int64_t', 'np.uint8_t',
+             'np.uint16_t', 'np.uint32_t', 'np.uint64_t']
+FLOAT_TYPES = ['double', 'float', 'np.float32_t', 'np.float64_t']
+# Placeholder types of literals
+INT_LITERAL = '<int>'
+FLOAT_LITERAL = '<float>'
+ARITHMETIC_OPS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod)
+NDARRAY_BUFFER_REGEX = re.compile(r'^np\.ndarray\[([^,\]]+)(.*)\]$')
+MEMVIEW_REGEX = re.compile(r'^([A-Za-z_][A-Za-z0-9_.]*)\[([:, 0-9]*)\]$')
+CDEF_LINE_REGEX = re.compile(r'^(\s*)cdef\s+(.*)$')
+
+
+def type_kind(type_):
+    """ 'int', 'float' or None """
+    if type_ in INT_TYPES or type_ == INT_LITERAL:
+        return 'int'
+    if type_ in FLOAT_TYPES or type_ == FLOAT_LITERAL:
+        return 'float'
+    return None
+
+
+def get_buffer_info(type_):
+    """
+    Returns (dtype, ndim) of a buffer or memoryview type, otherwise None
+
+    >>> from cyth.cyth_infer import *  # NOQA
+    >>> get_buffer_info('np.ndarray[np.float64_t,ndim=3,mode="c"]')
+    ('np.float64_t', 3)
+    >>> get_buffer_info('np.float32_t[:, ::1]')
+    ('np.float32_t', 2)
+    """
+    if type_ is None:
+        return None
+    match = NDARRAY_BUFFER_REGEX.match(type_)
+    if match:
+        ndim_match = re.search(r'ndim\s*=\s*(\d+)', match.group(2))
+        return match.group(1).strip(), int(ndim_match.group(1)) if ndim_match else 1
+    match = MEMVIEW_REGEX.match(type_)
+    if match and ':' in match.group(2):
+        return match.group(1), match.group(2).count(',') + 1
+    return None
+
+
+def unify_types(type_list):
+    """
+    Returns the single type all of type_list agree on, or None
+
+    >>> from cyth.cyth_infer import *  # NOQA
+    >>> unify_types(['Py_ssize_t', INT_LITERAL])
+    'Py_ssize_t'
+    >>> print(unify_types(['double', 'Py_ssize_t']))
+    None
+    >>> print(unify_types([INT_LITERAL]))
+    None
+    """
+    if len(type_list) == 0 or None in type_list:
+        return None
+    concrete = set(type_ for type_ in type_list if type_ not in (INT_LITERAL, FLOAT_LITERAL))
+    if len(concrete) != 1:
+        return None
+    type_ = concrete.pop()
+    kind = type_kind(type_)
+    for other in type_list:
+        if other == INT_LITERAL and kind is None:
+            return None
+        if other == FLOAT_LITERAL and kind != 'float':
+            return None
+    return type_
+
+
+def binop_type(op, left, right):
+    """
+    >>> from cyth.cyth_infer import *  # NOQA
+    >>> binop_type(ast.Mult(), 'np.float64_t', INT_LITERAL)
+    'np.float64_t'
+    >>> binop_type(ast.Add(), 'Py_ssize_t', 'int')
+    'Py_ssize_t'
+    >>> print(binop_type(ast.Div(), 'Py_ssize_t', 'Py_ssize_t'))
+    None
+    """
+    if not isinstance(op, ARITHMETIC_OPS):
+        return None
+    kinds = (type_kind(left), type_kind(right))
+    if None in kinds:
+        return None
+    if kinds == ('int', 'int'):
+        if isinstance(op, ast.Div):
+            # true division in python 3, floor division in python 2
+            return None
+        if left == right or right == INT_LITERAL:
+            return left
+        if left == INT_LITERAL:
+            return right
+        return 'Py_ssize_t'
+    # at least one float
+    floats = [type_ for type_ in (left, right) if type_kind(type_) == 'float'
+              and type_ != FLOAT_LITERAL]
+    if len(floats) == 0:
+        return 'double'
+    if len(floats) == 2 and floats[0] != floats[1]:
+        return 'double'
+    return floats[0]
+
+
+if sys.version_info >= (3, 8):
+    # python 3.8 parses every literal as ast.Constant
+    def is_number(node):
+        return (isinstance(node, ast.Constant) and not isinstance(node.value, bool) and
+                isinstance(node.value, six.integer_types + (float, complex)))
+
+    def get_number(node):
+        return node.value
+else:
+    def is_number(node):
+        return isinstance(node, ast.Num)
+
+    def get_number(node):
+        return node.n
+
+
+def is_range_call(node):
+    return (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and
+            node.func.id in ('range', 'xrange'))
+
+
+class LocalTypeInferrer(ast.NodeVisitor):
+    """
+    Gathers the types assigned to each local name of a function body, given
+    the types inferred so far (see infer_local_types).
+    """
+    def __init__(self, typedict, inferred):
+        self.typedict = typedict
+        self.inferred = inferred
+        self.assigned = {}
+        self.return_types = []
+
+    def record(self, name, type_):
+        self.assigned.setdefault(name, []).append(type_)
+
+    def lookup(self, name):
+        return self.typedict.get(name, self.inferred.get(name, None))
+
+    def expr_type(self, node):
+        if is_number(node):
+            if isinstance(get_number(node), six.integer_types):
+                return INT_LITERAL
+            if isinstance(get_number(node), float):
+                return FLOAT_LITERAL
+            return None
+        if isinstance(node, ast.Name):
+            return self.lookup(node.id)
+        if isinstance(node, ast.BinOp):
+            return binop_type(node.op, self.expr_type(node.left), self.expr_type(node.right))
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+            return self.expr_type(node.operand)
+        if isinstance(node, ast.Call):
+            if (isinstance(node.func, ast.Name) and node.func.id == 'len' and
+                    len(node.args) == 1):
+                return 'Py_ssize_t'
+            return None
+        if isinstance(node, ast.Subscript):
+            # python 3.9 dropped the ast.Index wrapper
+            index = node.slice.value if isinstance(node.slice, ast.Index) else node.slice
+            if not isinstance(index, (ast.Slice, ast.ExtSlice)):
+                return self.subscript_type(node.value, index)
+        return None
+
+    def subscript_type(self, value, index):
+        if (isinstance(value, ast.Attribute) and value.attr == 'shape' and
+                isinstance(value.value, ast.Name)):
+            if get_buffer_info(self.lookup(value.value.id)) is not None:
+                return 'Py_ssize_t'
+            return None
+        if isinstance(value, ast.Name):
+            info = get_buffer_info(self.lookup(value.id))
+            if info is None:
+                return None
+            dtype, ndim = info
+            indices = index.elts if isinstance(index, ast.Tuple) else [index]
+            if len(indices) == ndim and all(type_kind(self.expr_type(ix)) == 'int'
+                                            for ix in indices):
+                return dtype
+        return None
+
+    def visit_Assign(self, node):
+        self.visit(node.value)
+        if len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            self.record(node.targets[0].id, self.expr_type(node.value))
+        else:
+            for target in node.targets:
+                self.visit(target)
+
+    def visit_AugAssign(self, node):
+        self.visit(node.value)
+        if isinstance(node.target, ast.Name):
+            value_type = self.expr_type(node.value)
+            target_type = self.lookup(node.target.id)
+            if target_type is None and node.target.id in self.assigned:
+                # optimistic guess for accumulators, checked by the next pass
+                target_type = value_type
+            self.record(node.target.id, binop_type(node.op, target_type, value_type))
+        else:
+            self.visit(node.target)
+
+    def visit_For(self, node):
+        if isinstance(node.target, ast.Name) and is_range_call(node.iter):
+            self.record(node.target.id, 'Py_ssize_t')
+        else:
+            self.visit(node.target)
+        self.visit(node.iter)
+        for stmt in node.body + node.orelse:
+            self.visit(stmt)
+
+    def visit_Name(self, node):
+        if not isinstance(node.ctx, ast.Load):
+            # bound by anything other than the assignments above
+            self.record(node.id, None)
+
+    def visit_Global(self, node):
+        for name in node.names:
+            self.record(name, None)
+
+    def visit_FunctionDef(self, node):
+        # nested scopes are left alone
+        self.record(node.name, None)
+
+    def visit_Lambda(self, node):
+        pass
+
+    def visit_Return(self, node):
+        if node.value is None:
+            self.return_types.append(None)
+        else:
+            self.visit(node.value)
+            self.return_types.append(self.expr_type(node.value))
+
+    def get_local_types(self):
+        local_types = {}
+        for name, type_list in six.iteritems(self.assigned):
+            type_ = unify_types(type_list)
+            if type_ is not None:
+                local_types[name] = type_
+        return local_types
+
+
+def get_body_source(body, indent_with='    '):
+    """
+    Returns python source for a mix of emitted cyth code lines and python
+    statements, and the names declared by the single line cdefs in it (their
+    declarations are dropped, initializations are kept).
+    """
+    from cyth.cyth_parser import parse_cdef_line
+    base_indent = indent_with
+    for item in body:
+        if isinstance(item, six.string_types) and item.strip() != '':
+            line = item.lstrip('\n').split('\n')[0]
+            base_indent = line[:len(line) - len(line.lstrip())]
+            break
+    lines = []
+    declared = set([])
+    for item in body:
+        if isinstance(item, ast.AST):
+            source = cyth_helpers.ast_to_sourcecode(item)
+            lines.extend(base_indent + line for line in source.split('\n'))
+        elif isinstance(item, six.string_types):
+            for line in item.lstrip('\n').split('\n'):
+                match = CDEF_LINE_REGEX.match(line)
+                if match and not match.group(2).endswith(':'):
+                    cdef_typedict = parse_cdef_line(match.group(2))
+                    declared.update(cdef_typedict.keys())
+                    init = re.search(r'([A-Za-z_][A-Za-z0-9_]*)\s*=(?!=)(.*)$',
+                                     match.group(2).split(']')[-1])
+                    if len(cdef_typedict) == 1 and init:
+                        line = match.group(1) + init.group(1) + ' =' + init.group(2)
+                    else:
+                        continue
+                lines.append(line)
+    return utool.unindent('\n'.join(lines)), declared
+
+
+def infer_local_types(body, typedict, exclude=None, max_iters=5):
+    """
+    Infers C types for the untyped locals of a function body.
+
+    Args:
+        body (list): emitted cyth code lines and python statements
+        typedict (dict): declared types
+        exclude (list): names that must not be typed (e.g. parameters)
+
+    Returns:
+        tuple: (inferred, return_type). inferred maps local names to types,
+            return_type is the C type every return agrees on (or None). Both
+            are empty if the body is not plain python (e.g. uses casts).
+
+    Example:
+        >>> from cyth.cyth_infer import *  # NOQA
+        >>> import utool
+        >>> body = ast.parse(utool.unindent('''
+        ...     n = x.shape[0]
+        ...     total = 0.0
+        ...     for ix in range(n):
+        ...         total += x[ix] * 2
+        ...     return total
+        ...     ''')).body
+        >>> typedict = {'x': 'np.ndarray[np.float64_t,ndim=1]'}
+        >>> inferred, return_type = infer_local_types(body, typedict, ['x'])
+        >>> sorted(inferred.items())
+        [('ix', 'Py_ssize_t'), ('n', 'Py_ssize_t'), ('total', 'np.float64_t')]
+        >>> return_type
+        'np.float64_t'
+    """
+    source, declared = get_body_source(body)
+    try:
+        module_node = ast.parse(source)
+    except SyntaxError:
+        return {}, None
+    exclude = set(exclude or []) | declared | set(typedict.keys())
+    inferred = {}
+    for _ in range(max_iters):
+        inferrer = LocalTypeInferrer(typedict, inferred)
+        inferrer.visit(module_node)
+        new_inferred = {name: type_ for name, type_ in six.iteritems(inferrer.get_local_types())
+                        if name not in exclude}
+        if new_inferred == inferred:
+            break
+        inferred = new_inferred
+    else:
+        return {}, None
+    return_type = None
+    ends_with_return = len(module_node.body) > 0 and isinstance(module_node.body[-1], ast.Return)
+    if ends_with_return:
+        return_type = unify_types(inferrer.return_types)
+        if type_kind(return_type) is None:
+            # only scalars; buffers and fused types stay python objects
+            return_type = None
+    return inferred, return_type
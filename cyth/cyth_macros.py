@@ -2,9 +2,11 @@
 python -c "import cyth, doctest; print(doctest.testmod(cyth.cyth_macros))"
 """
 from __future__ import absolute_import, division, print_function
-import parse
+import ast
 import re
-from functools import partial
+import six
+from cyth import cyth_helpers
+from cyth import cyth_infer
 from .cyth_decorators import macro
 
 
@@ -12,36 +14,93 @@ def parens(str_):
     return '(' + str_ + ')'
 
 
-def is_constant(expr, known_constants=[]):
-    if re.match(r'\d+', expr) or expr in known_constants:
-        return True
-    return False
+class LoopNest(object):
+    """
+    A loop nest expanded by a macro: prologue lines (declarations, checks and
+    allocations), then body lines run for every index in the extents (dims).
+    Its str() is the cython source.
+
+    Args:
+        outputs (list): arrays the body writes, at the current index only
+        rebinds (list): names the prologue assigns a new array to
+    """
+    def __init__(self, prologue, dims, idxs, body, outputs=None, rebinds=None):
+        self.prologue = list(prologue)
+        self.dims = list(dims)
+        self.idxs = list(idxs)
+        self.body = list(body)
+        self.outputs = list(outputs or [])
+        self.rebinds = list(rebinds or [])
+
+    def fuse(self, other):
+        """ appends a nest over the same extents, reusing its loop indices """
+        rename = dict(zip(other.idxs, self.idxs))
+        index_regex = re.compile(r'\b(%s)\b' % '|'.join(map(re.escape, other.idxs)))
+        self.prologue += other.prologue
+        self.body += [index_regex.sub(lambda match: rename[match.group(1)], line)
+                      for line in other.body]
+        self.outputs += other.outputs
+        self.rebinds += other.rebinds
+
+    def __str__(self):
+        lines = self.prologue + ['cdef Py_ssize_t ' + ', '.join(self.idxs)]
+        indent = ''
+        for idx, dim in zip(self.idxs, self.dims):
+            lines += ['%sfor %s in range(%s):' % (indent, idx, dim)]
+            indent += '    '
+        lines += [indent + line for line in self.body]
+        return '\n'.join(lines)
+
+
+def uses_names(lines, names):
+    if len(names) == 0:
+        return False
+    regex = re.compile(r'\b(%s)\b' % '|'.join(map(re.escape, names)))
+    return any(regex.search(line) for line in lines)
 
 
-def get_slicerange(slice_, dim_name='dim0'):
+def fuse_loop_nests(expansions):
     """
-    slice_ = 'start:stop:stride'
+    Merges consecutive LoopNests over identical extents into one loop nest,
+    so their arrays are traversed once. Every prologue then runs before the
+    fused loop, so a nest is not fused if its prologue reads an array written
+    by the loop (e.g. slices it), or if it rebinds a name the loop uses. The
+    bodies may read each other's outputs because they only do so at the
+    current index.
+
+    >>> from cyth.cyth_macros import *
+    >>> gensym = make_gensym_function()
+    >>> src_views = {}
+    >>> lines = ['_iv11s = invVR_mats[:, 0, 0]', '_iv22s = invVR_mats[:, 1, 1]']
+    >>> expansions = [numpy_fancy_index_assign(gensym, line, src_views, copy=True)
+    ...               for line in lines]
+    >>> for expansion in fuse_loop_nests(expansions):
+    ...     print(expansion)
+    cdef np.float64_t[:, :, :] src__gensym0 = invVR_mats
+    if src__gensym0.shape[1] <= 0 or src__gensym0.shape[2] <= 0:
+        raise IndexError('index out of bounds')
+    cdef np.float64_t[:] view__gensym0 = src__gensym0[:, 0, 0]
+    cdef np.float64_t[::1] _iv11s = np.empty((src__gensym0.shape[0],), dtype=np.float64)
+    if src__gensym0.shape[1] <= 1 or src__gensym0.shape[2] <= 1:
+        raise IndexError('index out of bounds')
+    cdef np.float64_t[:] view__gensym1 = src__gensym0[:, 1, 1]
+    cdef np.float64_t[::1] _iv22s = np.empty((src__gensym0.shape[0],), dtype=np.float64)
+    cdef Py_ssize_t idx0__gensym0
+    for idx0__gensym0 in range(src__gensym0.shape[0]):
+        _iv11s[idx0__gensym0] = view__gensym0[idx0__gensym0]
+        _iv22s[idx0__gensym0] = view__gensym1[idx0__gensym0]
     """
-    tup = slice_.split(':')
-    if len(tup) == 0:
-        raise AssertionError('')
-    if len(tup) == 1:
-        if is_constant(tup[0]):
-            slicerange = ('1',)
+    fused = []
+    for expansion in expansions:
+        prev = fused[-1] if len(fused) > 0 else None
+        if (isinstance(expansion, LoopNest) and isinstance(prev, LoopNest) and
+                expansion.dims == prev.dims and
+                not uses_names(expansion.prologue, prev.outputs) and
+                not uses_names(prev.prologue + prev.body, expansion.rebinds)):
+            prev.fuse(expansion)
         else:
-            raise NotImplementedError('custom input')
-    elif len(tup) == 2:
-        start = '0' if tup[0] == '' else tup[0]
-        stop = dim_name if tup[1] == '' else tup[1]
-        slicerange = (start, stop)
-    elif len(tup) == 3:
-        start = '0' if tup[0] == '' else tup[0]
-        stop = dim_name if tup[1] == '' else tup[1]
-        stride = '1' if tup[2] == '' else tup[2]
-        slicerange = (start, stop, stride)
-    else:
-        raise AssertionError('??')
-    return slicerange
+            fused.append(expansion)
+    return fused
 
 
 def make_gensym_function(suffix='gensym'):
@@ -53,198 +112,774 @@ def make_gensym_function(suffix='gensym'):
     return gensym
 
 
-@macro
-def numpy_fancy_index_macro(gensym, lines):
-    return map(partial(numpy_fancy_index_assign, gensym), lines)
+NUMPY_DTYPE_NAMES = {
+    'double': 'np.float64',
+    'float': 'np.float32',
+    'int': 'np.intc',
+    'long': 'np.int_',
+    'Py_ssize_t': 'np.intp',
+}
 
 
-def numpy_fancy_index_assign(gensym, line):
+def get_numpy_dtype(ctype):
     """
-    Input is gaurenteed to be one numpy array assigning to another.
-    Still in development. May break for complicated cases.
+    >>> from cyth.cyth_macros import *
+    >>> get_numpy_dtype('np.float32_t'), get_numpy_dtype('Py_ssize_t')
+    ('np.float32', 'np.intp')
+    """
+    if ctype.startswith('np.') and ctype.endswith('_t'):
+        return ctype[:-2]
+    return NUMPY_DTYPE_NAMES[ctype]
+
 
+def memview_type(ctype, ndim, contiguous=False):
+    """
     >>> from cyth.cyth_macros import *
-    >>> gensym = make_gensym_function()
-    >>> line = '_iv21s = invVR_mats[:, 1, :, 2:42, ::-1, , 3:, :]'
-    >>> line = '_iv21s = invVR_mats[:, 1, :]'
-    >>> block1 = numpy_fancy_index_assign(gensym, '_iv11s = invVR_mats[:, 0, 0]')
-    >>> block2 = numpy_fancy_index_assign(gensym, '_iv12s = invVR_mats[:, :, 1]')
-    >>> block3 = numpy_fancy_index_assign(gensym, '_iv21s = invVR_mats[:, 1, :]')
-    >>> block4 = numpy_fancy_index_assign(gensym, '_iv22s = invVR_mats[:, 1, 1]')
-    >>> print('\n'.join((block1, block2, block3, block4)))
-
-    A shape is a tuple of array dimensions
-
-    """
-    # Split at assignment
-    LHS, RHS = line.split('=')
-    # Parse out the fancy index slice
-    _parseresult = parse.parse('{arr2}[{fancy_slice}]', RHS.strip())
-    _fancy_slice   = _parseresult.named['fancy_slice']
-
-    arr1 = LHS.strip()
-    arr2 = _parseresult.named['arr2']
-    # Break fancy slices into individual slices
-    slice_list = [_.strip() for _ in _fancy_slice.split(',')]
-
-    dim_ix_idx_fmt     = gensym('dim{ix}_idx')
-    dim_ix_fmt       = gensym('dim{ix}')
-    defdim_fmt       = 'cdef size_t {dim_ix_fmt} = {{arr2}}.shape[{{ix}}]'.format(dim_ix_fmt=dim_ix_fmt)
-    #alloc_ouput_fmt  = 'cdef np.ndarray {arr1} = np.ndarray(({LHS_shape}), {arr2}.dtype)'
-    alloc_ouput_fmt  = '{arr1} = np.ndarray(({LHS_shape}), {arr2}.dtype)'
-    alloc_ouput_fmt  = '{arr1} = np.ndarray(({LHS_shape}), {arr2}.dtype)'
-    for_fmt          = '{indent}for {dim_x} in range({dimsize}):'
-    assign_index_fmt = '{indent}{arr1}[{LHS_index}] = {arr2}[{RHS_index}]'
-
-    RHS_slicerange_list = [get_slicerange(slice_, dim_ix_fmt.format(ix=ix)) for ix, slice_ in enumerate(slice_list)]
-    LHS_slicerange_list = [slicerange for slicerange in RHS_slicerange_list if
-                           slicerange[0] != '1']
-
-    LHS_dimsize_list = [slicerange[0]
-                        if len(slicerange) == 1 else
-                        slicerange[1] + ' - ' + slicerange[0]
-                        for slicerange in LHS_slicerange_list]
-    RHS_dimsize_list = [slicerange[0]
-                         if len(slicerange) == 1 else
-                         slicerange[1] + ' - ' + slicerange[0]
-                         for slicerange in RHS_slicerange_list ]
-
-    #LHS_shape_list = [', '.join(slicerange) for slicerange in LHS_slicerange_list]
-
-    LHS_shape = parens(', '.join(LHS_dimsize_list))
-    #RHS_shape = parens(', '.join(RHS_dimsize_list))
+    >>> memview_type('np.float64_t', 2), memview_type('double', 2, contiguous=True)
+    ('np.float64_t[:, :]', 'double[:, ::1]')
+    """
+    axes = [':'] * ndim
+    if contiguous and ndim > 0:
+        axes[-1] = '::1'
+    return '%s[%s]' % (ctype, ', '.join(axes))
 
-    indent = ''
-    for_list = []
-    # indexes into the array shapes
-    LHS_shapex_list = []
-    RHS_shapex_list = []
-    # So hacky and special cased
-    for ix, dimsize in enumerate(RHS_dimsize_list):
-        rhs_slicerange = RHS_slicerange_list[ix]
-        dim_x = dim_ix_idx_fmt.format(ix=ix)
-        if len(rhs_slicerange) == 1:
-            RHS_shapex_list.append(dimsize)
-            #LHS_shapex_list.append('0')
+
+
+def shape_tuple(dims):
+    """
+    >>> from cyth.cyth_macros import *
+    >>> shape_tuple(['n']), shape_tuple(['n', 'm'])
+    ('(n,)', '(n, m)')
+    """
+    return '(' + ', '.join(dims) + (',' if len(dims) == 1 else '') + ')'
+
+
+def get_index_items(slice_node):
+    """
+    Returns the items of a subscript as ('slice', source), ('scalar', node) or
+    ('list', [sources]) tuples
+    """
+    if isinstance(slice_node, ast.ExtSlice):
+        nodes = slice_node.dims
+    elif isinstance(slice_node, ast.Index):
+        value = slice_node.value
+        nodes = value.elts if isinstance(value, ast.Tuple) else [value]
+    elif isinstance(slice_node, ast.Tuple):
+        nodes = slice_node.elts
+    else:
+        nodes = [slice_node]
+    items = []
+    for node in nodes:
+        if isinstance(node, ast.Index):
+            node = node.value
+        if isinstance(node, ast.Slice):
+            parts = [node.lower, node.upper] + ([] if node.step is None else [node.step])
+            items.append(('slice', ':'.join(map(get_index_source, parts))))
+        elif isinstance(node, (ast.List, ast.Tuple)):
+            items.append(('list', list(map(get_index_source, node.elts))))
+        elif isinstance(node, ast.Ellipsis) or getattr(node, 'value', None) is Ellipsis:
+            raise NotImplementedError('Ellipsis indices are not supported')
         else:
-            LHS_shapex_list.append(dim_x)
-            RHS_shapex_list.append(dim_x)
-            for_list.append(for_fmt.format(indent=indent, dim_x=dim_x,
-                                           dimsize=dimsize))
-            indent += '    '
+            items.append(('scalar', node))
+    return items
+
+
+def get_int_literal(node):
+    """ the value of an integer constant node (possibly negated), otherwise None """
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        value = get_int_literal(node.operand)
+        return None if value is None else -value
+    value = getattr(node, 'n', getattr(node, 'value', None))
+    if isinstance(value, six.integer_types) and not isinstance(value, bool):
+        return value
+    return None
 
-    RHS_defdim_list = [defdim_fmt.format(ix=ix, arr2=arr2) for ix in range(len(slice_list))]
 
-    # Make index expression
-    LHS_index = ', '.join(LHS_shapex_list)
-    RHS_index = ', '.join(RHS_shapex_list)
+def get_index_source(node):
+    if node is None:
+        return ''
+    value = get_int_literal(node)
+    return cyth_helpers.ast_to_sourcecode(node) if value is None else str(value)
 
-    alloc_output_line = alloc_ouput_fmt.format(
-        arr1=arr1, arr2=arr2, LHS_shape=LHS_shape)
-    defdim_assign = '\n'.join(RHS_defdim_list)
 
-    for_lines = '\n'.join(for_list)
+def parse_index_assign(line):
+    """
+    Returns (output, array, index items) if line assigns an index of an array
+    to a name, otherwise None
 
-    assign_index_line = assign_index_fmt.format(
-        indent=indent, arr1=arr1, LHS_index=LHS_index, arr2=arr2, RHS_index=RHS_index)
+    >>> from cyth.cyth_macros import *
+    >>> output, arr, items = parse_index_assign('_iv12s = invVR_mats[::-1, 0, [1, 2]]')
+    >>> output, arr, [kind for kind, _ in items]
+    ('_iv12s', 'invVR_mats', ['slice', 'scalar', 'list'])
+    >>> items[0][1], items[2][1]
+    ('::-1', ['1', '2'])
+    """
+    try:
+        stmt = ast.parse(line.strip()).body[0]
+    except SyntaxError:
+        return None
+    if not (isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 and
+            isinstance(stmt.targets[0], ast.Name) and isinstance(stmt.value, ast.Subscript) and
+            isinstance(stmt.value.value, ast.Name)):
+        return None
+    return stmt.targets[0].id, stmt.value.value.id, get_index_items(stmt.value.slice)
 
-    output_lines = [defdim_assign, alloc_output_line, for_lines, assign_index_line]
-    output_block = '\n' + '\n'.join(output_lines) + '\n\n'
-    print(output_block)
-    return output_block
+
+@macro
+def numpy_fancy_index_macro(gensym, lines, ndim=None, dtype='np.float64_t', copy='False'):
+    """
+    Expands `out = arr[index]` lines. Each array is read through one typed
+    memoryview, and out is declared as a typed memoryview (do not declare it
+    elsewhere; returning it from the function gives callers an ndarray).
+
+    Slices (any start, stop and step) and integer scalars select a strided
+    view, so out is a memoryview slice of arr and nothing is copied. A list
+    of indices in one axis, or the copy=True option, copies the selection
+    into a new contiguous array with typed loops; consecutive copies with
+    the same extents share one loop (see fuse_loop_nests). Cyth functions
+    run without boundscheck, so every scalar and list index is checked here
+    (raising IndexError).
+
+    The macro only sees source lines, so the arrays' dtype is given as an
+    option, and ndim defaults to the number of indices, e.g.
+    ``#macro numpy_fancy_index_macro ndim=3 dtype=np.float32_t``.
+    Other lines are left as they are.
+    """
+    src_views = {}
+    expansions = [numpy_fancy_index_assign(gensym, line, src_views, ndim, dtype, copy == 'True')
+                  for line in lines]
+    return ['\n' + str(expansion) + '\n' for expansion in fuse_loop_nests(expansions)]
 
 
-def numpy_fancy_index_assign1(gensym, line):
+def numpy_fancy_index_assign(gensym, line, src_views=None, ndim=None, dtype='np.float64_t',
+                             copy=False):
     """
-    Input is gaurenteed to be one numpy array assigning to another.
-    Still in development. May break for complicated cases.
+    Args:
+        src_views (dict): the memoryviews already declared for (array, ndim)
 
     >>> from cyth.cyth_macros import *
     >>> gensym = make_gensym_function()
-    >>> line = '_iv21s = invVR_mats[:, 1, :]'
-    >>> block1 = numpy_fancy_index_assign(gensym, '_iv11s = invVR_mats[:, 0, 0]')
-    >>> block2 = numpy_fancy_index_assign(gensym, '_iv12s = invVR_mats[:, :, 1]')
-    >>> block3 = numpy_fancy_index_assign(gensym, '_iv21s = invVR_mats[:, 1, :]')
-    >>> block4 = numpy_fancy_index_assign(gensym, '_iv22s = invVR_mats[:, 1, 1]')
-    >>> print('\n'.join((block1, block2, block3, block4)))
-
-    A shape is a tuple of array dimensions
-
-    """
-    # Split at assignment
-    LHS, RHS = line.split('=')
-    # Parse out the fancy index slice
-    _parseresult = parse.parse('{arr2}[{fancy_slice}]', RHS.strip())
-    _fancy_slice   = _parseresult.named['fancy_slice']
-
-    arr1 = LHS.strip()
-    arr2 = _parseresult.named['arr2']
-    # Break fancy slices into individual slices
-    slice_list = [_.strip() for _ in _fancy_slice.split(',')]
-
-    dim_ix_idx_fmt     = gensym('dim{ix}_idx')
-    dim_ix_fmt       = gensym('dim{ix}')
-    defdim_fmt       = 'cdef Py_ssize_t {dim_ix_fmt} = {{arr2}}.shape[{{ix}}]'.format(dim_ix_fmt=dim_ix_fmt)
-    #alloc_ouput_fmt  = 'cdef np.ndarray {arr1} = np.ndarray(({LHS_shape}), {arr2}.dtype)'
-    alloc_ouput_fmt  = '{arr1} = np.empty(({LHS_shape}))'
-    #, {arr2}.dtype
-    for_fmt          = '{indent}for {dim_x} in range({dimsize}):'
-    assign_index_fmt = '{indent}{arr1}[{LHS_index}] = {arr2}[{RHS_index}]'
-
-    RHS_slicerange_list = [get_slicerange(slice_, dim_ix_fmt.format(ix=ix))
-                           for ix, slice_ in enumerate(slice_list)]
-    LHS_slicerange_list = [slicerange for slicerange in RHS_slicerange_list if
-                           slicerange[0] != '1']
-
-    LHS_dimsize_list = [slicerange[0]
-                        if len(slicerange) == 1 else
-                        slicerange[1] + ' - ' + slicerange[0]
-                        for slicerange in LHS_slicerange_list]
-    RHS_dimsize_list = [slicerange[0]
-                         if len(slicerange) == 1 else
-                         slicerange[1] + ' - ' + slicerange[0]
-                         for slicerange in RHS_slicerange_list ]
-
-    #LHS_shape_list = [', '.join(slicerange) for slicerange in LHS_slicerange_list]
-
-    LHS_shape = parens(', '.join(LHS_dimsize_list))
-    #RHS_shape = parens(', '.join(RHS_dimsize_list))
-
-    indent = ''
-    for_list = []
-    # indexes into the array shapes
-    LHS_shapex_list = []
-    RHS_shapex_list = []
-    # So hacky and special cased
-    for ix, dimsize in enumerate(RHS_dimsize_list):
-        rhs_slicerange = RHS_slicerange_list[ix]
-        dim_x = dim_ix_idx_fmt.format(ix=ix)
-        if len(rhs_slicerange) == 1:
-            RHS_shapex_list.append(dimsize)
-            #LHS_shapex_list.append('0')
+    >>> src_views = {}
+    >>> print(numpy_fancy_index_assign(gensym, '_iv11s = invVR_mats[:, 0, 0]', src_views))
+    cdef np.float64_t[:, :, :] src__gensym0 = invVR_mats
+    if src__gensym0.shape[1] <= 0 or src__gensym0.shape[2] <= 0:
+        raise IndexError('index out of bounds')
+    cdef np.float64_t[:] _iv11s = src__gensym0[:, 0, 0]
+    >>> print(numpy_fancy_index_assign(gensym, '_iv21s = invVR_mats[::-1, 1, ix]', src_views))
+    cdef Py_ssize_t ix2__gensym1 = ix
+    if ix2__gensym1 < 0:
+        ix2__gensym1 += src__gensym0.shape[2]
+    if not 0 <= ix2__gensym1 < src__gensym0.shape[2]:
+        raise IndexError('index out of bounds')
+    if src__gensym0.shape[1] <= 1:
+        raise IndexError('index out of bounds')
+    cdef np.float64_t[:] _iv21s = src__gensym0[::-1, 1, ix2__gensym1]
+    >>> print(numpy_fancy_index_assign(gensym, 'out = invVR_mats[:, -1, [0, 1]]', src_views))
+    if src__gensym0.shape[1] < 1:
+        raise IndexError('index out of bounds')
+    cdef np.float64_t[:, :] view__gensym2 = src__gensym0[:, src__gensym0.shape[1] - 1, :]
+    cdef Py_ssize_t table__gensym2[2]
+    table__gensym2[:] = [0, 1]
+    cdef Py_ssize_t k__gensym2
+    for k__gensym2 in range(2):
+        if table__gensym2[k__gensym2] < 0:
+            table__gensym2[k__gensym2] += view__gensym2.shape[1]
+        if not 0 <= table__gensym2[k__gensym2] < view__gensym2.shape[1]:
+            raise IndexError('index out of bounds')
+    cdef np.float64_t[:, ::1] out = np.empty((src__gensym0.shape[0], 2), dtype=np.float64)
+    cdef Py_ssize_t idx0__gensym2, idx1__gensym2
+    for idx0__gensym2 in range(src__gensym0.shape[0]):
+        for idx1__gensym2 in range(2):
+            out[idx0__gensym2, idx1__gensym2] = view__gensym2[idx0__gensym2, table__gensym2[idx1__gensym2]]
+    """
+    parsed = parse_index_assign(line)
+    if parsed is None:
+        return line
+    output, arr, items = parsed
+    ndim = len(items) if ndim is None else int(ndim)
+    if len(items) > ndim:
+        raise IndexError('too many indices for %r (ndim=%d): %r' % (arr, ndim, line))
+    items = items + [('slice', ':')] * (ndim - len(items))
+    if src_views is None:
+        src_views = {}
+
+    sym_fmt = gensym('{name}')
+    sym = lambda name: sym_fmt.format(name=name)
+    block = []
+    src = src_views.get((arr, ndim), None)
+    if src is None:
+        src = src_views[(arr, ndim)] = sym('src')
+        block += ['cdef %s %s = %s' % (memview_type(dtype, ndim), src, arr)]
+    basic_index = []
+    list_axes = []  # (axis of the view, index sources)
+    full_axes = {}  # {axis of the view: axis of src} of ':' slices
+    constant_checks = []  # out of bounds conditions of constant scalars
+    for axis, (kind, item) in enumerate(items):
+        if kind == 'slice':
+            if item == ':':
+                full_axes[len([_ for _ in basic_index if ':' in _])] = axis
+            basic_index.append(item)
+        elif kind == 'list':
+            list_axes.append((len([_ for _ in basic_index if ':' in _]), item))
+            basic_index.append(':')
         else:
-            LHS_shapex_list.append(dim_x)
-            RHS_shapex_list.append(dim_x)
-            for_list.append(for_fmt.format(indent=indent, dim_x=dim_x,
-                                           dimsize=dimsize))
-            indent += '    '
+            # wraparound and boundscheck are off in cyth functions, so
+            # negative scalars are wrapped and all scalars are checked here
+            extent = '%s.shape[%d]' % (src, axis)
+            value = get_int_literal(item)
+            if value is None:
+                scalar = sym('ix%d' % axis)
+                block += ['cdef Py_ssize_t %s = %s' % (scalar, cyth_helpers.ast_to_sourcecode(item)),
+                          'if %s < 0:' % (scalar,),
+                          '    %s += %s' % (scalar, extent),
+                          'if not 0 <= %s < %s:' % (scalar, extent),
+                          "    raise IndexError('index out of bounds')"]
+                basic_index.append(scalar)
+            elif value < 0:
+                constant_checks.append('%s < %d' % (extent, -value))
+                basic_index.append('%s - %d' % (extent, -value))
+            else:
+                constant_checks.append('%s <= %d' % (extent, value))
+                basic_index.append(str(value))
+    if len(constant_checks) > 0:
+        block += ['if %s:' % (' or '.join(constant_checks),),
+                  "    raise IndexError('index out of bounds')"]
+    out_ndim = len([_ for _ in basic_index if ':' in _])
+    view_expr = '%s[%s]' % (src, ', '.join(basic_index))
+    if out_ndim == 0:
+        block += ['cdef %s %s = %s' % (dtype, output, view_expr)]
+        return '\n'.join(block)
+    if len(list_axes) == 0 and not copy:
+        block += ['cdef %s %s = %s' % (memview_type(dtype, out_ndim), output, view_expr)]
+        return '\n'.join(block)
+    if len(list_axes) > 1:
+        raise NotImplementedError('only one axis can be indexed by a list: %r' % (line,))
+
+    # copy the strided view; list indices go through a table
+    view = sym('view')
+    block += ['cdef %s %s = %s' % (memview_type(dtype, out_ndim), view, view_expr)]
+    # the extents of src are shared by the lines over it, see fuse_loop_nests
+    dims = ['%s.shape[%d]' % ((src, full_axes[ix]) if ix in full_axes else (view, ix))
+            for ix in range(out_ndim)]
+    view_idxs = idxs = [sym('idx%d' % ix) for ix in range(out_ndim)]
+    if len(list_axes) == 1:
+        list_axis, entries = list_axes[0]
+        table, k = sym('table'), sym('k')
+        extent = '%s.shape[%d]' % (view, list_axis)
+        block += ['cdef Py_ssize_t %s[%d]' % (table, len(entries)),
+                  '%s[:] = [%s]' % (table, ', '.join(entries)),
+                  'cdef Py_ssize_t %s' % (k,),
+                  'for %s in range(%d):' % (k, len(entries)),
+                  '    if %s[%s] < 0:' % (table, k),
+                  '        %s[%s] += %s' % (table, k, extent),
+                  '    if not 0 <= %s[%s] < %s:' % (table, k, extent),
+                  "        raise IndexError('index out of bounds')"]
+        dims = dims[:list_axis] + [str(len(entries))] + dims[list_axis + 1:]
+        view_idxs = (idxs[:list_axis] + ['%s[%s]' % (table, idxs[list_axis])] +
+                     idxs[list_axis + 1:])
+    block += ['cdef %s %s = np.empty(%s, dtype=%s)' % (
+        memview_type(dtype, out_ndim, contiguous=True), output, shape_tuple(dims),
+        get_numpy_dtype(dtype))]
+    body = ['%s[%s] = %s[%s]' % (output, ', '.join(idxs), view, ', '.join(view_idxs))]
+    return LoopNest(block, dims, idxs, body, outputs=[output])
+
+
+ELEMENTWISE_OPS = {
+    ast.Add: '+',
+    ast.Sub: '-',
+    ast.Mult: '*',
+    ast.Div: '/',
+    ast.Pow: '**',
+}
+
+
+def parse_elementwise(line, scalars=()):
+    """
+    Returns (output, expression node, array names) if line assigns an
+    arithmetic expression of arrays and scalars to a name, otherwise None.
+    Names are arrays unless listed in scalars.
 
-    RHS_defdim_list = [defdim_fmt.format(ix=ix, arr2=arr2) for ix in range(len(slice_list))]
+    >>> from cyth.cyth_macros import *
+    >>> output, expr, arrays = parse_elementwise('out = a * b + c / alpha', ['alpha'])
+    >>> output, arrays
+    ('out', ['a', 'b', 'c'])
+    >>> print(parse_elementwise('out = np.sqrt(a) + b'))
+    None
+    """
+    try:
+        stmt = ast.parse(line.strip()).body[0]
+    except SyntaxError:
+        return None
+    if not (isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 and
+            isinstance(stmt.targets[0], ast.Name)):
+        return None
+    arrays = []
+
+    def check(node):
+        if isinstance(node, ast.BinOp):
+            return type(node.op) in ELEMENTWISE_OPS and check(node.left) and check(node.right)
+        if isinstance(node, ast.UnaryOp):
+            return isinstance(node.op, (ast.USub, ast.UAdd)) and check(node.operand)
+        if isinstance(node, ast.Name):
+            if node.id not in scalars and node.id not in arrays:
+                arrays.append(node.id)
+            return True
+        value = getattr(node, 'n', getattr(node, 'value', None))
+        return isinstance(value, (six.integer_types, float)) and not isinstance(value, bool)
+    is_expression = isinstance(stmt.value, (ast.BinOp, ast.UnaryOp))
+    if not (is_expression and check(stmt.value) and len(arrays) > 0):
+        return None
+    return stmt.targets[0].id, stmt.value, arrays
+
+
+def get_elementwise_source(node, operand_source):
+    """ C source of an expression; operand_source gives the source of names """
+    if isinstance(node, ast.BinOp):
+        return '(%s %s %s)' % (get_elementwise_source(node.left, operand_source),
+                               ELEMENTWISE_OPS[type(node.op)],
+                               get_elementwise_source(node.right, operand_source))
+    if isinstance(node, ast.UnaryOp):
+        sign = '-' if isinstance(node.op, ast.USub) else '+'
+        return '(%s%s)' % (sign, get_elementwise_source(node.operand, operand_source))
+    if isinstance(node, ast.Name):
+        return operand_source(node.id)
+    return repr(getattr(node, 'n', getattr(node, 'value', None)))
 
-    # Make index expression
-    LHS_index = ', '.join(LHS_shapex_list)
-    RHS_index = ', '.join(RHS_shapex_list)
 
-    alloc_output_line = alloc_ouput_fmt.format(
-        arr1=arr1, arr2=arr2, LHS_shape=LHS_shape)
-    defdim_assign = '\n'.join(RHS_defdim_list)
+@macro
+def numpy_elementwise_macro(gensym, lines, ndim='1', dtype='np.float64_t', scalars=''):
+    """
+    Expands arithmetic (+, -, *, /, **) on arrays and scalars, e.g.
+    `out = a * b + c / alpha`, into one typed loop that writes each element
+    of out directly, so numpy allocates no temporaries. out is declared as a
+    new contiguous typed memoryview (returning it from the function gives
+    callers an ndarray).
+
+    The arrays must have the same ndim, and broadcast like numpy's: each
+    extent of out is the largest extent of the arrays along that axis, and
+    the arrays whose extent is 1 there are read at index 0 (an axis of length
+    0 does not broadcast against length 1, and the outputs of earlier lines
+    give out their extents). Scalars are broadcast. The macro only sees
+    source lines, so names are arrays unless listed in the scalars
+    option, and the arrays' ndim and dtype are given as options, e.g.
+    ``#macro numpy_elementwise_macro ndim=2 scalars=alpha,beta``.
+    Division follows the function's cdivision directive. Consecutive lines
+    over the outputs of earlier lines share one loop (see fuse_loop_nests).
+    Other lines are left as they are.
+    """
+    scalar_names = [name for name in scalars.split(',') if name != '']
+    src_views = {}
+    extents = {}
+    expansions = [numpy_elementwise_assign(gensym, line, src_views, int(ndim), dtype,
+                                           scalar_names, extents)
+                  for line in lines]
+    return ['\n' + str(expansion) + '\n' for expansion in fuse_loop_nests(expansions)]
+
 
-    for_lines = '\n'.join(for_list)
+def numpy_elementwise_assign(gensym, line, src_views=None, ndim=1, dtype='np.float64_t',
+                             scalars=(), extents=None):
+    """
+    Args:
+        src_views (dict): the memoryviews already declared for (array, ndim)
+        extents (dict): the extents of the outputs of earlier lines
 
-    assign_index_line = assign_index_fmt.format(
-        indent=indent, arr1=arr1, LHS_index=LHS_index, arr2=arr2, RHS_index=RHS_index)
+    >>> from cyth.cyth_macros import *
+    >>> gensym = make_gensym_function()
+    >>> src_views = {}
+    >>> print(numpy_elementwise_assign(gensym, 'out = a * b - c / alpha', src_views, 2,
+    ...                                scalars=['alpha']))
+    cdef np.float64_t[:, :] src_a__gensym0 = a
+    cdef np.float64_t[:, :] src_b__gensym0 = b
+    cdef np.float64_t[:, :] src_c__gensym0 = c
+    cdef np.float64_t alpha__gensym0 = alpha
+    cdef Py_ssize_t dim0__gensym0 = max(src_a__gensym0.shape[0], src_b__gensym0.shape[0], src_c__gensym0.shape[0])
+    cdef Py_ssize_t dim1__gensym0 = max(src_a__gensym0.shape[1], src_b__gensym0.shape[1], src_c__gensym0.shape[1])
+    if ((src_a__gensym0.shape[0] != dim0__gensym0 and src_a__gensym0.shape[0] != 1) or
+            (src_a__gensym0.shape[1] != dim1__gensym0 and src_a__gensym0.shape[1] != 1) or
+            (src_b__gensym0.shape[0] != dim0__gensym0 and src_b__gensym0.shape[0] != 1) or
+            (src_b__gensym0.shape[1] != dim1__gensym0 and src_b__gensym0.shape[1] != 1) or
+            (src_c__gensym0.shape[0] != dim0__gensym0 and src_c__gensym0.shape[0] != 1) or
+            (src_c__gensym0.shape[1] != dim1__gensym0 and src_c__gensym0.shape[1] != 1)):
+        raise ValueError('operands could not be broadcast together')
+    cdef Py_ssize_t step0_a__gensym0 = 0 if src_a__gensym0.shape[0] == 1 else 1
+    cdef Py_ssize_t step1_a__gensym0 = 0 if src_a__gensym0.shape[1] == 1 else 1
+    cdef Py_ssize_t step0_b__gensym0 = 0 if src_b__gensym0.shape[0] == 1 else 1
+    cdef Py_ssize_t step1_b__gensym0 = 0 if src_b__gensym0.shape[1] == 1 else 1
+    cdef Py_ssize_t step0_c__gensym0 = 0 if src_c__gensym0.shape[0] == 1 else 1
+    cdef Py_ssize_t step1_c__gensym0 = 0 if src_c__gensym0.shape[1] == 1 else 1
+    cdef np.float64_t[:, ::1] out = np.empty((dim0__gensym0, dim1__gensym0), dtype=np.float64)
+    cdef Py_ssize_t ix0__gensym0, ix1__gensym0
+    for ix0__gensym0 in range(dim0__gensym0):
+        for ix1__gensym0 in range(dim1__gensym0):
+            out[ix0__gensym0, ix1__gensym0] = ((src_a__gensym0[ix0__gensym0 * step0_a__gensym0, ix1__gensym0 * step1_a__gensym0] * src_b__gensym0[ix0__gensym0 * step0_b__gensym0, ix1__gensym0 * step1_b__gensym0]) - (src_c__gensym0[ix0__gensym0 * step0_c__gensym0, ix1__gensym0 * step1_c__gensym0] / alpha__gensym0))
+
+    Outputs of earlier lines are used as they are, and their extents are
+    reused when they are known
+
+    >>> print(numpy_elementwise_assign(gensym, 'out2 = -out * 2', src_views, 2))  # doctest: +ELLIPSIS
+    cdef Py_ssize_t dim0__gensym1 = out.shape[0]
+    ...
+    cdef np.float64_t[:, ::1] out2 = np.empty((dim0__gensym1, dim1__gensym1), dtype=np.float64)
+    ...
+            out2[ix0__gensym1, ix1__gensym1] = ((-out[ix0__gensym1, ix1__gensym1]) * 2)
+    >>> print(numpy_elementwise_assign(gensym, 'out = out + 1', src_views, 2))  # doctest: +ELLIPSIS
+    cdef np.float64_t[:, :] src_out__gensym2 = out
+    ...
+    out = np.empty((dim0__gensym2, dim1__gensym2), dtype=np.float64)
+    ...
+            out[ix0__gensym2, ix1__gensym2] = (src_out__gensym2[ix0__gensym2, ix1__gensym2] + 1)
+    >>> extents = {'out2': ['dim0__gensym1', 'dim1__gensym1']}
+    >>> print(numpy_elementwise_assign(gensym, 'out3 = out2 + a', src_views, 2,
+    ...                                extents=extents))  # doctest: +ELLIPSIS
+    if ((src_a__gensym0.shape[0] != dim0__gensym1 and src_a__gensym0.shape[0] != 1) or
+            (src_a__gensym0.shape[1] != dim1__gensym1 and src_a__gensym0.shape[1] != 1)):
+        raise ValueError('operands could not be broadcast together')
+    ...
+            out3[ix0__gensym3, ix1__gensym3] = (out2[ix0__gensym3, ix1__gensym3] + src_a__gensym0[ix0__gensym3 * step0_a__gensym3, ix1__gensym3 * step1_a__gensym3])
+    """
+    parsed = parse_elementwise(line, scalars)
+    if parsed is None:
+        return line
+    output, expr, arrays = parsed
+    if src_views is None:
+        src_views = {}
+    if extents is None:
+        extents = {}
+
+    sym_fmt = gensym('{name}')
+    sym = lambda name: sym_fmt.format(name=name)
+    block = []
+    views = []
+    # an output of an earlier line is already declared
+    is_declared = src_views.get((output, ndim), None) == output
+    for arr in arrays:
+        view = src_views.get((arr, ndim), None)
+        if view is None or arr == output:
+            # the output is read through the view of its old value
+            view = sym('src_' + arr)
+            block += ['cdef %s %s = %s' % (memview_type(dtype, ndim), view, arr)]
+            if arr != output:
+                src_views[(arr, ndim)] = view
+        views.append(view)
+    scalar_vars = {}
+    for name in scalars:
+        if name in [getattr(node, 'id', None) for node in ast.walk(expr)]:
+            scalar_vars[name] = sym(name)
+            block += ['cdef %s %s = %s' % (dtype, scalar_vars[name], name)]
+    idxs = [sym('ix%d' % ix) for ix in range(ndim)]
+    # lines with the same extents can share a loop, see fuse_loop_nests
+    dims = next((extents[arr] for arr in arrays if arr in extents), None)
+    if dims is None:
+        dims = [sym('dim%d' % ix) for ix in range(ndim)]
+        for ix, dim in enumerate(dims):
+            shapes = ['%s.shape[%d]' % (view, ix) for view in views]
+            extent = shapes[0] if len(shapes) == 1 else 'max(%s)' % (', '.join(shapes),)
+            block += ['cdef Py_ssize_t %s = %s' % (dim, extent)]
+    if len(arrays) == 1 and arrays[0] not in extents:
+        # the extents are its own
+        broadcast = []
+    else:
+        broadcast = [(arr, view) for arr, view in zip(arrays, views)
+                     if extents.get(arr, None) != dims]
+    if len(broadcast) > 0:
+        mismatches = ['(%s.shape[%d] != %s and %s.shape[%d] != 1)' % (view, ix, dim, view, ix)
+                      for _, view in broadcast for ix, dim in enumerate(dims)]
+        condition = ' or\n        '.join(mismatches)
+        block += ['if (%s):' % (condition,) if len(mismatches) > 1 else 'if %s:' % (condition,),
+                  "    raise ValueError('operands could not be broadcast together')"]
+    # stride-0 indexing of the axes of length 1
+    steps = {}
+    for arr, view in broadcast:
+        steps[arr] = [sym('step%d_%s' % (ix, arr)) for ix in range(ndim)]
+        block += ['cdef Py_ssize_t %s = 0 if %s.shape[%d] == 1 else 1' % (step, view, ix)
+                  for ix, step in enumerate(steps[arr])]
+    alloc = '%s = np.empty(%s, dtype=%s)' % (output, shape_tuple(dims), get_numpy_dtype(dtype))
+    if is_declared:
+        block += [alloc]
+    else:
+        block += ['cdef %s %s' % (memview_type(dtype, ndim, contiguous=True), alloc)]
+    # later lines read the output itself
+    src_views[(output, ndim)] = output
+    extents[output] = dims
+    index = ', '.join(idxs)
+    view_dict = dict(zip(arrays, views))
+
+    def operand_source(name):
+        if name in scalar_vars:
+            return scalar_vars[name]
+        if name in steps:
+            return '%s[%s]' % (view_dict[name], ', '.join(
+                '%s * %s' % (idx, step) for idx, step in zip(idxs, steps[name])))
+        return '%s[%s]' % (view_dict[name], index)
+    body = ['%s[%s] = %s' % (output, index, get_elementwise_source(expr, operand_source))]
+    return LoopNest(block, dims, idxs, body, outputs=[output], rebinds=[output])
+
+
+# name: (accumulator type, output dtype); None means the input's (see
+# get_sum_type for sums). Outputs use the np typedefs so they conform to user
+# declared memoryviews
+REDUCTIONS = {
+    'sum': (None, None),
+    'mean': ('double', 'np.float64_t'),
+    'min': (None, None),
+    'max': (None, None),
+    'argmin': ('Py_ssize_t', 'np.intp_t'),
+    'argmax': ('Py_ssize_t', 'np.intp_t'),
+    'nanmin': (None, None),
+    'nanmax': (None, None),
+    'nanargmin': ('Py_ssize_t', 'np.intp_t'),
+    'nanargmax': ('Py_ssize_t', 'np.intp_t'),
+}
+
+
+def get_sum_type(dtype):
+    """
+    numpy sums integers in 64 bits, so they do not overflow as easily
+
+    >>> from cyth.cyth_macros import *
+    >>> get_sum_type('np.int32_t'), get_sum_type('np.uint8_t'), get_sum_type('np.float32_t')
+    ('np.int64_t', 'np.uint64_t', 'np.float32_t')
+    """
+    if cyth_infer.type_kind(dtype) != 'int':
+        return dtype
+    if dtype.startswith(('np.uint', 'unsigned', 'size_t')):
+        return 'np.uint64_t'
+    return 'np.int64_t'
+
+
+def parse_reduction(line):
+    """
+    Returns (output, reduction, array, axis) if line assigns a reduction of an
+    array to a name, otherwise None
 
-    output_lines = [defdim_assign, alloc_output_line, for_lines, assign_index_line]
-    output_block = '\n' + '\n'.join(output_lines) + '\n\n'
-    print(output_block)
-    return output_block
+    >>> from cyth.cyth_macros import *
+    >>> parse_reduction('out = dists.min(axis=1)')
+    ('out', 'min', 'dists', 1)
+    >>> parse_reduction('out = np.argmax(dists, -1)')
+    ('out', 'argmax', 'dists', -1)
+    >>> parse_reduction('total = dists.sum()')
+    ('total', 'sum', 'dists', None)
+    >>> parse_reduction('out = np.nanargmin(dists, axis=0)')
+    ('out', 'nanargmin', 'dists', 0)
+    >>> print(parse_reduction('out = dists.min(axis=1) + 1'))
+    None
+    """
+    try:
+        stmt = ast.parse(line.strip()).body[0]
+    except SyntaxError:
+        return None
+    if not (isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 and
+            isinstance(stmt.targets[0], ast.Name) and isinstance(stmt.value, ast.Call)):
+        return None
+    call = stmt.value
+    if not (isinstance(call.func, ast.Attribute) and call.func.attr in REDUCTIONS and
+            isinstance(call.func.value, ast.Name)):
+        return None
+    args = list(call.args)
+    if call.func.value.id in ('np', 'numpy'):
+        if len(args) == 0:
+            return None
+        arr = args.pop(0)
+    elif call.func.attr.startswith('nan'):
+        # ndarrays have no nan* methods
+        return None
+    else:
+        arr = call.func.value
+    if not isinstance(arr, ast.Name):
+        return None
+    axis_nodes = args[:1] + [kw.value for kw in call.keywords if kw.arg == 'axis']
+    if len(args) > 1 or len(axis_nodes) > 1 or len(call.keywords) > len(axis_nodes) - len(args[:1]):
+        # out=, keepdims=, dtype=, ... are left to numpy
+        return None
+    axis = None
+    if len(axis_nodes) == 1:
+        try:
+            axis = ast.literal_eval(axis_nodes[0])
+        except ValueError:
+            return None
+        if not (axis is None or isinstance(axis, int)):
+            return None
+    return stmt.targets[0].id, call.func.attr, arr.id, axis
+
+
+@macro
+def numpy_reduce_macro(gensym, lines, ndim='2', dtype='np.float64_t'):
+    """
+    Expands reductions (sum, mean, min, max, argmin, argmax and np.nanmin,
+    np.nanmax, np.nanargmin, np.nanargmax) over one axis, or over the whole
+    array, into typed loops. The arrays are read through typed
+    memoryviews and the running value of each output element is kept in a C
+    variable. Other lines are left as they are.
+
+    The macro only sees source lines, so the inputs' ndim and dtype are given
+    as options, e.g. ``#macro numpy_reduce_macro ndim=2 dtype=np.float32_t``.
+    Integer sums accumulate in (and give) 64 bit integers like numpy's. Other
+    accumulators have the input's dtype, except that mean accumulates in
+    double and gives NaN over empty axes. NaNs are handled as numpy does: min
+    and max give NaN and argmin and argmax the index of the first NaN, while
+    the nan* reductions skip NaNs (nanargmin and nanargmax raise ValueError
+    where every element is NaN).
+    """
+    return ['\n' + numpy_reduce_assign(gensym, line, int(ndim), dtype) + '\n'
+            for line in lines]
+
+
+def numpy_reduce_assign(gensym, line, ndim, dtype):
+    """
+    >>> from cyth.cyth_macros import *
+    >>> gensym = make_gensym_function()
+    >>> print(numpy_reduce_assign(gensym, 'out = dists.argmin(axis=1)', 2, 'np.float64_t'))
+    cdef np.float64_t[:, :] arr__gensym0 = dists
+    cdef Py_ssize_t dim0__gensym0 = arr__gensym0.shape[0]
+    cdef Py_ssize_t dim1__gensym0 = arr__gensym0.shape[1]
+    cdef Py_ssize_t ix0__gensym0, ix1__gensym0
+    cdef Py_ssize_t acc__gensym0
+    cdef np.float64_t best__gensym0
+    cdef np.float64_t value__gensym0
+    if dim1__gensym0 == 0:
+        raise ValueError('attempt to get argmin of an empty sequence')
+    out = np.empty((dim0__gensym0,), dtype=np.intp)
+    cdef np.intp_t[:] out__gensym0 = out
+    for ix0__gensym0 in range(dim0__gensym0):
+        acc__gensym0 = 0
+        best__gensym0 = arr__gensym0[ix0__gensym0, 0]
+        for ix1__gensym0 in range(dim1__gensym0):
+            value__gensym0 = arr__gensym0[ix0__gensym0, ix1__gensym0]
+            if best__gensym0 == best__gensym0 and (value__gensym0 < best__gensym0 or value__gensym0 != value__gensym0):
+                best__gensym0 = value__gensym0
+                acc__gensym0 = ix1__gensym0
+        out__gensym0[ix0__gensym0] = acc__gensym0
+    >>> print(numpy_reduce_assign(gensym, 'out = np.nanargmax(dists, 0)', 2, 'np.float64_t'))  # doctest: +ELLIPSIS
+    cdef np.float64_t[:, :] arr__gensym1 = dists
+    ...
+        for ix0__gensym1 in range(dim0__gensym1):
+            value__gensym1 = arr__gensym1[ix0__gensym1, ix1__gensym1]
+            if value__gensym1 > best__gensym1 or (best__gensym1 != best__gensym1 and value__gensym1 == value__gensym1):
+                best__gensym1 = value__gensym1
+                acc__gensym1 = ix0__gensym1
+        if best__gensym1 != best__gensym1:
+            raise ValueError('All-NaN slice encountered')
+        out__gensym1[ix1__gensym1] = acc__gensym1
+    >>> print(numpy_reduce_assign(gensym, 'total = np.sum(dists)', 2, 'np.float64_t'))  # doctest: +ELLIPSIS
+    cdef np.float64_t[:, :] arr__gensym2 = dists
+    ...
+    acc__gensym2 = 0
+    for ix0__gensym2 in range(dim0__gensym2):
+        for ix1__gensym2 in range(dim1__gensym2):
+            acc__gensym2 += arr__gensym2[ix0__gensym2, ix1__gensym2]
+    total = acc__gensym2
+    >>> print(numpy_reduce_assign(gensym, 'means = np.mean(counts, 0)', 2, 'np.int32_t'))  # doctest: +ELLIPSIS
+    cdef np.int32_t[:, :] arr__gensym3 = counts
+    ...
+    cdef double acc__gensym3
+    cdef Py_ssize_t count__gensym3 = dim0__gensym3
+    cdef double nan__gensym3 = np.nan
+    ...
+        out__gensym3[ix1__gensym3] = acc__gensym3 / count__gensym3 if count__gensym3 > 0 else nan__gensym3
+    """
+    parsed = parse_reduction(line)
+    if parsed is None:
+        return line
+    output, reduction, arr, axis = parsed
+    if axis is not None:
+        if not -ndim <= axis < ndim:
+            raise ValueError('axis %d is out of bounds for %r (ndim=%d)' % (axis, arr, ndim))
+        axis = axis % ndim
+    reduced_axes = list(range(ndim)) if axis is None else [axis]
+    kept_axes = [ix for ix in range(ndim) if ix not in reduced_axes]
+    acc_type, out_type = REDUCTIONS[reduction]
+    if reduction == 'sum':
+        acc_type = out_type = get_sum_type(dtype)
+    acc_type = dtype if acc_type is None else acc_type
+    out_type = dtype if out_type is None else out_type
+    is_float = cyth_infer.type_kind(dtype) == 'float'
+    skip_nans = reduction.startswith('nan')
+    reduction = reduction[3:] if skip_nans else reduction
+
+    sym_fmt = gensym('{name}')
+    sym = lambda name: sym_fmt.format(name=name)
+    view, acc, best, out_view = sym('arr'), sym('acc'), sym('best'), sym('out')
+    value, count, nan = sym('value'), sym('count'), sym('nan')
+    dims = [sym('dim%d' % ix) for ix in range(ndim)]
+    idxs = [sym('ix%d' % ix) for ix in range(ndim)]
+
+    def index_expr(reduced_value):
+        return '%s[%s]' % (view, ', '.join(
+            idxs[ix] if ix in kept_axes else reduced_value(ix) for ix in range(ndim)))
+    element = index_expr(lambda ix: idxs[ix])
+    first_element = index_expr(lambda ix: '0')
+    is_arg = reduction in ('argmin', 'argmax')
+
+    block = ['cdef %s %s = %s' % (memview_type(dtype, ndim), view, arr)]
+    block += ['cdef Py_ssize_t %s = %s.shape[%d]' % (dim, view, ix) for ix, dim in enumerate(dims)]
+    block += ['cdef Py_ssize_t ' + ', '.join(idxs)]
+    block += ['cdef %s %s' % (acc_type, acc)]
+    if is_arg:
+        block += ['cdef %s %s' % (dtype, best)]
+    if is_float and reduction not in ('sum', 'mean'):
+        block += ['cdef %s %s' % (dtype, value)]
+    if reduction == 'mean':
+        block += ['cdef Py_ssize_t %s = %s' % (count, ' * '.join(dims[ix] for ix in reduced_axes)),
+                  'cdef double %s = np.nan' % (nan,)]
+    if reduction not in ('sum', 'mean'):
+        empty_msg = ('attempt to get %s of an empty sequence' % (reduction,) if is_arg else
+                     'zero-size array to reduction operation %s which has no identity' % (reduction,))
+        block += ['if %s:' % ' or '.join('%s == 0' % dims[ix] for ix in reduced_axes),
+                  "    raise ValueError('%s')" % (empty_msg,)]
+    if len(kept_axes) > 0:
+        out_shape = shape_tuple([dims[ix] for ix in kept_axes])
+        block += ['%s = np.empty(%s, dtype=%s)' % (output, out_shape, get_numpy_dtype(out_type))]
+        block += ['cdef %s %s = %s' % (memview_type(out_type, len(kept_axes)), out_view, output)]
+
+    indent = ''
+    for ix in kept_axes:
+        block += ['%sfor %s in range(%s):' % (indent, idxs[ix], dims[ix])]
+        indent += '    '
+    if reduction in ('sum', 'mean'):
+        block += [indent + acc + ' = 0']
+    elif is_arg:
+        block += [indent + acc + ' = 0', indent + best + ' = ' + first_element]
+    else:
+        block += [indent + acc + ' = ' + first_element]
+    inner_indent = indent
+    for ix in reduced_axes:
+        block += ['%sfor %s in range(%s):' % (inner_indent, idxs[ix], dims[ix])]
+        inner_indent += '    '
+    if reduction in ('sum', 'mean'):
+        block += [inner_indent + acc + ' += ' + element]
+    else:
+        compare = '<' if reduction in ('min', 'argmin') else '>'
+        target = best if is_arg else acc
+        if is_float and skip_nans:
+            # the running value only stays NaN while every element was NaN
+            block += ['%s%s = %s' % (inner_indent, value, element),
+                      '%sif %s %s %s or (%s != %s and %s == %s):' % (
+                          inner_indent, value, compare, target, target, target, value, value),
+                      '%s    %s = %s' % (inner_indent, target, value)]
+        elif is_float:
+            # like numpy, the first NaN is the result
+            block += ['%s%s = %s' % (inner_indent, value, element),
+                      '%sif %s == %s and (%s %s %s or %s != %s):' % (
+                          inner_indent, target, target, value, compare, target, value, value),
+                      '%s    %s = %s' % (inner_indent, target, value)]
+        else:
+            block += ['%sif %s %s %s:' % (inner_indent, element, compare, target),
+                      '%s    %s = %s' % (inner_indent, target, element)]
+        if is_arg:
+            # numpy gives flat indices when reducing the whole array
+            flat_index = idxs[reduced_axes[0]]
+            for ix in reduced_axes[1:]:
+                flat_index = '%s * %s + %s' % (flat_index, dims[ix], idxs[ix])
+            block += ['%s    %s = %s' % (inner_indent, acc, flat_index)]
+            if is_float and skip_nans:
+                block += ['%sif %s != %s:' % (indent, best, best),
+                          "%s    raise ValueError('All-NaN slice encountered')" % (indent,)]
+    result = acc
+    if reduction == 'mean':
+        # numpy gives NaN (and a warning) for the mean of nothing
+        result = '%s / %s if %s > 0 else %s' % (acc, count, count, nan)
+    if len(kept_axes) > 0:
+        block += ['%s%s[%s] = %s' % (indent, out_view, ', '.join(idxs[ix] for ix in kept_axes), result)]
+    else:
+        block += ['%s = %s' % (output, result)]
+    return '\n'.join(block)
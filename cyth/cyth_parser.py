@@ -3,7 +3,7 @@
 """
 from __future__ import absolute_import, division, print_function
 import six
-from six.moves import zip, map, filter
+from six.moves import zip, map
 from itertools import chain
 import utool
 import sys
@@ -16,16 +16,102 @@ import cyth  # NOQA
 from copy import deepcopy
 from cyth.cyth_decorators import MACRO_EXPANDERS_DICT
 from cyth import cyth_benchmarks
+from cyth import cyth_analysis
+from cyth import cyth_profile
+from cyth import cyth_infer
+from cyth.cyth_analysis import is_docstring, assignment_targets
 import cyth.cyth_macros
 BASE_CLASS = astor.codegen.SourceGenerator
 
+# http://docs.cython.org/src/reference/compilation.html#compiler-directives
+# [(name, defaultval), ...]
+CYTHON_COMPILER_DIRECTIVES = [
+    ('boundscheck', True),
+    ('wraparound', True),
+    ('initializedcheck', True),
+    ('nonecheck', False),
+    ('overflowcheck', False),
+    ('overflowcheck.fold', True),  # may help or hurt depending on compiler, arch, and opt settings
+    ('embedsignature', False),
+    ('cdivision', False),
+    ('cdivision_warnings', False),
+    ('always_allow_keywords', None),
+    ('profile', False),
+    ('linetrace', False),
+    ('infer_types', None),
+    ('language_level', 2),
+    ('c_string_type', bytes),
+    ('c_string_encoding', 'ascii'),
+    ('type_version_tag', True),
+    ('unraisable_tracebacks', None),
+]
+# Directives that can only be given in the '# cython:' header of a module
+MODULE_ONLY_DIRECTIVES = ['language_level', 'c_string_type', 'c_string_encoding',
+                          'type_version_tag']
+# Emitted on every cythonized function unless overridden by #CYTH_DIRECTIVES
+DEFAULT_FUNCTION_DIRECTIVES = {'boundscheck': False, 'wraparound': False}
+
+# Options of #CYTH_PARALLEL, passed on to cython.parallel.prange
+PARALLEL_OPTIONS = ['num_threads', 'schedule', 'chunksize']
+PARALLEL_SCHEDULES = ['static', 'dynamic', 'guided', 'runtime']
+# Declared types that are still python objects (no use without the GIL)
+PYTHON_OBJECT_TYPES = ['object', 'tuple', 'list', 'dict', 'set', 'str', 'bytes',
+                       'unicode', 'np.ndarray']
+# C types that PEP 484/526 annotations can spell (optionally as a memoryview)
+ANNOTATION_CTYPE_REGEX = re.compile(
+    r'^((unsigned |signed |long )*(bint|char|short|int|long|float|double|size_t|Py_ssize_t)|'
+    r'([A-Za-z_][A-Za-z0-9_]*\.)?[A-Za-z_][A-Za-z0-9_]*_t)(\[[0-9:, ]+\])?$|^np\.ndarray\[.*\]$')
+# Words allowed in the body of a parallel loop that are not variables
+NOGIL_KEYWORDS = ['and', 'or', 'not', 'if', 'elif', 'else', 'in', 'for',
+                  'range', 'pass', 'break', 'continue']
+# Header of the pyx of modules with parallel loops
+OPENMP_HEADER_LINES = [
+    '# distutils: extra_compile_args = -fopenmp',
+    '# distutils: extra_link_args = -fopenmp',
+]
+# np.ndarray[dtype, ndim=N, mode="c"] buffer declarations
+NDARRAY_REGEX = re.compile(r'^np\.ndarray\[(.*)\]$')
+# a single line cdef of a buffer in cyth code
+NDARRAY_CDEF_REGEX = re.compile(r'^(\s*cdef\s+)(np\.ndarray\[[^\]]*\])(\s+)([A-Za-z_][A-Za-z0-9_]*)(.*)$')
+# a single line cdef of a memoryview in cyth code (e.g. from macros)
+MEMVIEW_CDEF_REGEX = re.compile(r'^\s*cdef\s+[A-Za-z_][A-Za-z0-9_.]*\[[^\]]*:[^\]]*\]\s+([A-Za-z_][A-Za-z0-9_]*)')
+# the name declared by a single line cdef in cyth code
+CDEF_NAME_REGEX = re.compile(r'^\s*cdef\s+[A-Za-z_][A-Za-z0-9_.]*(?:\[[^\]]*\])?\s+([A-Za-z_][A-Za-z0-9_]*)\s*(?:=|$)')
+# 'return x' or 'return x, y' in cyth code
+RETURN_NAMES_REGEX = re.compile(r'^(\s*return\s+)\(?([A-Za-z_][A-Za-z0-9_, ]*?)\)?\s*$')
+# dtypes accepted by #CYTH_DTYPES (each has a np.<name>_t ctypedef)
+FUSED_DTYPES = ['int8', 'int16', 'int32', 'int64', 'uint8', 'uint16', 'uint32',
+                'uint64', 'float32', 'float64', 'complex64', 'complex128']
+FOR_RANGE_REGEX = re.compile(r'^(\s*)for\s+([A-Za-z_][A-Za-z0-9_]*)\s+in\s+range\((.*)\)\s*:\s*$')
+LOOP_NAME_REGEX = re.compile(r'(?<![A-Za-z0-9_.])[A-Za-z_][A-Za-z0-9_]*')
+# Module level cyth code that is declared in the pxd instead of the pyx
+PXD_DECLARATION_REGEX = re.compile(r'^\s*(ctypedef\s|cdef\s+(packed\s+)?(struct|union|enum|extern)\b)')
+CIMPORT_LINE_REGEX = re.compile(r'^\s*(cimport\s|from\s+\S+\s+cimport\s)')
+# Global of the pyx listing the functions emitted as cdef
+DEMOTED_FUNCS_NAME = 'CYTH_DEMOTED_FUNCS'
+# Demoted functions with at most this many lines of code are made inline
+AUTO_INLINE_MAX_LINES = utool.get_argval('--inline-max-lines', type_=int, default=8)
+
 
 class CythVisitor(BASE_CLASS):
     indent_level = 0
     emit = sys.stdout.write
 
     def __init__(self, indent_with=' ' * 4, add_line_information=False,
-                 py_modname=None):
+                 py_modname=None, py_text=None, function_cache=None,
+                 memview=False, demote=False, recorded_types=None):
+        """
+        Args:
+            py_modname (str): name of the module being translated
+            py_text (str): source of the module. Required for function_cache.
+            function_cache (dict): per-function results of a previous run, as
+                returned by get_function_cache (see cyth_cache)
+            memview (bool): declare np.ndarray buffers as typed memoryviews
+            demote (bool): emit cyth functions that only other cyth functions
+                call as cdef (see ModuleAnalyzer.get_internal_funcs)
+            recorded_types (dict): argument types of functions (or
+                Class.method) recorded at runtime (see cyth_record)
+        """
         super(CythVisitor, self).__init__(indent_with, add_line_information)
         self.benchmark_names = []
         self.benchmark_codes = []
@@ -41,10 +127,26 @@ class CythVisitor(BASE_CLASS):
         self.import_from_blacklist = ['range', 'map', 'zip']
         self.cythonized_funcs = {}
         self.plain_funcs = {}
-        self.fpig = FirstpassInformationGatherer()
-        self.spig = SecondpassInformationGatherer(self.fpig)
+        self.py_text = py_text
+        self.memview = memview
+        self.demote = demote
+        self.recorded_types = {} if recorded_types is None else recorded_types
+        self.demoted_funcs = set([])  # emitted as cdef, invisible to python
+        self.cyth_classes = set([])  # emitted as cdef classes
+        self.cythonized_classes = {}
+        self.current_class = None  # state of the cdef class being emitted
+        if function_cache is None:
+            function_cache = {'analysis': {}, 'emission': {}}
+        self.function_cache = function_cache
+        self.source_hashes = {}
+        self.used_emissions = {}
+        self.current_effects = None
+        self.analysis = None
         self.modules_to_cimport = []
         self.interface_lines = []  # generated for the pxd header
+        self.declaration_lines = []  # module level ctypedefs etc. for the pxd
+        self.module_directives = {}  # from #CYTH_DIRECTIVES in module docstrings
+        self.uses_parallel = False  # a #CYTH_PARALLEL loop was emitted
         self.gensym = cyth.cyth_macros.make_gensym_function()
 
     def get_result(self):
@@ -52,14 +154,32 @@ class CythVisitor(BASE_CLASS):
         returns cythonized pyx text resulting from parsing the py file with cyth
         markups
         """
+        header_lines = []
+        if len(self.module_directives) > 0:
+            header_lines.append(get_directive_header(self.module_directives))
+        import_lines = list(self.import_lines)
+        if self.uses_parallel:
+            header_lines.extend(OPENMP_HEADER_LINES)
+            import_lines.insert(2, 'from cython.parallel cimport prange')
         cyth_text = (
-            '\n'.join(self.import_lines) +
+            '\n'.join(header_lines + import_lines) +
             '\n' +
             ''.join(self.result)
         )
-        pxd_text = ('cimport numpy as np\n' + '\n\n'.join(self.interface_lines))
+        if len(self.demoted_funcs) > 0:
+            # tells the importer which functions keep their python version
+            cyth_text += '\n\n%s = %r\n' % (DEMOTED_FUNCS_NAME, sorted(self.demoted_funcs))
+        pxd_text = ('cimport numpy as np\n' +
+                    ''.join(line + '\n' for line in self.declaration_lines) +
+                    ('\n' if len(self.declaration_lines) > 0 else '') +
+                    '\n\n'.join(self.interface_lines))
         return cyth_text, pxd_text
 
+    def get_function_cache(self):
+        """ the per-function results of this run, to pass to the next one """
+        return {'analysis': self.analysis.used_facts,
+                'emission': self.used_emissions}
+
     def process_args(self, args, vararg, kwarg, defaults=None):
         processed_argslist = map(self.visit, args)
         if vararg:
@@ -87,17 +207,20 @@ class CythVisitor(BASE_CLASS):
         def loop_args(args, defaults):
             padding = [None] * (len(args) - len(defaults))
             for arg, default in zip(args, padding + defaults):
-                if arg.id in typedict:
-                    arg_ = typedict[arg.id] + ' ' + arg.id
-                    nonsig_typedict.pop(arg.id)
+                name = get_arg_name(arg)
+                if name in typedict:
+                    arg_ = typedict[name] + ' ' + name
+                    nonsig_typedict.pop(name)
                 else:
-                    arg_ = arg
+                    arg_ = name
                 self.write(write_comma, arg_)
                 self.conditional_write('=', default)
 
         loop_args(node.args, node.defaults)
-        self.conditional_write(write_comma, '*', node.vararg)
-        self.conditional_write(write_comma, '**', node.kwarg)
+        if node.vararg is not None:
+            self.write(write_comma, '*', get_arg_name(node.vararg))
+        if node.kwarg is not None:
+            self.write(write_comma, '**', get_arg_name(node.kwarg))
 
         kwonlyargs = getattr(node, 'kwonlyargs', None)
         if kwonlyargs:
@@ -150,7 +273,8 @@ class CythVisitor(BASE_CLASS):
 
     def typedict_to_cythdef(self, typedict):
         res = ['cdef:']
-        for (id_, type_) in six.iteritems(typedict):
+        # sorted so the generated text is deterministic
+        for (id_, type_) in sorted(six.iteritems(typedict)):
             #print("%s, %s" % (repr(id_), repr(type_)))
             res.append(self.indent_with + type_ + ' ' + id_)
         if len(typedict) == 0:
@@ -216,7 +340,8 @@ class CythVisitor(BASE_CLASS):
 
     def parse_cyth_preproc_markup(self, docstr, cyth_mode, collect_macro_input,
                                   macro_input_buffer_ptr,
-                                  suspended_macro_context_ptr, inline_flag_ptr):
+                                  suspended_macro_context_ptr, inline_flag_ptr,
+                                  directives=None, dtypes=None, attrs=None):
         source_lines = []
         param_typedict = {}
         bodyvars_typedict = {}
@@ -247,11 +372,25 @@ class CythVisitor(BASE_CLASS):
         def handle_inline(matcher):
             inline_flag_ptr[0] = True
 
+        def handle_dtypes(matcher):
+            if dtypes is not None:
+                dtypes.extend(parse_dtypes(matcher.group(1)))
+
+        def handle_parallel(matcher):
+            if cyth_mode_ptr[0]:
+                # marks the loop on the next line; see expand_parallel_loops
+                source_lines.append(ParallelLoopMarker(parse_parallel_options(matcher.group(1))))
+
+        def handle_directives(matcher):
+            if directives is not None:
+                directives.update(parse_directives(matcher.group(1)))
+
         def handle_macro(matcher):
             """ this should eventually be changed to reuse
                 the machinery for multiline """
             macro_name = matcher.group(1)
-            suspended_macro_context_ptr[0] = (macro_name,)
+            macro_kwargs = parse_macro_options(matcher.group(2))
+            suspended_macro_context_ptr[0] = (macro_name, macro_kwargs)
             collect_macro_input_ptr[0] = True
             assert len(macro_input_buffer_ptr[0]) == 0, macro_input_buffer_ptr[0]
 
@@ -260,12 +399,13 @@ class CythVisitor(BASE_CLASS):
                 most straightforward way to implement them until the
                 parse_cyth_preproc_markup/visit_FunctionDef 'coroutine'
                 blob is refactored """
-            (macro_name,) = suspended_macro_context_ptr[0]
+            (macro_name, macro_kwargs) = suspended_macro_context_ptr[0]
             lines = macro_input_buffer_ptr[0]
             #print('macro invokation of "%s" on lines %r' % (macro_name, lines))
             expander = MACRO_EXPANDERS_DICT.get(macro_name, None)
             if expander:
-                expanded_lines = ['\n'] + expander(self.gensym, lines) + ['\n']
+                with cyth_profile.phase('macro'):
+                    expanded_lines = ['\n'] + list(expander(self.gensym, lines, **macro_kwargs)) + ['\n']
             else:
                 errmsg = 'No macro named %r has been registered via the cyth.macro decorator'
                 raise NotImplementedError(errmsg % macro_name)
@@ -283,7 +423,10 @@ class CythVisitor(BASE_CLASS):
             ('endif', handle_endif),
             ('CYTH_RETURNS (.*)', handle_returns_decl),
             ('CYTH_INLINE', handle_inline),
-            ('macro ([^ ]*).*', handle_macro),
+            ('CYTH_DIRECTIVES (.*)', handle_directives),
+            ('CYTH_PARALLEL(.*)', handle_parallel),
+            ('CYTH_DTYPES (.*)', handle_dtypes),
+            ('macro ([^ ]*)(.*)', handle_macro),
             ('endmacro', handle_endmacro),  # HACK
         ]]
 
@@ -305,12 +448,18 @@ class CythVisitor(BASE_CLASS):
                 #print('%r -> %r' % (line, tmp_typedict))
                 bodyvars_typedict.update(tmp_typedict)
 
+        def handle_attrs(matcher, lines):
+            if attrs is not None:
+                for line in lines:
+                    attrs.extend(sorted(six.iteritems(parse_cdef_line(line))))
+
         multiline_directives = [((a + ":"), b) for (a, b) in [
             ('#CYTH_PARAM_TYPES', handle_param_types),
+            ('#CYTH_ATTRS', handle_attrs),
             ('cdef', handle_cdef),
         ]]
 
-        regex_compile_car = lambda (a, b): (re.compile(a), b)
+        regex_compile_car = lambda pair: (re.compile(pair[0]), pair[1])
         #print(list(oneline_directives))
         compiled_oneline_directives = list(map(regex_compile_car, oneline_directives))
         compiled_multiline_directives = list(map(regex_compile_car, multiline_directives))
@@ -360,11 +509,17 @@ class CythVisitor(BASE_CLASS):
         return source_lines, cyth_mode_ptr[0], collect_macro_input_ptr[0], param_typedict, bodyvars_typedict, return_type_ptr[0]
 
     def visit_Module(self, node):
-        # cr = CallRecorder()
-        # cr.visit(node)
-        # self.all_funcalls = cr.calls
-        self.fpig.visit(node)
-        self.spig.visit(node)
+        self.module_directives = get_module_directives(node)
+        if self.py_text is not None:
+            self.source_hashes = cyth_analysis.get_toplevel_source_hashes(node, self.py_text)
+        # All analysis happens up front in one walk; the loop below only emits
+        with cyth_profile.phase('analysis'):
+            self.analysis = cyth_analysis.ModuleAnalyzer(
+                self.source_hashes, self.function_cache['analysis'])
+            self.analysis.visit(node)
+        if self.demote:
+            self.demoted_funcs = get_demotable_funcs(node, self.analysis)
+        self.cyth_classes = get_cyth_classes(node)
 
         def get_alias_name(al):
             alias_name = al.name if al.asname is None else al.asname
@@ -383,12 +538,17 @@ class CythVisitor(BASE_CLASS):
                 #        self.write(cyth_def)
                 hacky_blob_of_retvals = self.parse_cyth_preproc_markup(docstr, False, False, [[]], [None], [False])
                 lines = hacky_blob_of_retvals[0]
+                declaration_lines, lines = split_pxd_declarations(lines)
+                self.declaration_lines.extend(declaration_lines)
                 self.newline(extra=1)
                 for line in lines:
                     self.write(line)
             # try to parse functions for cyth tags
             elif isinstance(subnode, ast.FunctionDef):
-                self.visit(subnode)
+                self.visit_toplevel_function(subnode)
+            elif isinstance(subnode, ast.ClassDef):
+                if subnode.name in self.cyth_classes:
+                    self.visit_toplevel_class(subnode)
             # register imports
             elif isinstance(subnode, ast.Import):
                 for alias in subnode.names:
@@ -402,8 +562,13 @@ class CythVisitor(BASE_CLASS):
             # register a global
             elif isinstance(subnode, (ast.Assign, ast.AugAssign)):
                 targets = assignment_targets(subnode)
-                if any((self.spig.globals_used.get(target, False) for target in targets)):
+                if any((self.analysis.globals_used.get(target, False) for target in targets)):
                     self.visit(subnode)
+                    # e.g. TAU = 2 * np.pi needs np imported in the pyx too
+                    for name_node in ast.walk(subnode.value):
+                        if isinstance(name_node, ast.Name):
+                            self.mark_module_used(name_node.id)
+                            self.mark_function_used(name_node.id)
             else:
                 #print('Skipping a global %r' % subnode.__class__)
                 pass
@@ -411,6 +576,237 @@ class CythVisitor(BASE_CLASS):
         self.import_lines.extend(imports)
         #return BASE_CLASS.visit_Module(self, node)
 
+    def visit_toplevel_class(self, node):
+        """
+        Emits a class whose docstring has cyth markup as a cdef class. The
+        attributes declared by #CYTH_ATTRS become public C fields (declared in
+        the pxd), methods with cyth markup become cpdef methods and the other
+        methods are copied as they are.
+        """
+        attrs = []
+        self.parse_cyth_preproc_markup(get_class_markup(node), False, False, [[]], [None],
+                                       [False], attrs=attrs)
+        cyth_classname = cyth_helpers.get_cyth_name(node.name)
+        base_names = [base.id for base in node.bases if base.id != 'object']
+        base_string = ''.join('(%s)' % cyth_helpers.get_cyth_name(name) for name in base_names)
+        self.cythonized_classes[node.name] = node
+        self.newline(extra=1)
+        self.statement(node, 'cdef class %s%s:' % (cyth_classname, base_string))
+        self.current_class = {'name': node.name, 'cyth_name': cyth_classname,
+                              'interface_lines': []}
+        self.indentation += 1
+        num_results = len(self.result)
+        for stmt in node.body[1:]:
+            if isinstance(stmt, ast.FunctionDef):
+                self.gensym = cyth.cyth_macros.make_gensym_function()
+                if len(stmt.decorator_list) > 0:
+                    # static/class methods and properties stay python
+                    BASE_CLASS.visit_FunctionDef(self, stmt)
+                else:
+                    self.visit(stmt)
+            elif not is_docstring(stmt):
+                self.visit(stmt)
+        if len(self.result) == num_results:
+            self.statement(node, 'pass')
+        self.indentation -= 1
+        pxd_lines = ['cdef class %s%s:' % (cyth_classname, base_string)]
+        pxd_lines += [self.indent_with + 'cdef public %s %s' % (get_attr_type(type_), name)
+                      for name, type_ in attrs]
+        pxd_lines += [self.indent_with + line for line in self.current_class['interface_lines']]
+        if len(pxd_lines) == 1:
+            pxd_lines.append(self.indent_with + 'pass')
+        self.interface_lines.append('\n'.join(pxd_lines))
+        self.current_class = None
+
+    def visit_toplevel_function(self, node):
+        """
+        Emits a top-level function, or replays its emission from the function
+        cache if its source (and the pending newlines before it) are unchanged.
+        """
+        # gensyms are locals, so a fresh counter per function keeps its output
+        # independent of the functions before it
+        self.gensym = cyth.cyth_macros.make_gensym_function()
+        source_hash = self.source_hashes.get(node, None)
+        if source_hash is None:
+            self.visit(node)
+            return
+        # module directives end up in the decorators of every function, and
+        # calls to demoted functions, cyth classes and imported modules are
+        # rewritten
+        import_names = sorted(self.imported_modules) + sorted(self.imported_functions)
+        emission_key = '%s:%d:%d:%r:%r:%r' % (source_hash, self.new_lines, len(self.result) > 0,
+                                              sorted(self.module_directives.items()),
+                                              sorted(self.demoted_funcs | self.cyth_classes),
+                                              import_names)
+        emission = self.function_cache['emission'].get(emission_key, None)
+        if emission is None:
+            emission = self.record_function_emission(node)
+        else:
+            self.replay_function_emission(node, emission)
+        self.used_emissions[emission_key] = emission
+
+    def record_function_emission(self, node):
+        """ visits node and returns everything the visit changed """
+        num_results = len(self.result)
+        num_interface = len(self.interface_lines)
+        num_benchmarks = len(self.benchmark_names)
+        self.current_effects = {'modules': set([]), 'functions': set([]), 'cimports': [],
+                                'parallel': False}
+        self.visit(node)
+        effects = self.current_effects
+        self.current_effects = None
+        emission = {
+            'result': self.result[num_results:],
+            'new_lines': self.new_lines,
+            'cythonized': self.cythonized_funcs.get(node.name, None) is node,
+            'interface_lines': self.interface_lines[num_interface:],
+            'benchmarks': list(zip(self.benchmark_names[num_benchmarks:],
+                                   self.benchmark_codes[num_benchmarks:])),
+            'modules': sorted(effects['modules']),
+            'functions': sorted(effects['functions']),
+            'cimports': effects['cimports'],
+            'parallel': effects['parallel'],
+        }
+        return emission
+
+    def replay_function_emission(self, node, emission):
+        self.result.extend(emission['result'])
+        self.new_lines = emission['new_lines']
+        if emission['cythonized']:
+            self.cythonized_funcs[node.name] = node
+        else:
+            self.plain_funcs[node.name] = node
+        self.interface_lines.extend(emission['interface_lines'])
+        for bench_name, bench_code in emission['benchmarks']:
+            self.benchmark_names.append(bench_name)
+            self.benchmark_codes.append(bench_code)
+        for name in emission['modules']:
+            self.mark_module_used(name)
+        for name in emission['functions']:
+            self.mark_function_used(name)
+        for name in emission['cimports']:
+            self.mark_module_cimported(name)
+        if emission['parallel']:
+            self.mark_parallel_used()
+
+    def mark_module_used(self, name):
+        if self.current_effects is not None:
+            self.current_effects['modules'].add(name)
+        if name in self.imported_modules:
+            self.imported_modules[name][1] = True
+
+    def mark_function_used(self, name):
+        if self.current_effects is not None:
+            self.current_effects['functions'].add(name)
+        if name in self.imported_functions:
+            self.imported_functions[name][2] = True
+
+    def get_pxd_signature(self, def_keyword, return_string, cyth_funcname, args, typedict):
+        """ declaration of a function in the pxd, where defaults are written as * """
+        pxd_args = deepcopy(args)
+        pxd_args.defaults = ['*'] * len(args.defaults)
+        index_before = len(self.result)
+        self.write('%s%s%s(' % (def_keyword, return_string, cyth_funcname,))
+        self.signature(pxd_args, typedict=typedict)
+        self.write(')')
+        pxd_signature = ''.join(self.result[index_before:])
+        del self.result[index_before:]
+        return pxd_signature
+
+    def rewrite_module_calls(self, code):
+        """
+        Makes calls to mod.func_cyth in cyth code direct C calls into the
+        cimported pxd of mod, like visit_Call does for python code
+        """
+        def replace_call(match):
+            parts = match.group(1).split('.')
+            is_module = parts[0] in self.imported_modules or parts[0] in self.imported_functions
+            if (len(parts) == 2 and is_module and parts[1].endswith('_cyth') and
+                    not parts[1].startswith('_')):
+                self.mark_module_cimported(parts[0])
+                return cyth_helpers.get_cyth_name(parts[0]) + '._' + parts[1] + '('
+            return match.group(0)
+        return cyth_analysis.CALL_REGEX.sub(replace_call, code)
+
+    def mark_module_cimported(self, name):
+        if self.current_effects is not None:
+            self.current_effects['cimports'].append(name)
+        self.modules_to_cimport.append(name)
+
+    def memview_body(self, body, typedict, convert=True):
+        """
+        Converts the single line buffer cdefs of cyth code to memoryviews (if
+        convert) and wraps returned memoryviews with np.asarray, so callers
+        still get ndarrays.
+        """
+        memview_names = set(id_ for id_, type_ in six.iteritems(typedict)
+                            if is_memview_type(type_))
+        new_body = []
+        for item in body:
+            if isinstance(item, six.string_types):
+                line = item.lstrip('\n')
+                # macros expand to several lines
+                memview_names.update(match.group(1) for match in map(
+                    MEMVIEW_CDEF_REGEX.match, line.split('\n')) if match)
+                match = NDARRAY_CDEF_REGEX.match(line)
+                if match and convert:
+                    prefix, type_, space, id_, rest = match.groups()
+                    memview_names.add(id_)
+                    line = prefix + ndarray_to_memview(type_) + space + id_ + rest
+                match = RETURN_NAMES_REGEX.match(line)
+                if match:
+                    names = [name.strip() for name in match.group(2).split(',')]
+                    if any(name in memview_names for name in names):
+                        wrapped = ['np.asarray(%s)' % name if name in memview_names else name
+                                   for name in names]
+                        line = match.group(1) + ', '.join(wrapped)
+                new_body.append(item[:len(item) - len(item.lstrip('\n'))] + line)
+            elif isinstance(item, ast.AST):
+                new_body.append(MemviewReturnWrapper(memview_names).visit(deepcopy(item)))
+            else:
+                new_body.append(item)
+        if len(memview_names) > 0:
+            self.mark_module_used('np')
+        return new_body
+
+    def fused_dtype_body(self, body, dtypes, fused_name):
+        """
+        Python level uses of the fused dtypes in cyth code (e.g.
+        dtype=np.float64) become a variable holding the dtype of the
+        specialization being compiled.
+        """
+        dtype_regex = re.compile(r'np\.(%s)(?![A-Za-z0-9_])' % '|'.join(dtypes))
+        uses_dtype = any(isinstance(item, six.string_types) and dtype_regex.search(item)
+                         for item in body)
+        if not uses_dtype:
+            return body
+        dtype_var = self.gensym('dtype')
+        new_body = []
+        for item in body:
+            if isinstance(item, six.string_types):
+                item = dtype_regex.sub(dtype_var, item)
+            new_body.append(item)
+        # select the dtype where the cyth code starts
+        for ix, item in enumerate(new_body):
+            if isinstance(item, six.string_types) and item.strip() != '':
+                line = item.lstrip('\n')
+                indent = line[:len(line) - len(line.lstrip())]
+                break
+        else:
+            ix, indent = 0, self.indent_with
+        select_lines = []
+        for count, dtype in enumerate(dtypes):
+            keyword = 'if' if count == 0 else 'elif'
+            select_lines.append('\n%s%s %s is np.%s_t:' % (indent, keyword, fused_name, dtype))
+            select_lines.append('\n%s%s%s = np.%s' % (indent, self.indent_with, dtype_var, dtype))
+        self.mark_module_used('np')
+        return new_body[:ix] + select_lines + new_body[ix:]
+
+    def mark_parallel_used(self):
+        if self.current_effects is not None:
+            self.current_effects['parallel'] = True
+        self.uses_parallel = True
+
     def visit_ImportFrom(self, node, emitCimport=False):
         imp = 'cimport' if emitCimport else 'import'
         if node.module:
@@ -421,14 +817,16 @@ class CythVisitor(BASE_CLASS):
         self.comma_list(node.names)
 
     def generate_imports(self, modules, functions):
+        # Everything is visited in sorted order so identical modules always
+        # produce identical text (the compiled-extension cache relies on it)
         imports = []
-        for (alias, used_flag) in six.itervalues(modules):
+        for (_, (alias, used_flag)) in sorted(six.iteritems(modules)):
             if used_flag:
                 import_line = cyth_helpers.ast_to_sourcecode(ast.Import(names=[alias]))
                 imports.append(import_line)
                 if alias.name in self.cimport_whitelist:
                     imports.append('c' + import_line)
-        for (modulename, alias, used_flag) in six.itervalues(functions):
+        for (_, (modulename, alias, used_flag)) in sorted(six.iteritems(functions)):
             # If module
             if used_flag and alias.name not in self.import_from_blacklist:
                 impnode = ast.ImportFrom(module=modulename, names=[alias], level=0)
@@ -442,7 +840,7 @@ class CythVisitor(BASE_CLASS):
                     temp_cv.visit_ImportFrom(impnode, emitCimport=True)
                     import_line = temp_cv.get_result()[0]
                     imports.append(import_line)
-        for modulename in set(self.modules_to_cimport):
+        for modulename in sorted(set(self.modules_to_cimport)):
             module_alias = modules.get(modulename, [None])[0]
             if module_alias is not None:
                 assert isinstance(module_alias, ast.alias), type(module_alias)
@@ -453,33 +851,23 @@ class CythVisitor(BASE_CLASS):
                 tmpnode = ast.Import(names=[cythed_alias])
                 import_line = 'c' + cyth_helpers.ast_to_sourcecode(tmpnode)
                 imports.append(import_line)
-        module_func_dict = dict(chain(self.cythonized_funcs.iteritems(),
-                                      self.plain_funcs.iteritems()))
-
-        #@utool.show_return_value
-        def is_called_in(funcname, node):
-            call_list = get_funcalls_in_node(node)
-            def _iscalled(call):
-                return (isinstance(call, ast.Call) and
-                        isinstance(call.func, ast.Name) and
-                        funcname == call.func.id)
-            return any(map(_iscalled, call_list))
-            #def name_of_call(call):  # ast.Node -> string option
-            #    #print('ast dump: %r' % ast.dump(call))
-            #    if not isinstance(call, ast.Call):
-            #        return []
-            #    if not isinstance(call.func, ast.Name):
-            #        return []
-            #    return [call.func.id]
-            #is_called = funcname in chain(*map(name_of_call, call_list))
-            #return is_called
-
-        called_funcs = []
-        print('module_func_dict = %r' % (module_func_dict.keys(),))
-        for callee in module_func_dict.keys():
-            for (caller, caller_node) in six.iteritems(self.cythonized_funcs):
-                if is_called_in(callee, caller_node):
-                    called_funcs.append(callee)
+            elif modulename in functions:
+                # a module imported with 'from package import module'
+                package_name, module_alias = functions[modulename][0:2]
+                cythed_alias = ast.alias(cyth_helpers.get_cyth_name(module_alias.name),
+                                         module_alias.asname and
+                                         cyth_helpers.get_cyth_name(module_alias.asname))
+                tmpnode = ast.ImportFrom(module=package_name, names=[cythed_alias], level=0)
+                imports.append(cyth_helpers.ast_to_sourcecode(tmpnode).replace(' import ', ' cimport ', 1))
+        module_func_dict = dict(chain(six.iteritems(self.cythonized_funcs),
+                                      six.iteritems(self.plain_funcs)))
+
+        # module functions called by any cythonized function
+        call_graph = self.analysis.call_graph
+        called_funcs = [callee for callee in sorted(module_func_dict.keys())
+                        if callee not in self.demoted_funcs and
+                        any(callee in call_graph.get(caller, ())
+                            for caller in chain(self.cythonized_funcs, self.cythonized_classes))]
         if len(called_funcs) > 0:
             names = [ast.alias(name, None) for name in called_funcs]
             fromimport = ast.ImportFrom(module=self.py_modname, names=names, level=0)
@@ -497,18 +885,22 @@ class CythVisitor(BASE_CLASS):
         is_cyth_call = lambda name: name.endswith('_cyth') and not name.startswith('_')
         if isinstance(node.func, ast.Attribute) and isinstance(node.func.value, ast.Name):
             #print('visit_Call, branch 1')
-            if node.func.value.id in self.imported_modules:
-                self.imported_modules[node.func.value.id][1] = True
+            self.mark_module_used(node.func.value.id)
             if is_cyth_call(node.func.attr):
-                self.modules_to_cimport.append(node.func.value.id)
+                self.mark_module_cimported(node.func.value.id)
                 newnode = deepcopy(node)
                 newnode.func.attr = '_' + node.func.attr
                 newnode.func.value.id = cyth_helpers.get_cyth_name(node.func.value.id)
                 return BASE_CLASS.visit_Call(self, newnode)
         if isinstance(node.func, ast.Name):
             #print('visit_Call, branch 2')
-            if node.func.id in self.imported_functions:
-                self.imported_functions[node.func.id][2] = True
+            self.mark_function_used(node.func.id)
+            if (cyth_analysis.get_function_base_name(node.func.id) in
+                    self.demoted_funcs | self.cyth_classes):
+                newnode = deepcopy(node)
+                newnode.func.id = cyth_helpers.get_cyth_name(
+                    cyth_analysis.get_function_base_name(node.func.id))
+                return BASE_CLASS.visit_Call(self, newnode)
             if is_cyth_call(node.func.id):
                 newnode = deepcopy(node)
                 newnode.func.id = '_' + node.func.id
@@ -532,9 +924,15 @@ class CythVisitor(BASE_CLASS):
         has_markup = False
         first_docstr = None
         inline_flag_ptr = [False]
+        directives = {}
+        dtypes = []
         collect_macro_input = False
         macro_input_buffer_ptr = [[]]
         suspended_macro_context_ptr = [None]
+        # C type annotations are typed like the docstring markup, which takes
+        # precedence over them
+        annotation_param_typedict, annotation_return_type = get_annotation_types(node)
+        annotation_stripper = AnnotationStripper()
         for stmt in node.body:
             if is_docstring(stmt):
                 docstr = stmt.value.s
@@ -547,7 +945,7 @@ class CythVisitor(BASE_CLASS):
                  new_return_type) = self.parse_cyth_preproc_markup(
                     docstr, cyth_mode, collect_macro_input,
                     macro_input_buffer_ptr, suspended_macro_context_ptr,
-                    inline_flag_ptr)
+                    inline_flag_ptr, directives, dtypes)
                 #print('source_lines: %r' % (source_lines,))
                 new_body.extend(source_lines)
                 if new_return_type is not None and return_type is None:
@@ -557,70 +955,146 @@ class CythVisitor(BASE_CLASS):
             else:
                 #print('cyth_mode: %r, stmt: %r' % (cyth_mode, ast.dump(stmt)))
                 if not (cyth_mode or collect_macro_input):
-                    new_body.append(stmt)
+                    stmt = annotation_stripper.visit(deepcopy(stmt))
+                    if stmt is not None:
+                        new_body.append(stmt)
                 if collect_macro_input:
                     macro_input_buffer_ptr[0].append(cyth_helpers.ast_to_sourcecode(stmt))
+        is_method = self.current_class is not None
+        # types recorded at runtime come last
+        recorded_name = (self.current_class['name'] + '.' + node.name
+                         if is_method else node.name)
+        arg_names = get_arg_names(node.args)
+        recorded_typedict = {id_: type_ for id_, type_ in
+                             six.iteritems(self.recorded_types.get(recorded_name, {}))
+                             if id_ in arg_names}
+        for typedict in [annotation_param_typedict, recorded_typedict]:
+            for id_, type_ in six.iteritems(typedict):
+                param_typedict.setdefault(id_, type_)
+        for id_, type_ in six.iteritems(annotation_stripper.typedict):
+            bodyvars_typedict.setdefault(id_, type_)
+        if return_type is None:
+            return_type = annotation_return_type
+        has_markup = has_markup or (len(annotation_param_typedict) > 0 or
+                                    len(annotation_stripper.typedict) > 0 or
+                                    annotation_return_type is not None or
+                                    len(recorded_typedict) > 0)
         if has_markup:
-            self.cythonized_funcs[node.name] = node
-            self.register_benchmark(node.name, first_docstr, self.py_modname)
+            if not is_method:
+                self.cythonized_funcs[node.name] = node
+            is_demoted = node.name in self.demoted_funcs and not is_method
+            if not (is_demoted or is_method or first_docstr is None):
+                # benchmarks call the cython version from python (functions
+                # typed by annotations alone have no doctests to time)
+                self.register_benchmark(node.name, first_docstr, self.py_modname)
+            direct_call_names = self.demoted_funcs | self.cyth_classes
+            if len(direct_call_names) > 0:
+                new_body = [rewrite_internal_calls(item, direct_call_names)
+                            if isinstance(item, six.string_types) else item
+                            for item in new_body]
+            new_body = [self.rewrite_module_calls(item)
+                        if isinstance(item, six.string_types) else item
+                        for item in new_body]
+            # modules and functions only cyth code uses are imported too
+            for item in new_body:
+                if isinstance(item, six.string_types):
+                    for name in cyth_analysis.tokenize_dotted_names(item):
+                        if name in self.imported_modules:
+                            self.mark_module_used(name)
+                        elif name in self.imported_functions:
+                            self.mark_function_used(name)
             union_typedict = {}
             union_typedict.update(param_typedict)
             union_typedict.update(bodyvars_typedict)
+            if self.memview:
+                union_typedict = {id_: ndarray_to_memview(type_)
+                                  for id_, type_ in six.iteritems(union_typedict)}
+            new_body = self.memview_body(new_body, union_typedict, convert=self.memview)
+            if is_method:
+                # methods keep their names; the class is the cython version
+                cyth_funcname = node.name
+                fused_name = self.current_class['cyth_name'] + '_' + node.name + '_dtype_t'
+            else:
+                cyth_funcname = cyth_helpers.get_cyth_name(node.name)
+                fused_name = cyth_funcname + '_dtype_t'
+            if len(dtypes) > 0:
+                union_typedict = {id_: specialize_dtypes(type_, dtypes, fused_name)
+                                  for id_, type_ in six.iteritems(union_typedict)}
+                new_body = self.fused_dtype_body(new_body, dtypes, fused_name)
+                # the pyx sees the declarations of its pxd
+                self.interface_lines.append(get_fused_ctypedef(fused_name, dtypes))
+            inferred_typedict, inferred_return_type = cyth_infer.infer_local_types(
+                new_body, union_typedict, exclude=arg_names)
+            # inferred locals are declared with the cdef: block
+            union_typedict.update(inferred_typedict)
+            # single line cdefs in the body (e.g. from macros) take precedence
+            # over the cdef: block
+            for id_ in get_body_cdef_names(new_body):
+                if id_ not in arg_names:
+                    union_typedict.pop(id_, None)
             if return_type is None:
                 return_type = infer_return_type(node, union_typedict)
+                if is_memview_type(return_type):
+                    # memview_body returns these as ndarrays
+                    return_type = None
+            if return_type is None:
+                return_type = inferred_return_type
+            if any(isinstance(item, ParallelLoopMarker) for item in new_body):
+                new_body = expand_parallel_loops(new_body, union_typedict)
+                self.mark_parallel_used()
 
             self.newline(extra=1)
-            cyth_funcname = cyth_helpers.get_cyth_name(node.name)
-            # TODO: should allow for user specification
-            func_prefix = utool.unindent('''
-            @cython.boundscheck(False)
-            @cython.wraparound(False)
-            ''').strip()
-
-            # http://docs.cython.org/src/reference/compilation.html#compiler-directives
-            # [(name, defaultval), ...]
-            cython_compiler_directives = [  # NOQA
-                ('boundscheck', True),
-                ('wraparound', True),
-                ('nonecheck', False),
-                ('overflowcheck', False),
-                ('overflowcheck.fold', True),  # may help or hurt depending on compiler, arch, and opt settings
-                ('embedsignature', False),
-                ('cdivision', False),
-                ('cdivision_warnings', False),
-                ('always_allow_keywords', None),
-                ('profile', False),
-                ('linetrace', False),
-                ('invert_types', None),
-                ('language_level', 2),
-                ('c_string_type', bytes),
-                ('c_string_encoding', 'ascii'),
-                ('type_version_tag', True),
-                ('unraisable_tracebacks', None),
-            ]
-
-            return_string = (" %s " % return_type) if return_type is not None else " "
-            self.statement(node, func_prefix + '\n')
-            # HACK: indexing is used to extract a portion of the generated stream, which wouldn't
-            # be needed if statement/write/etc all returned values rather than writing a stream
-            index_before = len(self.result)
-            inline_string = ' inline ' if inline_flag_ptr[0] else ''
-            self.write('cpdef%s%s%s(' % (inline_string, return_string, cyth_funcname,))
+            function_directives = DEFAULT_FUNCTION_DIRECTIVES.copy()
+            function_directives.update(
+                (key, val) for key, val in six.iteritems(self.module_directives)
+                if key not in MODULE_ONLY_DIRECTIVES)
+            function_directives.update(directives)
+            indent = self.indent_with * self.indentation
+            func_prefix = ('\n' + indent).join(get_directive_decorators(function_directives))
+
+            if is_method:
+                is_inline = False
+                # special methods cannot be cpdef
+                def_keyword = 'def' if is_special_method(node.name) else 'cpdef'
+            elif is_demoted:
+                is_inline = inline_flag_ptr[0] or get_body_size(new_body) <= AUTO_INLINE_MAX_LINES
+                def_keyword = 'cdef'
+            else:
+                is_inline = inline_flag_ptr[0]
+                def_keyword = 'cpdef'
+            if return_type is not None and def_keyword != 'def':
+                return_string = " %s " % return_type
+            else:
+                return_string = " "
+            self.statement(node, func_prefix + '\n' + indent)
+            inline_string = ' inline' if is_inline else ''
+            self.write('%s%s%s%s(' % (def_keyword, inline_string, return_string, cyth_funcname,))
             nonsig_typedict = self.signature(node.args, typedict=union_typedict)
             cyth_def_body = self.typedict_to_cythdef(nonsig_typedict)
             self.write(')')
-            function_signature = ''.join(self.result[index_before:])
-            self.interface_lines.append(function_signature)
+            # pxds declare without inline, and other modules may cimport
+            # demoted functions too
+            if is_method:
+                if def_keyword == 'cpdef':
+                    self.current_class['interface_lines'].append(self.get_pxd_signature(
+                        def_keyword, return_string, cyth_funcname, node.args, union_typedict))
+            else:
+                self.interface_lines.append(self.get_pxd_signature(
+                    def_keyword, return_string, cyth_funcname, node.args, union_typedict))
             self.write(':')
             # TODO FIXME: the typedict parser is a giant hack right now.
             # Find a good cython parser
             self.indentation += 1
             #cyth_def_body = self.typedict_to_cythdef(bodyvars_typedict)
             for s in cyth_def_body:
-                self.write('\n', s)
-            self.write('\n')
+                self.newline()
+                self.write(s)
+            self.newline()
             self.indentation -= 1
             self.body(new_body)
+        elif is_method:
+            # the cdef class replaces the python class, so it needs every method
+            BASE_CLASS.visit_FunctionDef(self, node)
         else:
             self.plain_funcs[node.name] = node
 #        if actiontup:
@@ -683,38 +1157,596 @@ class CythVisitor(BASE_CLASS):
         return bench_text
 
 
-def is_docstring(node):
-    return isinstance(node, ast.Expr) and isinstance(node.value, ast.Str)
+#def parseparen(string):
+#    src = cStringIO.StringIO(line3).readline
+#    tokentup_list = list(tokenize.generate_tokens(src))
+#    token_list = [token[1] for token in tokentup_list]
 
 
-def assignment_targets(node):
+def parse_macro_options(text):
     """
-    Assign nodes have a list of multiple targets, which is used for
-    'a = b = c' (a and b are both targets)
+    Parses the 'key=val ...' options after the name in a #macro line; they are
+    passed to the expander as keyword arguments
 
-    'x, y = y, x' has a tuple as the only element of the targets array,
-    (likewise for '[x, y] = [y, x]', but with lists)
+    >>> from cyth.cyth_parser import *  # NOQA
+    >>> sorted(parse_macro_options(' ndim=3 dtype=np.float32_t').items())
+    [('dtype', 'np.float32_t'), ('ndim', '3')]
     """
-    assert isinstance(node, (ast.Assign, ast.AugAssign)), type(node)
-    if isinstance(node, ast.AugAssign):
-        assign_targets = [node.target]
-        return assign_targets
-    elif isinstance(node, ast.Assign):
-        assign_targets = []
-        for target in node.targets:
-            if isinstance(target, (ast.Tuple, ast.List)):
-                assign_targets.extend(target.elts)
-            else:
-                assign_targets.append(target)
-        return assign_targets
+    options = {}
+    for item in text.split():
+        if '=' not in item:
+            raise ValueError('macro option %r has no value' % (item,))
+        key, val = item.split('=', 1)
+        options[key] = val
+    return options
+
+
+def parse_directives(text, module_level=False):
+    """
+    Parses the 'name=value ...' list of a #CYTH_DIRECTIVES line
+
+    Args:
+        text (str): whitespace separated name=value pairs
+        module_level (bool): allow directives that only apply to whole modules
+
+    Raises:
+        ValueError: for unknown directives or values of the wrong kind
+
+    Example:
+        >>> from cyth.cyth_parser import *  # NOQA
+        >>> sorted(parse_directives('cdivision=True nonecheck=False').items())
+        [('cdivision', True), ('nonecheck', False)]
+        >>> parse_directives('c_string_encoding=utf8', module_level=True)
+        {'c_string_encoding': 'utf8'}
+        >>> parse_directives('boundcheck=False')
+        Traceback (most recent call last):
+        ...
+        ValueError: unknown cython directive 'boundcheck'
+    """
+    import ast as ast_
+    default_dict = dict(CYTHON_COMPILER_DIRECTIVES)
+    directives = {}
+    for item in text.split():
+        if '=' not in item:
+            raise ValueError('cython directive %r has no value' % (item,))
+        name, valstr = item.split('=', 1)
+        if name not in default_dict:
+            raise ValueError('unknown cython directive %r' % (name,))
+        if name in MODULE_ONLY_DIRECTIVES and not module_level:
+            raise ValueError('cython directive %r can only be given for a module' % (name,))
+        try:
+            val = ast_.literal_eval(valstr)
+        except (ValueError, SyntaxError):
+            val = valstr
+        if isinstance(default_dict[name], bool) and not isinstance(val, bool):
+            raise ValueError('cython directive %r expects True or False, got %r' % (name, valstr))
+        directives[name] = val
+    return directives
+
+
+def get_module_directives(module_node):
+    """ Parses the #CYTH_DIRECTIVES lines of the module level docstrings """
+    regex = re.compile('#CYTH_DIRECTIVES (.*)')
+    directives = {}
+    for subnode in module_node.body:
+        if is_docstring(subnode):
+            for match in regex.finditer(subnode.value.s):
+                directives.update(parse_directives(match.group(1), module_level=True))
+    return directives
+
+
+def _directive_order(name):
+    return [key for key, _ in CYTHON_COMPILER_DIRECTIVES].index(name)
+
+
+def get_directive_decorators(directives):
+    """
+    >>> from cyth.cyth_parser import *  # NOQA
+    >>> print('\\n'.join(get_directive_decorators({'cdivision': True, 'boundscheck': False})))
+    @cython.boundscheck(False)
+    @cython.cdivision(True)
+    """
+    return ['@cython.%s(%r)' % (name, directives[name])
+            for name in sorted(directives, key=_directive_order)]
+
+
+def get_directive_header(directives):
+    """
+    >>> from cyth.cyth_parser import *  # NOQA
+    >>> print(get_directive_header({'language_level': 3, 'cdivision': True}))
+    # cython: cdivision=True, language_level=3
+    """
+    return '# cython: ' + ', '.join('%s=%s' % (name, directives[name])
+                                    for name in sorted(directives, key=_directive_order))
+
+
+def ndarray_to_memview(type_):
+    """
+    Returns the typed memoryview equivalent of a np.ndarray buffer type. The
+    mode of the buffer picks the contiguous axis. Other types are returned
+    unchanged.
+
+    Example:
+        >>> from cyth.cyth_parser import *  # NOQA
+        >>> ndarray_to_memview('np.ndarray[np.float64_t,ndim=2]')
+        'np.float64_t[:, :]'
+        >>> ndarray_to_memview('np.ndarray[np.float64_t, ndim=3, mode="c"]')
+        'np.float64_t[:, :, ::1]'
+        >>> ndarray_to_memview("np.ndarray[np.int32_t,ndim=2,mode='fortran']")
+        'np.int32_t[::1, :]'
+        >>> ndarray_to_memview('Py_ssize_t')
+        'Py_ssize_t'
+    """
+    match = NDARRAY_REGEX.match(type_.strip())
+    if match is None:
+        return type_
+    parts = [part.strip() for part in match.group(1).split(',')]
+    dtype = parts[0]
+    kwargs = dict(part.split('=', 1) for part in parts[1:] if '=' in part)
+    ndim = int(kwargs.get('ndim', 1))
+    mode = kwargs.get('mode', 'strided').strip('\'"')
+    axes = [':'] * ndim
+    if mode == 'c':
+        axes[-1] = '::1'
+    elif mode == 'fortran':
+        axes[0] = '::1'
+    elif mode not in ['strided', 'full']:
+        raise ValueError('unknown buffer mode %r in %r' % (mode, type_))
+    return '%s[%s]' % (dtype, ', '.join(axes))
+
+
+def is_memview_type(type_):
+    return type_ is not None and type_.endswith(']') and ':' in type_
+
+
+class MemviewReturnWrapper(ast.NodeTransformer):
+    """ wraps returned memoryviews in np.asarray """
+    def __init__(self, memview_names):
+        self.memview_names = memview_names
+
+    def wrap(self, node):
+        if isinstance(node, ast.Name) and node.id in self.memview_names:
+            asarray = ast.Attribute(value=ast.Name(id='np', ctx=ast.Load()),
+                                    attr='asarray', ctx=ast.Load())
+            return ast.Call(func=asarray, args=[node], keywords=[],
+                            starargs=None, kwargs=None)
+        return node
+
+    def visit_FunctionDef(self, node):
+        # returns of nested functions are not returns of the cyth function
+        return node
+
+    def visit_Return(self, node):
+        if isinstance(node.value, ast.Tuple):
+            node.value.elts = list(map(self.wrap, node.value.elts))
+        elif node.value is not None:
+            node.value = self.wrap(node.value)
+        return node
+
+
+def parse_dtypes(text):
+    """
+    Parses the dtype list of a #CYTH_DTYPES line
+
+    Example:
+        >>> from cyth.cyth_parser import *  # NOQA
+        >>> parse_dtypes('float32 np.float64_t')
+        ['float32', 'float64']
+        >>> parse_dtypes('float16')
+        Traceback (most recent call last):
+        ...
+        ValueError: #CYTH_DTYPES does not support 'float16'
+    """
+    dtypes = []
+    for item in text.split():
+        dtype = item.replace('np.', '', 1) if item.startswith('np.') else item
+        dtype = dtype[:-2] if dtype.endswith('_t') else dtype
+        if dtype not in FUSED_DTYPES:
+            raise ValueError('#CYTH_DTYPES does not support %r' % (item,))
+        if dtype not in dtypes:
+            dtypes.append(dtype)
+    return dtypes
+
+
+def specialize_dtypes(type_, dtypes, fused_name):
+    """
+    >>> from cyth.cyth_parser import *  # NOQA
+    >>> specialize_dtypes('np.ndarray[np.float64_t,ndim=2]', ['float32', 'float64'], 'f_t')
+    'np.ndarray[f_t,ndim=2]'
+    """
+    return re.sub(r'np\.(%s)_t(?![A-Za-z0-9_])' % '|'.join(dtypes), fused_name, type_)
+
+
+def get_fused_ctypedef(fused_name, dtypes):
+    """
+    >>> from cyth.cyth_parser import *  # NOQA
+    >>> print(get_fused_ctypedef('f_t', ['float32', 'float64']))
+    ctypedef fused f_t:
+        np.float32_t
+        np.float64_t
+    """
+    lines = ['ctypedef fused %s:' % (fused_name,)]
+    lines += ['    np.%s_t' % (dtype,) for dtype in dtypes]
+    return '\n'.join(lines)
+
+
+class ParallelLoopMarker(object):
+    """ Placeholder for a #CYTH_PARALLEL line in the body of a function """
+    def __init__(self, options):
+        self.options = options
+
+
+def parse_parallel_options(text):
+    """
+    Parses the options of a #CYTH_PARALLEL line into prange keyword arguments
+
+    Example:
+        >>> from cyth.cyth_parser import *  # NOQA
+        >>> sorted(parse_parallel_options(' num_threads=4 schedule=dynamic').items())
+        [('num_threads', '4'), ('schedule', "'dynamic'")]
+        >>> parse_parallel_options(' schedule=fastest')
+        Traceback (most recent call last):
+        ...
+        ValueError: unknown prange schedule 'fastest'
+    """
+    options = {}
+    for item in text.split():
+        name, _, valstr = item.partition('=')
+        if name not in PARALLEL_OPTIONS or valstr == '':
+            raise ValueError('invalid #CYTH_PARALLEL option %r' % (item,))
+        if name == 'schedule':
+            valstr = valstr.strip('\'"')
+            if valstr not in PARALLEL_SCHEDULES:
+                raise ValueError('unknown prange schedule %r' % (valstr,))
+            valstr = repr(valstr)
+        options[name] = valstr
+    return options
+
+
+def split_pxd_declarations(lines):
+    """
+    Separates the declarations of module level cyth code that belong in the
+    pxd (ctypedefs, structs, unions, enums and extern blocks) from the rest.
+    The pyx sees its pxd, so they are not repeated there. Cimports are kept
+    in both.
+
+    Args:
+        lines (list): cyth code lines, each starting with a newline
+
+    Returns:
+        tuple: (declaration_lines, pyx_lines)
+
+    Example:
+        >>> from cyth.cyth_parser import *  # NOQA
+        >>> lines = ['\\nfrom libc.math cimport sqrt', '\\nctypedef np.float64_t DTYPE_t',
+        ...          '\\ncdef struct Pt:', '\\n    double x', '\\ncdef double X = 1']
+        >>> declaration_lines, pyx_lines = split_pxd_declarations(lines)
+        >>> print('\\n'.join(declaration_lines))
+        from libc.math cimport sqrt
+        ctypedef np.float64_t DTYPE_t
+        cdef struct Pt:
+            double x
+        >>> pyx_lines
+        ['\\nfrom libc.math cimport sqrt', '\\ncdef double X = 1']
+    """
+    declaration_lines = []
+    pyx_lines = []
+    block_indent = None  # indentation of the declaration block being moved
+    for line in lines:
+        text = line.lstrip('\n')
+        indent = len(text) - len(text.lstrip())
+        if block_indent is not None:
+            if text.strip() == '' or indent > block_indent:
+                declaration_lines.append(text)
+                continue
+            block_indent = None
+        if PXD_DECLARATION_REGEX.match(text):
+            declaration_lines.append(text)
+            if text.rstrip().endswith(':'):
+                block_indent = indent
+        else:
+            if CIMPORT_LINE_REGEX.match(text):
+                declaration_lines.append(text)
+            pyx_lines.append(line)
+    return declaration_lines, pyx_lines
+
+
+def get_body_cdef_names(body):
+    """
+    >>> from cyth.cyth_parser import *  # NOQA
+    >>> body = ['    cdef np.float64_t[:] _iv11s = src[:, 0, 0]', '    cdef Py_ssize_t n', '    cdef:']
+    >>> get_body_cdef_names(body)
+    ['_iv11s', 'n']
+    """
+    names = []
+    for item in body:
+        if isinstance(item, six.string_types):
+            for line in item.split('\n'):
+                match = CDEF_NAME_REGEX.match(line)
+                if match:
+                    names.append(match.group(1))
+    return names
+
+
+def get_cyth_classes(module_node):
+    """
+    Top-level classes whose docstring has cyth markup and that can be cdef
+    classes: undecorated, and derived from object or another such class.
+
+    >>> from cyth.cyth_parser import *  # NOQA
+    >>> import utool
+    >>> source = utool.unindent('''
+    ...     class Foo(object):
+    ...         \'#if CYTH\'
+    ...     class Bar(Foo):
+    ...         \'#if CYTH\'
+    ...     class Baz(dict):
+    ...         \'#if CYTH\'
+    ...     ''')
+    >>> sorted(get_cyth_classes(ast.parse(source)))
+    [cyth] cannot make a cdef class of Baz; its bases are ['dict']
+    ['Bar', 'Foo']
+    """
+    cyth_classes = set([])
+    for subnode in module_node.body:
+        if not isinstance(subnode, ast.ClassDef) or len(subnode.decorator_list) > 0:
+            continue
+        if get_class_markup(subnode) is None:
+            continue
+        base_names = [base.id if isinstance(base, ast.Name) else None for base in subnode.bases]
+        base_names = [name for name in base_names if name != 'object']
+        # extension types have a single base
+        if len(base_names) == 0 or (len(base_names) == 1 and base_names[0] in cyth_classes):
+            cyth_classes.add(subnode.name)
+        else:
+            print('[cyth] cannot make a cdef class of %s; its bases are %r' % (
+                subnode.name, base_names))
+    return cyth_classes
+
+
+def get_class_markup(class_node):
+    """ the docstring with cyth markup among the leading docstrings of a class """
+    for stmt in class_node.body:
+        if not is_docstring(stmt):
+            break
+        if '#if CYTH' in stmt.value.s:
+            return stmt.value.s
+    return None
+
+
+def is_special_method(name):
+    return name.startswith('__') and name.endswith('__')
+
+
+def get_attr_type(type_):
+    """
+    Buffer types are only allowed for locals, so buffer attributes are plain
+    ndarrays
+
+    >>> from cyth.cyth_parser import *  # NOQA
+    >>> get_attr_type('np.ndarray[np.float64_t,ndim=2]'), get_attr_type('double')
+    ('np.ndarray', 'double')
+    """
+    if NDARRAY_REGEX.match(type_):
+        return 'np.ndarray'
+    return type_
+
+
+def get_demotable_funcs(module_node, analysis):
+    """
+    Internal cyth functions (see ModuleAnalyzer.get_internal_funcs) that can
+    be cdef functions, which cannot take *args or **kwargs.
+    """
+    internal_funcs = analysis.get_internal_funcs()
+    return set(subnode.name for subnode in module_node.body
+               if isinstance(subnode, ast.FunctionDef) and subnode.name in internal_funcs and
+               subnode.args.vararg is None and subnode.args.kwarg is None)
+
+
+def rewrite_internal_calls(code, funcnames):
+    """
+    Makes cyth code call the cython version of funcnames directly
+
+    >>> from cyth.cyth_parser import *  # NOQA
+    >>> print(rewrite_internal_calls('y = helper(x) + helper_cyth(x) + np.helper(x)', ['helper']))
+    y = _helper_cyth(x) + _helper_cyth(x) + np.helper(x)
+    """
+    def replace_call(match):
+        base_name = cyth_analysis.get_function_base_name(match.group(1))
+        if base_name in funcnames:
+            return cyth_helpers.get_cyth_name(base_name) + '('
+        return match.group(0)
+    return cyth_analysis.CALL_REGEX.sub(replace_call, code)
+
+
+def get_body_size(body):
+    """ number of lines of code in a function body """
+    num_lines = 0
+    for item in body:
+        if isinstance(item, ast.AST):
+            num_lines += len(cyth_helpers.ast_to_sourcecode(item).strip().split('\n'))
+        elif isinstance(item, six.string_types):
+            num_lines += len([line for line in item.split('\n')
+                              if line.strip() != '' and not line.strip().startswith('#')])
+    return num_lines
+
+
+def get_arg_name(arg):
+    """ the name of an argument (a Name or str in python 2, an arg in python 3) """
+    if isinstance(arg, six.string_types):
+        return arg
+    return arg.arg if hasattr(arg, 'arg') else arg.id
+
+
+def get_arg_names(args):
+    """
+    >>> from cyth.cyth_parser import *  # NOQA
+    >>> get_arg_names(ast.parse('def foo(a, b=1, *c, **d): pass').body[0].args)
+    ['a', 'b', 'c', 'd']
+    """
+    arg_names = [get_arg_name(arg) for arg in args.args + getattr(args, 'kwonlyargs', [])]
+    arg_names.extend(get_arg_name(arg) for arg in (args.vararg, args.kwarg) if arg is not None)
+    return arg_names
+
+
+def annotation_to_ctype(node):
+    """
+    Returns the C type an annotation spells, either as a string or through
+    the cython module, otherwise None. Annotations with python types (int,
+    np.ndarray, typing generics) are left to python.
+
+    >>> from cyth.cyth_parser import *  # NOQA
+    >>> annotation_to_ctype(ast.parse("'double[:, ::1]'").body[0].value)
+    'double[:, ::1]'
+    >>> annotation_to_ctype(ast.parse('cython.Py_ssize_t').body[0].value)
+    'Py_ssize_t'
+    >>> annotation_to_ctype(ast.parse("'np.ndarray[np.float64_t, ndim=2]'").body[0].value)
+    'np.ndarray[np.float64_t, ndim=2]'
+    >>> print(annotation_to_ctype(ast.parse('int').body[0].value))
+    None
+    >>> print(annotation_to_ctype(ast.parse("'List[int]'").body[0].value))
+    None
+    """
+    if node is None:
+        return None
+    value = getattr(node, 's', getattr(node, 'value', None))
+    if isinstance(value, six.string_types):
+        type_ = re.sub(r'^cython\.', '', value.strip())
     else:
-        raise AssertionError('unexpected node type %r' % type(node))
+        if hasattr(ast, 'unparse'):
+            source = ast.unparse(node)
+        else:
+            source = cyth_helpers.ast_to_sourcecode(node).strip()
+        if not source.startswith('cython.'):
+            return None
+        type_ = source[len('cython.'):]
+    return type_ if ANNOTATION_CTYPE_REGEX.match(type_) else None
 
 
-#def parseparen(string):
-#    src = cStringIO.StringIO(line3).readline
-#    tokentup_list = list(tokenize.generate_tokens(src))
-#    token_list = [token[1] for token in tokentup_list]
+def get_annotation_types(funcdef_node):
+    """
+    Returns the C types of the annotated parameters and the annotated return
+    type of a function (see AnnotationStripper for annotated variables)
+    """
+    args = funcdef_node.args
+    param_typedict = {}
+    for arg in args.args + getattr(args, 'kwonlyargs', []):
+        type_ = annotation_to_ctype(getattr(arg, 'annotation', None))
+        if type_ is not None:
+            param_typedict[get_arg_name(arg)] = type_
+    return_type = annotation_to_ctype(getattr(funcdef_node, 'returns', None))
+    if is_memview_type(return_type):
+        # memview_body returns memoryviews as ndarrays
+        return_type = None
+    return param_typedict, return_type
+
+
+class AnnotationStripper(ast.NodeTransformer):
+    """
+    Turns annotated assignments into plain ones and collects the C types of
+    the annotated variables, which are declared in the cdef: block
+    """
+    def __init__(self):
+        self.typedict = {}
+
+    def visit_FunctionDef(self, node):
+        # nested functions are python code
+        return node
+
+    visit_ClassDef = visit_FunctionDef
+
+    def visit_AnnAssign(self, node):
+        type_ = annotation_to_ctype(node.annotation)
+        if type_ is not None and isinstance(node.target, ast.Name):
+            self.typedict[node.target.id] = type_
+        if node.value is None:
+            return None
+        return ast.copy_location(ast.Assign(targets=[node.target], value=node.value), node)
+
+
+def is_c_type(type_):
+    """
+    >>> from cyth.cyth_parser import *  # NOQA
+    >>> is_c_type('np.ndarray[np.float64_t,ndim=3]'), is_c_type('np.ndarray')
+    (True, False)
+    """
+    return type_ is not None and type_ not in PYTHON_OBJECT_TYPES
+
+
+def check_nogil_loop(loopvar, code_lines, typedict):
+    """
+    Raises ValueError if the loop code might touch python objects: calls, or
+    names without a declared C type.
+    """
+    code = '\n'.join(code_lines)
+    calls = sorted(set(callee for line in code_lines
+                       for callee in cyth_analysis.get_cyth_code_calls(line)) - set(['range']))
+    if len(calls) > 0:
+        raise ValueError('#CYTH_PARALLEL loop over %r calls %s, which needs the GIL' %
+                         (loopvar, ', '.join(calls)))
+    untyped = sorted(set(name for name in LOOP_NAME_REGEX.findall(code)
+                         if name not in NOGIL_KEYWORDS and not is_c_type(typedict.get(name))))
+    if len(untyped) > 0:
+        raise ValueError('#CYTH_PARALLEL loop over %r uses %s, which are not declared with C types' %
+                         (loopvar, ', '.join(untyped)))
+
+
+def expand_parallel_loops(body, typedict):
+    """
+    Rewrites the 'for x in range(...):' cyth loop following each
+    ParallelLoopMarker in body as a prange loop in a nogil block.
+
+    Example:
+        >>> from cyth.cyth_parser import *  # NOQA
+        >>> body = [ParallelLoopMarker({'num_threads': '4'}),
+        ...         '\\n    for ix in range(n):', '\\n        out[ix] = x[ix] * 2']
+        >>> typedict = {'ix': 'Py_ssize_t', 'n': 'Py_ssize_t',
+        ...             'out': 'double[:]', 'x': 'double[:]'}
+        >>> print(''.join(expand_parallel_loops(body, typedict)))
+        <BLANKLINE>
+            with nogil:
+                for ix in prange(n, num_threads=4):
+                    out[ix] = x[ix] * 2
+        >>> expand_parallel_loops(body[0:2] + ['\\n        out[ix] = f(x)'], typedict)
+        Traceback (most recent call last):
+        ...
+        ValueError: #CYTH_PARALLEL loop over 'ix' calls f, which needs the GIL
+    """
+    is_line = lambda item: isinstance(item, six.string_types)
+    new_body = []
+    ix = 0
+    while ix < len(body):
+        marker = body[ix]
+        ix += 1
+        if not isinstance(marker, ParallelLoopMarker):
+            new_body.append(marker)
+            continue
+        while ix < len(body) and is_line(body[ix]) and body[ix].strip() == '':
+            new_body.append(body[ix])
+            ix += 1
+        match = None
+        if ix < len(body) and is_line(body[ix]):
+            match = FOR_RANGE_REGEX.match(body[ix].lstrip('\n'))
+        if match is None:
+            raise ValueError('#CYTH_PARALLEL must be followed by a '
+                             '"for ... in range(...):" line of cyth code')
+        indent, loopvar, range_args = match.groups()
+        ix += 1
+        loop_lines = []
+        while ix < len(body) and is_line(body[ix]):
+            line = body[ix].lstrip('\n')
+            if line.strip() != '' and utool.get_indentation(line) <= len(indent):
+                break
+            loop_lines.append(line)
+            ix += 1
+        check_nogil_loop(loopvar, [loopvar, range_args] + loop_lines, typedict)
+        prange_args = [range_args] + ['%s=%s' % (name, marker.options[name])
+                                      for name in PARALLEL_OPTIONS if name in marker.options]
+        new_body.append('\n' + indent + 'with nogil:')
+        new_body.append('\n' + indent + '    for %s in prange(%s):' % (loopvar, ', '.join(prange_args)))
+        new_body.extend('\n' + ('    ' + line if line.strip() != '' else line)
+                        for line in loop_lines)
+    return new_body
 
 
 def parse_cdef_line(line):
@@ -757,73 +1789,6 @@ def parse_cdef_line(line):
     return typedict
 
 
-class FirstpassInformationGatherer(ast.NodeVisitor):
-    """
-    first pass visitor class
-    """
-    def __init__(self):
-        self.global_names = []
-
-    def visit_Module(self, node):
-        for subnode in node.body:
-            if isinstance(subnode, (ast.Assign, ast.AugAssign)):
-                assign_targets = assignment_targets(subnode)
-                for target in assign_targets:
-                    self.global_names.append(target)
-
-
-class SecondpassInformationGatherer(ast.NodeVisitor):
-    """
-    second pass visitor class
-    """
-    def __init__(self, fpig):
-        self.fpig = fpig
-        self.globals_used = {name: False for name in fpig.global_names}
-
-    def visit_Name(self, node):
-        isname = lambda x: isinstance(x, ast.Name)
-        getid = lambda x: x.id
-        global_name_iter = map(getid, filter(isname, self.fpig.global_names))
-        if getid(node) in global_name_iter and isinstance(node.ctx, ast.Load):
-            self.globals_used[node] = True
-
-    def visit_Attribute(self, node):
-        if isinstance(node.value, ast.Name):
-            isattribute = lambda x: isinstance(x, ast.Attribute)
-            hasloadctx = lambda x: isinstance(x.value, ast.Name) and isinstance(x.value.ctx, ast.Load)
-            filt = lambda x: isattribute(x) and hasloadctx(x)
-            gettup = lambda x: (x.value.id, x.attr)
-            tup_iter = map(gettup, filter(filt, self.fpig.global_names))
-            if gettup(node) in tup_iter:
-                self.globals_used[node] = True
-
-    def visit_Expr(self, node):
-        if isinstance(node.value, ast.Str):
-            for global_name_node in self.fpig.global_names:
-                # for cyth strings, we don't yet have a good parser, so use
-                #  substring as a conservative estimate
-                global_name = None
-                if isinstance(global_name_node, ast.Name):
-                    global_name = global_name_node.id
-                elif isinstance(global_name_node, ast.Attribute):
-                    global_name = global_name_node.value.id + "." + global_name_node.attr
-                self.globals_used[global_name_node] = (self.globals_used.get(global_name_node, False) or
-                                                        (node.value.s.find(global_name) != -1))
-
-
-class CallRecorder(ast.NodeVisitor):
-    def __init__(self):
-        self.calls = []
-    def visit_Call(self, node):
-        self.calls.append(node)
-
-
-def get_funcalls_in_node(node):
-    cr = CallRecorder()
-    cr.visit(node)
-    return cr.calls
-
-
 def infer_return_type(funcdef_node, typedict):
     class ReturnTypeInferrer(ast.NodeVisitor):
         def __init__(self, node):
@@ -834,7 +1799,7 @@ def infer_return_type(funcdef_node, typedict):
             funcdef = node
             self.visit(funcdef)
             #print('visited_returns: %r' % self.visited_returns)
-            if utool.list_allsame(self.visited_returns) and len(self.visited_returns) > 0:
+            if len(set(self.visited_returns)) == 1:
                 self.return_type = self.visited_returns[0]
 
         def visit_Return(self, node):
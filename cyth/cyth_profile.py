@@ -0,0 +1,132 @@
+"""
+python -c "import doctest, cyth; print(doctest.testmod(cyth.cyth_profile))"
+
+Per-file, per-phase timings of the translation pipeline:
+
+    cyth_script.py ~/code/vtool/vtool --build --cyth-profile
+
+Each stage (read, parse, analysis, emit, macro, write, cython, cc) is timed
+separately for every file. Phases are exclusive: time spent in a nested phase
+(e.g. macro expansion during emission) is not also charged to its parent.
+The timings are written to cyth_profile.json and summarized on the console.
+"""
+from __future__ import absolute_import, division, print_function
+from contextlib import contextmanager
+import json
+import sys
+import time
+import utool
+
+PROFILE = '--cyth-profile' in sys.argv
+PROFILE_FNAME = 'cyth_profile.json'
+# Number of files listed in the console summary
+SUMMARY_TOP = 10
+
+# file key -> {phase name: seconds}
+_TIMINGS = {}
+# [key, phase name, start time] of the phases currently being timed
+_PHASE_STACK = []
+
+
+def record(key, name, seconds):
+    phase_dict = _TIMINGS.setdefault(key, {})
+    phase_dict[name] = phase_dict.get(name, 0.0) + seconds
+
+
+@contextmanager
+def phase(name, key=None):
+    """
+    Times the enclosed block as phase name of key. If key is None the key of
+    the enclosing phase is used, so code that does not know which file it is
+    working on (e.g. a macro expander) can still be attributed.
+
+    >>> from cyth import cyth_profile
+    >>> cyth_profile.PROFILE = True
+    >>> with cyth_profile.phase('emit', 'foo.py'):
+    ...     with cyth_profile.phase('macro'):
+    ...         pass
+    >>> sorted(cyth_profile.pop_timings()['foo.py'].keys())
+    ['emit', 'macro']
+    >>> cyth_profile.PROFILE = False
+    """
+    if not PROFILE:
+        yield
+        return
+    now = time.time()
+    if len(_PHASE_STACK) > 0:
+        # pause the parent phase
+        parent = _PHASE_STACK[-1]
+        record(parent[0], parent[1], now - parent[2])
+        if key is None:
+            key = parent[0]
+    frame = [key, name, now]
+    _PHASE_STACK.append(frame)
+    try:
+        yield
+    finally:
+        now = time.time()
+        _PHASE_STACK.pop()
+        record(key, name, now - frame[2])
+        if len(_PHASE_STACK) > 0:
+            # resume the parent phase
+            _PHASE_STACK[-1][2] = now
+
+
+def pop_timings():
+    """ Returns and clears the timings gathered in this process """
+    timings = dict(_TIMINGS)
+    _TIMINGS.clear()
+    return timings
+
+
+def merge_timings(timings):
+    """ Adds timings gathered elsewhere (e.g. in a worker process) """
+    for key, phase_dict in timings.items():
+        for name, seconds in phase_dict.items():
+            record(key, name, seconds)
+
+
+def get_phase_totals(timings):
+    """
+    >>> from cyth.cyth_profile import *  # NOQA
+    >>> timings = {'a.py': {'parse': 1.0, 'emit': 2.0}, 'b.py': {'emit': 1.5}}
+    >>> get_phase_totals(timings)
+    [('emit', 3.5), ('parse', 1.0)]
+    """
+    totals = {}
+    for phase_dict in timings.values():
+        for name, seconds in phase_dict.items():
+            totals[name] = totals.get(name, 0.0) + seconds
+    return sorted(totals.items(), key=lambda item: (-item[1], item[0]))
+
+
+def get_file_totals(timings):
+    totals = [(key, sum(phase_dict.values())) for key, phase_dict in timings.items()]
+    return sorted(totals, key=lambda item: (-item[1], item[0]))
+
+
+def dump_profile(timings, fpath=PROFILE_FNAME):
+    data = {
+        'files': timings,
+        'phases': dict(get_phase_totals(timings)),
+    }
+    with open(fpath, 'w') as file_:
+        json.dump(data, file_, indent=1, sort_keys=True)
+    print('[cyth.profile] wrote %s' % (fpath,))
+
+
+def print_profile_summary(timings, top=SUMMARY_TOP):
+    phase_totals = get_phase_totals(timings)
+    total = sum(seconds for _, seconds in phase_totals)
+    lines = ['%-10s %8.3fs %5.1f%%' % (name, seconds, 100 * seconds / max(total, 1E-9))
+             for name, seconds in phase_totals]
+    print('[cyth.profile] time per phase (%.3fs total):' % (total,))
+    print(utool.indentjoin(lines).strip('\n'))
+    file_totals = get_file_totals(timings)
+    lines = []
+    for key, seconds in file_totals[:top]:
+        phase_dict = timings[key]
+        slowest = max(phase_dict, key=phase_dict.get)
+        lines.append('%8.3fs %s (slowest phase: %s)' % (seconds, key, slowest))
+    print('[cyth.profile] slowest %d of %d files:' % (len(lines), len(file_totals)))
+    print(utool.indentjoin(lines).strip('\n'))
@@ -0,0 +1,273 @@
+"""
+python -c "import doctest, cyth; print(doctest.testmod(cyth.cyth_record))"
+
+Records the argument types of selected functions while a representative
+workload runs, so their #CYTH_PARAM_TYPES do not have to be written by hand:
+
+    import cyth
+    from vtool import keypoint
+    with cyth.record_types(keypoint.get_invVR_mats_sqrd_scale):
+        run_workload()  # with --nocyth, so the python functions are called
+
+Calls are watched through sys.setprofile (in the recording thread only). For
+each argument the python type is recorded, and for ndarrays also the dtype,
+ndim and contiguity. When recording stops the observations are merged into a
+sidecar file next to each module (_<name>_cyth_types.json), so several
+workloads add up. translate reads the sidecar as a type source of lower
+precedence than the docstring markup and annotations, and a function with
+recorded types is cythonized even without markup (methods only in classes
+with cyth markup, see cyth_parser.visit_toplevel_class).
+
+To print the inferred blocks (e.g. to move them into the docstrings):
+
+    python -m cyth.cyth_record ~/code/vtool/vtool/keypoint.py
+"""
+from __future__ import absolute_import, division, print_function
+from contextlib import contextmanager
+from os.path import exists
+import json
+import sys
+import six
+import utool
+from cyth import cyth_cache
+from cyth import cyth_helpers
+
+# Bump when the layout of the sidecar files changes
+SIDECAR_VERSION = 1
+# Python types that cython can declare as such
+DECLARABLE_OBJECT_TYPES = ['tuple', 'list', 'dict', 'set', 'str', 'bytes', 'unicode']
+# ndarray dtypes with a np.<name>_t ctypedef
+NUMPY_CTYPE_DTYPES = ['int8', 'int16', 'int32', 'int64', 'uint8', 'uint16', 'uint32',
+                      'uint64', 'float32', 'float64', 'complex64', 'complex128']
+
+# py_fpath -> {recorded function name: {argument name: set of observations}}
+_OBSERVATIONS = {}
+
+
+def describe_value(value):
+    """
+    Returns the observation of an argument value as a tuple: ('ndarray',
+    dtype, ndim, mode) for numpy arrays, otherwise ('type', type name)
+
+    >>> from cyth.cyth_record import *  # NOQA
+    >>> import numpy as np
+    >>> describe_value(np.zeros((3, 4))[:, ::2])
+    ('ndarray', 'float64', 2, 'strided')
+    >>> describe_value(np.zeros((3, 4), order='F'))
+    ('ndarray', 'float64', 2, 'fortran')
+    >>> describe_value(1.5), describe_value(True)
+    (('type', 'float'), ('type', 'bool'))
+    """
+    numpy = sys.modules.get('numpy', None)
+    if numpy is not None and isinstance(value, numpy.ndarray):
+        if value.flags.c_contiguous:
+            mode = 'c'
+        elif value.flags.f_contiguous:
+            mode = 'fortran'
+        else:
+            mode = 'strided'
+        return ('ndarray', value.dtype.name, value.ndim, mode)
+    if numpy is not None and isinstance(value, numpy.generic):
+        # numpy scalars are used like the python ones
+        value = value.item()
+    return ('type', type(value).__name__)
+
+
+def observation_to_ctype(observation, with_mode=True):
+    """
+    Returns the type cyth declares for an observation, or None if it is left
+    undeclared
+
+    >>> from cyth.cyth_record import *  # NOQA
+    >>> observation_to_ctype(('ndarray', 'float64', 2, 'c'))
+    'np.ndarray[np.float64_t, ndim=2, mode="c"]'
+    >>> observation_to_ctype(('ndarray', 'float64', 2, 'c'), with_mode=False)
+    'np.ndarray[np.float64_t, ndim=2]'
+    >>> observation_to_ctype(('type', 'int')), observation_to_ctype(('type', 'Foo'))
+    ('Py_ssize_t', None)
+    """
+    if observation[0] == 'ndarray':
+        _, dtype, ndim, mode = observation
+        if dtype not in NUMPY_CTYPE_DTYPES:
+            return 'np.ndarray'
+        mode_string = ', mode="%s"' % (mode,) if with_mode and mode != 'strided' else ''
+        return 'np.ndarray[np.%s_t, ndim=%d%s]' % (dtype, ndim, mode_string)
+    type_name = observation[1]
+    if type_name == 'float':
+        return 'double'
+    if type_name in ['int', 'long']:
+        return 'Py_ssize_t'
+    if type_name == 'bool':
+        return 'bint'
+    if type_name in DECLARABLE_OBJECT_TYPES:
+        return type_name
+    return None
+
+
+def infer_ctype(observations):
+    """
+    Returns the type that fits every observation of an argument, or None.
+    Arrays seen with different contiguity are declared strided; arguments
+    seen with different types are left undeclared.
+
+    >>> from cyth.cyth_record import *  # NOQA
+    >>> infer_ctype([('ndarray', 'float64', 1, 'c'), ('ndarray', 'float64', 1, 'strided')])
+    'np.ndarray[np.float64_t, ndim=1]'
+    >>> print(infer_ctype([('type', 'int'), ('type', 'float')]))
+    None
+    """
+    for with_mode in [True, False]:
+        ctypes = set(observation_to_ctype(tuple(observation), with_mode)
+                     for observation in observations)
+        if len(ctypes) == 1:
+            return ctypes.pop()
+    return None
+
+
+def get_recorded_name(func):
+    """ the name the observations of func are stored under (Class.method for methods) """
+    # python 2 methods know their class, python 3 functions their qualname
+    im_class = getattr(func, 'im_class', None)
+    func = getattr(func, '__func__', func)
+    if im_class is not None:
+        return im_class.__name__ + '.' + func.__name__
+    return getattr(func, '__qualname__', func.__name__)
+
+
+def get_arg_names(code):
+    num_args = code.co_argcount + getattr(code, 'co_kwonlyargcount', 0)
+    return code.co_varnames[:num_args]
+
+
+@contextmanager
+def record_types(*funcs, **kwargs):
+    """
+    Records the argument types of each call to funcs in the enclosed block
+
+    Kwargs:
+        save (bool): merge the observations into the sidecar files of the
+            modules of funcs afterwards (default True)
+
+    >>> from cyth.cyth_record import *  # NOQA
+    >>> from cyth import cyth_record
+    >>> def foo(x, n=1):
+    ...     return x * n
+    >>> with record_types(foo, save=False):
+    ...     _ = foo(2.5, 3), foo(1.0)
+    >>> observations = cyth_record._OBSERVATIONS.pop(six.get_function_code(foo).co_filename)
+    >>> sorted((name, sorted(obs)) for name, obs in observations['foo'].items())
+    [('n', [('type', 'int')]), ('x', [('type', 'float')])]
+    """
+    save = kwargs.get('save', True)
+    recorded_names = {six.get_function_code(getattr(func, '__func__', func)):
+                      get_recorded_name(func) for func in funcs}
+
+    def profile_func(frame, event, arg):
+        if event != 'call':
+            return
+        code = frame.f_code
+        recorded_name = recorded_names.get(code, None)
+        if recorded_name is None:
+            return
+        func_observations = _OBSERVATIONS.setdefault(
+            code.co_filename, {}).setdefault(recorded_name, {})
+        for name in get_arg_names(code):
+            observation = describe_value(frame.f_locals[name])
+            func_observations.setdefault(name, set([])).add(observation)
+
+    previous = sys.getprofile()
+    sys.setprofile(profile_func)
+    try:
+        yield
+    finally:
+        sys.setprofile(previous)
+        if save:
+            save_observations()
+
+
+def get_py_fpath(co_filename):
+    """ the source file of a code object (which may name the .pyc) """
+    if co_filename.endswith(('.pyc', '.pyo')):
+        return co_filename[:-1]
+    return co_filename
+
+
+def load_sidecar(py_fpath):
+    """ Returns {recorded function name: {argument name: [observations]}} """
+    sidecar_fpath = cyth_helpers.get_cyth_types_path(py_fpath)
+    if exists(sidecar_fpath):
+        try:
+            with open(sidecar_fpath, 'r') as file_:
+                sidecar = json.load(file_)
+            if sidecar.get('version') == SIDECAR_VERSION:
+                return sidecar['functions']
+        except (ValueError, KeyError):
+            pass
+    return {}
+
+
+def save_observations():
+    """ Merges and clears the observations gathered in this process """
+    for co_filename, observations in list(_OBSERVATIONS.items()):
+        py_fpath = get_py_fpath(co_filename)
+        if not exists(py_fpath):
+            continue
+        sidecar_fpath = cyth_helpers.get_cyth_types_path(py_fpath)
+        with cyth_cache.cache_lock(sidecar_fpath):
+            functions = load_sidecar(py_fpath)
+            for recorded_name, arg_observations in six.iteritems(observations):
+                func_dict = functions.setdefault(recorded_name, {})
+                for name, observation_set in six.iteritems(arg_observations):
+                    merged = set(map(tuple, func_dict.get(name, [])))
+                    merged.update(observation_set)
+                    func_dict[name] = sorted(map(list, merged))
+            text = json.dumps({'version': SIDECAR_VERSION, 'functions': functions},
+                              indent=1, sort_keys=True)
+            cyth_cache.write_if_changed(sidecar_fpath, text, verbose=False)
+        print('[cyth.record] recorded types in %s' % (sidecar_fpath,))
+    _OBSERVATIONS.clear()
+
+
+def load_recorded_types(py_fpath):
+    """
+    Returns {recorded function name: typedict} of the arguments whose type
+    could be inferred from the sidecar of py_fpath
+    """
+    recorded_types = {}
+    for recorded_name, arg_observations in six.iteritems(load_sidecar(py_fpath)):
+        typedict = {}
+        for name, observations in six.iteritems(arg_observations):
+            type_ = infer_ctype(observations)
+            if type_ is not None:
+                typedict[name] = type_
+        if len(typedict) > 0:
+            recorded_types[recorded_name] = typedict
+    return recorded_types
+
+
+def format_param_types(typedict, indent_with=' ' * 4):
+    """
+    >>> from cyth.cyth_record import *  # NOQA
+    >>> typedict = {'x': 'np.ndarray[np.float64_t, ndim=2]', 'n': 'Py_ssize_t'}
+    >>> print(format_param_types(typedict))
+    #CYTH_PARAM_TYPES:
+        Py_ssize_t n
+        np.ndarray[np.float64_t, ndim=2] x
+    """
+    lines = ['#CYTH_PARAM_TYPES:']
+    lines += [indent_with + type_ + ' ' + name for name, type_ in sorted(six.iteritems(typedict))]
+    return '\n'.join(lines)
+
+
+def print_recorded_types(py_fpath):
+    recorded_types = load_recorded_types(py_fpath)
+    if len(recorded_types) == 0:
+        print('[cyth.record] no recorded types for %s' % (py_fpath,))
+    for recorded_name, typedict in sorted(recorded_types.items()):
+        print('%s:' % (recorded_name,))
+        print(utool.indent(format_param_types(typedict)))
+
+
+if __name__ == '__main__':
+    for py_fpath in utool.get_fpath_args(sys.argv[1:], pat='*.py'):
+        print_recorded_types(utool.unixpath(py_fpath))
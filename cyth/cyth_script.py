@@ -6,6 +6,8 @@ ut
 python cyth/cyth_script.py ~/code/fpath
 cyth_script.py ~/code/ibeis/ibeis/model/hots
 cyth_script.py "~/code/vtool/vtool"
+cyth_script.py --watch --build
+cyth_script.py ~/code/vtool/vtool --build --cyth-profile
 
 """
 from __future__ import absolute_import, division, print_function
@@ -16,9 +18,15 @@ import os
 from os.path import isfile
 from cyth import cyth_helpers
 from cyth import cyth_parser
+from cyth import cyth_cache
+from cyth import cyth_build
+from cyth import cyth_profile
 from cyth import cyth_benchmarks
+from cyth import cyth_record
+from cyth.cyth_decorators import MACRO_EXPANDERS_DICT
 import ast
 import astor
+import json
 BASE_CLASS = astor.codegen.SourceGenerator
 
 
@@ -27,66 +35,205 @@ BASE_CLASS = astor.codegen.SourceGenerator
 CYTHON_HTML = '--annotate' in sys.argv or '-a' in sys.argv
 CYTHON_MAKE_C = '--makec' in sys.argv
 CYTHON_BUILD = '--build' in sys.argv
+# Retranslate even if the translation manifest says nothing changed
+CYTH_FORCE = '--force' in sys.argv
+# Do not reuse extensions from the shared compiled-extension cache
+CYTH_EXT_CACHE = '--no-ext-cache' not in sys.argv
+# Number of worker processes used to translate files
+CYTH_JOBS = utool.get_argval(('--jobs', '-j'), type_=int, default=1)
+# Keep running and retranslate files as they change (see cyth_watch)
+CYTH_WATCH = '--watch' in sys.argv
+# Declare np.ndarray buffers as typed memoryviews
+CYTH_MEMVIEW = '--memview' in sys.argv
+# Emit cyth functions only called by other cyth functions as cdef
+CYTH_DEMOTE = '--no-demote' not in sys.argv
 
 
-def translate_fpath(py_fpath):
+def get_translation_options():
+    """ options that change what translate_fpath produces """
+    # Build flags are not listed here; the build stage decides for itself
+    # whether an extension module is out of date.
+    options = {
+        'memview': CYTH_MEMVIEW,
+        'demote': CYTH_DEMOTE,
+    }
+    return options
+
+
+def translate_fpath(py_fpath, manifest=None, new_entries=None):
     """ creates a cython pyx file from a python file with cyth tags
+
+    Args:
+        manifest (dict): the translation manifest (loaded if None)
+        new_entries (dict): collects the manifest entry of the translation.
+            If None the entry is saved to the manifest right away.
+
     >>> from cyth.cyth_script import *  # NOQA
     >>> py_fpath = utool.unixpath('~/code/vtool/vtool/linalg.py')
     """
-    # If -a is given, generate cython html for each pyx file
     # Get cython pyx and benchmark output path
     cy_pyxpath = cyth_helpers.get_cyth_path(py_fpath)
     cy_pxdpath = cyth_helpers.get_cyth_pxd_path(py_fpath)
     cy_benchpath = cyth_helpers.get_cyth_bench_path(py_fpath)
     # Infer the python module name
     py_modname = cyth_helpers.get_py_module_name(py_fpath)
-    # Read the python file
-    py_text = utool.read_from(py_fpath, verbose=False)
-    # dont parse files without tags
-    if py_text.find('CYTH') == -1:
-        return None
+    with cyth_profile.phase('read', py_fpath):
+        # dont read or parse files without tags
+        if not cyth_cache.has_cyth_tag(py_fpath):
+            return None
+        # Read the python file
+        py_text = utool.read_from(py_fpath, verbose=False)
+        # argument types recorded by cyth.record_types are a type source too
+        recorded_types = cyth_record.load_recorded_types(py_fpath)
+        # dont retranslate files that have not changed since the last run
+        options = get_translation_options()
+        options['recorded_types'] = json.dumps(recorded_types, sort_keys=True)
+        translation_key = cyth_cache.get_translation_key(
+            py_text, py_modname, options)
+        if manifest is None:
+            manifest = cyth_cache.load_manifest()
+        if not CYTH_FORCE and cyth_cache.is_translation_current(manifest, py_fpath,
+                                                                translation_key):
+            print('[cyth.translate_fpath] up to date: %r' % py_fpath)
+            return cy_benchpath
+        # unchanged functions reuse their results from the last translation
+        context_key = cyth_cache.get_function_cache_context(
+            py_modname, options, MACRO_EXPANDERS_DICT.keys())
+        if CYTH_FORCE:
+            function_cache = None
+        else:
+            function_cache = cyth_cache.load_function_cache(py_modname, context_key)
     print('\n___________________')
     print('[cyth.translate_fpath] py_fpath=%r' % py_fpath)
     # Parse the python file
-    visitor = cyth_parser.CythVisitor(py_modname=py_modname)
-    visitor.visit(ast.parse(py_text))
-    # Get the generated pyx file and benchmark file
-    pyx_text, pxd_text = visitor.get_result()
-    bench_text = visitor.get_benchmarks()
-    # Write pyx and benchmark
-    utool.write_to(cy_pyxpath, pyx_text)
-    utool.write_to(cy_pxdpath, pxd_text, verbose=False)
-    utool.write_to(cy_benchpath, bench_text, verbose=False)
-    if CYTHON_HTML:
-        print('[cyth.translate_fpath] generating annotation html')
-        cython_exe = utool.get_cython_exe()
-        os.system(cython_exe + ' -a ' + cy_pyxpath)
-    if CYTHON_MAKE_C:
-        print('[cyth.translate_fpath] generating cython c')
-        cython_exe = utool.get_cython_exe()
-        os.system(cython_exe + ' ' + cy_pyxpath)
-    if CYTHON_BUILD:
-        gcc_exe = 'gcc'
-        print('[cyth.translate_fpath] generating c library')
-        c_path = cyth_helpers.get_c_path(cy_pyxpath)
-        #C:\MinGW\bin\gcc.exe -w -Wall -m32 -lpython27 -IC:\Python27\Lib\site-packages\numpy\core\include -IC:\Python27\include -IC:\Python27\PC -IC:\Python27\Lib\site-packages\numpy\core\include -LC:\Python27\libs -o _linalg_cyth.pyd -c _linalg_cyth.c
-        os.system(gcc_exe + ' ' + c_path)
+    with cyth_profile.phase('parse', py_fpath):
+        module_node = ast.parse(py_text)
+    with cyth_profile.phase('emit', py_fpath):
+        visitor = cyth_parser.CythVisitor(py_modname=py_modname, py_text=py_text,
+                                          function_cache=function_cache,
+                                          memview=options['memview'],
+                                          demote=options['demote'],
+                                          recorded_types=recorded_types)
+        visitor.visit(module_node)
+        # Get the generated pyx file and benchmark file
+        pyx_text, pxd_text = visitor.get_result()
+        bench_text = visitor.get_benchmarks()
+    with cyth_profile.phase('write', py_fpath):
+        # Write pyx and benchmark (identical outputs are left untouched)
+        cyth_cache.write_if_changed(cy_pyxpath, pyx_text)
+        cyth_cache.write_if_changed(cy_pxdpath, pxd_text, verbose=False)
+        cyth_cache.write_if_changed(cy_benchpath, bench_text, verbose=False)
+        # other modules can only cimport the pxd from within a package layout
+        for init_pxdpath in cyth_helpers.get_package_init_pxd_paths(py_modname):
+            init_pypath = os.path.splitext(init_pxdpath)[0] + '.py'
+            if os.path.exists(init_pypath) and not os.path.exists(init_pxdpath):
+                utool.write_to(init_pxdpath, '', verbose=False)
+        entry = cyth_cache.get_translation_entry(translation_key,
+                                                 [cy_pyxpath, cy_pxdpath, cy_benchpath])
+        if new_entries is None:
+            cyth_cache.record_translations({py_fpath: entry})
+        else:
+            new_entries[py_fpath] = entry
+        cyth_cache.save_function_cache(py_modname, context_key,
+                                       visitor.get_function_cache())
     return cy_benchpath
 
 
-def translate(*paths):
-    """ Translates a list of paths """
+# the translation manifest as loaded by the parent of a translation worker
+_worker_manifest = None
+
 
-    cy_bench_list = []
-    for fpath in paths:
-        if isfile(fpath):
-            abspath = utool.unixpath(fpath)
-            cy_bench = translate_fpath(abspath)
-            if cy_bench is not None:
-                cy_bench_list.append(cy_bench)
+def _init_translate_worker(macro_expanders, manifest):
+    """
+    Registers the parent's macros in a translation worker. Macros registered
+    by user code at runtime are not visible to freshly spawned processes.
+    Gensym counters need no syncing: each CythVisitor makes its own.
+    """
+    global _worker_manifest
+    MACRO_EXPANDERS_DICT.update(macro_expanders)
+    _worker_manifest = manifest
+
+
+def _translate_fpath_worker(py_fpath):
+    """
+    translate_fpath for pool workers; also sends back their manifest entries
+    and timings
+    """
+    new_entries = {}
+    cy_bench = translate_fpath(py_fpath, _worker_manifest, new_entries)
+    return cy_bench, new_entries, cyth_profile.pop_timings()
+
+
+def translate_fpath_list(abspath_list, jobs=1):
+    """
+    Runs translate_fpath over abspath_list using jobs processes. Returns the
+    results in the same order as abspath_list.
 
-    if len(cy_bench_list) > 0:
+    The translation manifest is read once up front, and the entries of the
+    translated files are added to it in one write at the end.
+    """
+    manifest = cyth_cache.load_manifest()
+    new_entries = {}
+    if jobs <= 1 or len(abspath_list) <= 1:
+        result_list = [translate_fpath(py_fpath, manifest, new_entries)
+                       for py_fpath in abspath_list]
+    else:
+        import multiprocessing
+        jobs = min(jobs, len(abspath_list))
+        print('[cyth] translating %d files with %d processes' % (len(abspath_list), jobs))
+        pool = multiprocessing.Pool(jobs, initializer=_init_translate_worker,
+                                    initargs=(dict(MACRO_EXPANDERS_DICT), manifest))
+        try:
+            worker_results = pool.map(_translate_fpath_worker, abspath_list)
+        finally:
+            pool.close()
+            pool.join()
+        result_list = []
+        for cy_bench, worker_entries, timings in worker_results:
+            cyth_profile.merge_timings(timings)
+            new_entries.update(worker_entries)
+            result_list.append(cy_bench)
+    cyth_cache.record_translations(new_entries)
+    return result_list
+
+
+def translate(*paths, **kwargs):
+    """ Translates a list of paths
+
+    Kwargs:
+        jobs (int): number of processes to translate with (default --jobs)
+        write_runbench (bool): write the run_cyth_benchmarks scripts (default True)
+        exit_on_failure (bool): exit with status 1 if any module fails to
+            build (default True)
+
+    Returns:
+        list: benchmark paths of the tagged files
+    """
+    jobs = kwargs.get('jobs', CYTH_JOBS)
+    write_runbench = kwargs.get('write_runbench', True)
+    exit_on_failure = kwargs.get('exit_on_failure', True)
+    num_failed = 0
+    abspath_list = [utool.unixpath(fpath) for fpath in paths if isfile(fpath)]
+    # Only tagged files are worth a worker; most files cost just a stat()
+    abspath_list = cyth_cache.filter_tagged_fpaths(abspath_list)
+    result_list = translate_fpath_list(abspath_list, jobs)
+    cy_bench_list = [cy_bench for cy_bench in result_list if cy_bench is not None]
+
+    if len(cy_bench_list) > 0 and (CYTHON_HTML or CYTHON_MAKE_C or CYTHON_BUILD):
+        # If -a is given, generate cython html for each pyx file
+        built_fpath_list = [py_fpath for py_fpath, cy_bench in zip(abspath_list, result_list)
+                            if cy_bench is not None]
+        cy_pyxpath_list = list(map(cyth_helpers.get_cyth_path, built_fpath_list))
+        status_list = cyth_build.build_pyx_list(
+            cy_pyxpath_list, jobs=jobs, make_ext=CYTHON_BUILD,
+            annotate=CYTHON_HTML, force=CYTH_FORCE, use_cache=CYTH_EXT_CACHE)
+        # the builders time themselves (possibly in other processes)
+        for py_fpath, status in zip(built_fpath_list, status_list):
+            cyth_profile.record(py_fpath, 'cython', status['cython_time'])
+            cyth_profile.record(py_fpath, 'cc', status['cc_time'])
+        num_failed = cyth_build.count_failed(status_list)
+
+    if len(cy_bench_list) > 0 and write_runbench:
         runbench_shtext = cyth_benchmarks.build_runbench_shell_text(cy_bench_list)
         runbench_pytext = cyth_benchmarks.build_runbench_pyth_text(cy_bench_list)
 
@@ -97,6 +244,14 @@ def translate(*paths):
         os.chmod('run_cyth_benchmarks.py', 33277)
         #except OSError:
         #    pass
+    # each call reports its own timings (watch mode translates repeatedly)
+    timings = cyth_profile.pop_timings()
+    if cyth_profile.PROFILE:
+        cyth_profile.dump_profile(timings)
+        cyth_profile.print_profile_summary(timings)
+    if num_failed > 0 and exit_on_failure:
+        sys.exit(1)
+    return cy_bench_list
 
 
 # TODO: append following formated text to end of cythonized files if it is not
@@ -113,8 +268,8 @@ def translate(*paths):
 '''
 
 
-def translate_all():
-    """ Translates a all python paths in directory """
+def find_moduledir_fpaths():
+    """ Returns all python files in the module directories under the cwd """
     dpaths = utool.ls_moduledirs('.')
     #print('[cyth] translate_all: %r' % (dpaths,))
 
@@ -128,7 +283,13 @@ def translate_all():
                    for dpath in dpaths]
     fpath_iter = utool.iflatten(fpaths_iter)
     abspath_iter = map(utool.unixpath, fpath_iter)
-    fpath_list = list(set(list(abspath_iter)))
+    fpath_list = sorted(set(list(abspath_iter)))
+    return fpath_list
+
+
+def translate_all():
+    """ Translates a all python paths in directory """
+    fpath_list = find_moduledir_fpaths()
     #print('[cyth] translate_all: %s' % ('\n'.join(fpath_list),))
     # Try to translate each
     translate(*fpath_list)
@@ -141,6 +302,10 @@ def translate_all():
 
 if __name__ == '__main__':
     print('[cyth] main')
+    if CYTH_WATCH:
+        from cyth import cyth_watch
+        cyth_watch.watch()
+        sys.exit(0)
     input_path_list = utool.get_fpath_args(sys.argv[1:], pat='*.py')
     print(input_path_list)
     print('[cyth] nInput=%d' % (len(input_path_list,)))
@@ -0,0 +1,253 @@
+"""
+python -c "import doctest, cyth; print(doctest.testmod(cyth.cyth_watch))"
+
+Watch mode for cyth_script:
+
+    cyth_script.py --watch --build
+
+Polls the python files in the module directories found by translate_all,
+and the types recorded for them (see cyth_record). When a burst of saves has
+settled, every file whose CYTH-tagged content or recorded types changed is
+retranslated (see get_tagged_signature) (and rebuilt if --build is given). After a rebuild
+its benchmarks are rerun and the change in timings is printed; with
+--build, the benchmarks of the already built files are run when watching
+starts, so the first change has timings to compare with.
+"""
+from __future__ import absolute_import, division, print_function
+from os.path import exists, join
+import ast
+import json
+import os
+import subprocess
+import sys
+import time
+import utool
+from cyth import cyth_analysis
+from cyth import cyth_build
+from cyth import cyth_cache
+from cyth import cyth_helpers
+from cyth import cyth_record
+from cyth import cyth_script
+
+# Seconds between polls of the watched files
+WATCH_INTERVAL = utool.get_argval('--watch-interval', type_=float, default=.5)
+# Seconds without further changes before a burst of saves is processed
+WATCH_DEBOUNCE = utool.get_argval('--watch-debounce', type_=float, default=1.)
+BENCH_ITERATIONS = utool.get_argval(('--iterations', '-n'), type_=int, default=100)
+
+
+def stat_fpaths(fpath_list):
+    """ Returns {fpath: (mtime, size)} for each existing file in fpath_list """
+    stat_dict = {}
+    for fpath in fpath_list:
+        try:
+            st = os.stat(fpath)
+        except OSError:
+            continue
+        stat_dict[fpath] = (st.st_mtime, st.st_size)
+    return stat_dict
+
+
+def get_watched_fpaths():
+    """
+    Returns {watched path: python file} for the python files in the module
+    directories and their recorded types (see cyth_record)
+    """
+    watched_dict = {}
+    for fpath in cyth_script.find_moduledir_fpaths():
+        watched_dict[fpath] = fpath
+        watched_dict[cyth_helpers.get_cyth_types_path(fpath)] = fpath
+    return watched_dict
+
+
+def get_changed_fpaths(stat_dict, new_stat_dict):
+    """ paths whose stats differ, including created and deleted files """
+    return [fpath for fpath in set(stat_dict) | set(new_stat_dict)
+            if stat_dict.get(fpath) != new_stat_dict.get(fpath)]
+
+
+def has_annotations(node):
+    """ True if a function in node annotates an argument or its return """
+    for subnode in ast.walk(node):
+        if isinstance(subnode, ast.FunctionDef):
+            args = subnode.args.args + getattr(subnode.args, 'kwonlyargs', [])
+            if (getattr(subnode, 'returns', None) is not None or
+                    any(getattr(arg, 'annotation', None) is not None for arg in args)):
+                return True
+    return False
+
+
+def is_tagged_node(node, source, recorded_names):
+    """
+    True if translation may use the code of a top-level function or class:
+    it has cyth tags, annotations or recorded types
+    """
+    if node.name in recorded_names or has_annotations(node):
+        return True
+    if not isinstance(source, bytes):
+        source = source.encode('utf8')
+    return cyth_cache.CYTH_TAG_REGEX.search(source) is not None
+
+
+def get_tagged_signature(fpath):
+    """
+    Hash of what translating the file depends on if it has cyth tags,
+    otherwise None: its tagged functions and classes, its other top-level
+    statements and its recorded types (see cyth_record). Of the untagged
+    functions and classes only the names count, and the tagged functions they
+    use (which decide what is demoted), so editing them changes nothing.
+
+    >>> from cyth.cyth_watch import *  # NOQA
+    >>> import shutil, tempfile
+    >>> dpath = tempfile.mkdtemp()
+    >>> fpath = join(dpath, 'foo.py')
+    >>> tagged = 'def foo(x):\\n    #CYTH_INLINE\\n    return x\\n'
+    >>> def signature(text):
+    ...     utool.write_to(fpath, text, verbose=False)
+    ...     return get_tagged_signature(fpath)
+    >>> base = signature(tagged + 'def bar():\\n    return 1\\n')
+    >>> base == signature(tagged + 'def bar():\\n    return 2\\n')
+    True
+    >>> base == signature(tagged + 'def bar():\\n    return foo(2)\\n')
+    False
+    >>> base == signature(tagged.replace('x', 'y') + 'def bar():\\n    return 1\\n')
+    False
+    >>> print(signature('def bar():\\n    return 1\\n'))
+    None
+    >>> shutil.rmtree(dpath)
+    """
+    if not exists(fpath) or not cyth_cache.has_cyth_tag(fpath):
+        return None
+    py_text = utool.read_from(fpath, verbose=False)
+    types_fpath = cyth_helpers.get_cyth_types_path(fpath)
+    types_text = utool.read_from(types_fpath, verbose=False) if exists(types_fpath) else ''
+    try:
+        module_node = ast.parse(py_text)
+    except SyntaxError:
+        # translating reports the error; fixing it is a change
+        return cyth_cache.hash_text(py_text + types_text)
+    recorded_names = set(name.split('.')[0] for name in cyth_record.load_sidecar(fpath))
+    sources = cyth_analysis.get_toplevel_sources(module_node, py_text)
+    tagged_nodes = set(node for node, source in sources.items()
+                       if is_tagged_node(node, source, recorded_names))
+    tagged_names = set(node.name for node in tagged_nodes)
+    parts = [types_text]
+    for node in module_node.body:
+        if node in tagged_nodes:
+            parts.append(sources[node])
+        elif node in sources:
+            used_names = set(subnode.id for subnode in ast.walk(node)
+                             if isinstance(subnode, ast.Name))
+            parts.append(' '.join([node.name] + sorted(used_names & tagged_names)))
+        else:
+            parts.append(ast.dump(node))
+    return cyth_cache.hash_text('\n'.join(parts))
+
+
+def run_benchmark_module(cy_benchpath, iterations=BENCH_ITERATIONS):
+    """
+    Runs a generated benchmark module in a fresh interpreter (so the newly
+    built extension is the one imported) and returns its list of
+    (python_time, cython_time) pairs, or None if it failed.
+    """
+    bench_modname = cyth_helpers.get_py_module_name(cy_benchpath)
+    runner = utool.unindent('''
+        import json
+        import {bench_modname} as bench
+        results = bench.run_all_benchmarks({iterations})
+        print(json.dumps([(pyth_time, cyth_time) for pyth_time, cyth_time, _ in results]))
+        ''').format(bench_modname=bench_modname, iterations=iterations)
+    proc = subprocess.Popen([sys.executable, '-c', runner],
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    out, _ = proc.communicate()
+    out = out.decode('utf8')
+    if proc.returncode != 0:
+        print('[cyth.watch] benchmarks failed for %s' % (bench_modname,))
+        print(out)
+        return None
+    return [tuple(pair) for pair in json.loads(out.strip().split('\n')[-1])]
+
+
+def print_benchmark_deltas(cy_benchpath, old_results, new_results):
+    bench_modname = cyth_helpers.get_py_module_name(cy_benchpath)
+    print('[cyth.watch] benchmarks for %s' % (bench_modname,))
+    for ix, (pyth_time, cyth_time) in enumerate(new_results):
+        line = '    test %d: python=%fs cython=%fs' % (ix, pyth_time, cyth_time)
+        if old_results is not None and ix < len(old_results):
+            old_cyth_time = old_results[ix][1]
+            if old_cyth_time > 0:
+                pcnt = (cyth_time - old_cyth_time) / old_cyth_time * 100
+                line += ' (was %fs, %+.1f%%)' % (old_cyth_time, pcnt)
+        print(line)
+
+
+def run_baseline_benchmarks(fpath_list):
+    """ Returns {benchmark path: results} for the built files in fpath_list """
+    bench_results = {}
+    for fpath in fpath_list:
+        cy_benchpath = cyth_helpers.get_cyth_bench_path(fpath)
+        ext_fpath = cyth_build.get_ext_path(cyth_helpers.get_cyth_path(fpath))
+        if not (exists(cy_benchpath) and exists(ext_fpath)):
+            continue
+        results = run_benchmark_module(cy_benchpath)
+        if results is not None:
+            bench_results[cy_benchpath] = results
+    return bench_results
+
+
+def retranslate(fpath_list, bench_results):
+    """ Retranslates (and rebuilds) fpath_list and reruns their benchmarks """
+    print('[cyth.watch] retranslating %d changed files' % (len(fpath_list),))
+    cy_bench_list = cyth_script.translate(*fpath_list, write_runbench=False,
+                                           exit_on_failure=False)
+    if not cyth_script.CYTHON_BUILD:
+        return
+    for cy_benchpath in cy_bench_list:
+        new_results = run_benchmark_module(cy_benchpath)
+        if new_results is not None:
+            print_benchmark_deltas(cy_benchpath, bench_results.get(cy_benchpath),
+                                   new_results)
+            bench_results[cy_benchpath] = new_results
+
+
+def watch(interval=WATCH_INTERVAL, debounce=WATCH_DEBOUNCE):
+    """ Watches the module directories until interrupted """
+    watched_dict = get_watched_fpaths()
+    stat_dict = stat_fpaths(watched_dict)
+    fpath_list = sorted(set(watched_dict.values()))
+    signature_dict = {fpath: get_tagged_signature(fpath) for fpath in fpath_list}
+    bench_results = {}
+    if cyth_script.CYTHON_BUILD:
+        print('[cyth.watch] running the benchmarks of the built files')
+        bench_results = run_baseline_benchmarks(
+            [fpath for fpath in fpath_list if signature_dict[fpath] is not None])
+    pending = set([])
+    last_change = None
+    print('[cyth.watch] watching %d files (Ctrl+C to stop)' % (len(fpath_list),))
+    try:
+        while True:
+            time.sleep(interval)
+            # relist every poll so new files are picked up
+            new_watched_dict = get_watched_fpaths()
+            new_stat_dict = stat_fpaths(new_watched_dict)
+            changed = [new_watched_dict.get(fpath, watched_dict.get(fpath))
+                       for fpath in get_changed_fpaths(stat_dict, new_stat_dict)]
+            watched_dict, stat_dict = new_watched_dict, new_stat_dict
+            if len(changed) > 0:
+                pending.update(changed)
+                last_change = time.time()
+                continue
+            if len(pending) == 0 or time.time() - last_change < debounce:
+                continue
+            # the burst has settled; only tagged content changes matter
+            retranslate_list = []
+            for fpath in sorted(pending):
+                signature = get_tagged_signature(fpath)
+                if signature is not None and signature != signature_dict.get(fpath):
+                    retranslate_list.append(fpath)
+                signature_dict[fpath] = signature
+            pending = set([])
+            if len(retranslate_list) > 0:
+                retranslate(retranslate_list, bench_results)
+    except KeyboardInterrupt:
+        print('[cyth.watch] stopped')
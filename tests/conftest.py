@@ -0,0 +1,55 @@
+"""
+Fixtures for the behaviour tests. Each test gets a fresh working directory
+holding an empty package named 'pkg' (cyth computes module names and keeps
+its caches relative to the working directory).
+
+    python -m pytest tests
+"""
+from __future__ import absolute_import, division, print_function
+from os.path import join
+import sys
+import textwrap
+import pytest
+import utool
+from cyth import cyth_build
+from cyth import cyth_helpers
+from cyth import cyth_profile
+from cyth import cyth_script
+
+
+@pytest.fixture
+def workdir(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    monkeypatch.syspath_prepend(str(tmpdir))
+    monkeypatch.setenv('CYTH_EXT_CACHE_DIR', str(tmpdir.join('ext_cache')))
+    monkeypatch.setattr(cyth_script, 'CYTH_FORCE', False)
+    tmpdir.mkdir('pkg').join('__init__.py').write('')
+    yield str(tmpdir)
+    for modname in list(sys.modules):
+        if modname == 'pkg' or modname.startswith('pkg.'):
+            del sys.modules[modname]
+    cyth_profile.pop_timings()
+
+
+def write_module(workdir, name, text):
+    """ writes pkg/<name>.py and returns its path """
+    py_fpath = join(workdir, 'pkg', name + '.py')
+    utool.write_to(py_fpath, textwrap.dedent(text).lstrip('\n'), verbose=False)
+    return py_fpath
+
+
+def read_pyx(py_fpath):
+    return utool.read_from(cyth_helpers.get_cyth_path(py_fpath), verbose=False)
+
+
+def build(py_fpath, **kwargs):
+    """ compiles the translation of py_fpath and returns its build status """
+    status = cyth_build.build_pyx(cyth_helpers.get_cyth_path(py_fpath), **kwargs)
+    assert status['error'] is None, status['error']
+    return status
+
+
+def import_module(name):
+    """ imports pkg.<name> after its extension was built """
+    __import__('pkg.' + name)
+    return sys.modules['pkg.' + name]
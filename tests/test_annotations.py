@@ -0,0 +1,49 @@
+from __future__ import absolute_import, division, print_function
+import sys
+import pytest
+from cyth import cyth_script
+from conftest import write_module, read_pyx, build, import_module
+
+pytestmark = pytest.mark.skipif(sys.version_info[0] < 3,
+                                reason='annotations need python 3')
+
+ANNOTATED_MODULE = '''
+import cython
+import numpy as np
+
+
+def total(x: 'double[:, ::1]', n: cython.Py_ssize_t, scale: float = 1.0) -> cython.double:
+    t: cython.double = 0.0
+    for i in range(n):
+        t += x[i, 0] * scale
+    return t
+
+
+def untyped(x: int):
+    return x
+
+
+import cyth
+exec(cyth.import_cyth_execstr(__name__))
+'''
+
+
+def test_annotations_declare_types(workdir):
+    py_fpath = write_module(workdir, 'ann', ANNOTATED_MODULE)
+    assert cyth_script.translate_fpath(py_fpath) is not None
+    pyx_text = read_pyx(py_fpath)
+    assert 'cpdef double _total_cyth(double[:, ::1] x, Py_ssize_t n, scale=' in pyx_text
+    assert '        double t\n' in pyx_text
+    # annotations are stripped from the emitted code
+    assert ': cython.double' not in pyx_text
+    # plain python annotations are not c types
+    assert '_untyped_cyth' not in pyx_text
+
+
+def test_annotated_module_builds(workdir):
+    import numpy as np
+    py_fpath = write_module(workdir, 'ann', ANNOTATED_MODULE)
+    cyth_script.translate_fpath(py_fpath)
+    build(py_fpath)
+    module = import_module('ann')
+    assert module.total_cyth(np.ones((4, 2)), 4, 2.0) == 8.0
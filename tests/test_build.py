@@ -0,0 +1,83 @@
+from __future__ import absolute_import, division, print_function
+import os
+import pytest
+from cyth import cyth_build
+from cyth import cyth_helpers
+from cyth import cyth_script
+from conftest import write_module, build, import_module
+
+SQUARE_MODULE = '''
+def square(x):
+    """
+    #if CYTH
+    #CYTH_PARAM_TYPES:
+        double x
+    #CYTH_RETURNS double
+    return x * x
+    #else
+    """
+    return x * x
+    """
+    #endif
+    """
+
+
+import cyth
+exec(cyth.import_cyth_execstr(__name__))
+'''
+
+BROKEN_MODULE = '''
+def broken(x):
+    """
+    #if CYTH
+    #CYTH_PARAM_TYPES:
+        double x
+    return x +
+    #else
+    """
+    return x
+    """
+    #endif
+    """
+'''
+
+
+def list_files(dpath):
+    return [os.path.join(root, fname)
+            for root, dirs, fnames in os.walk(dpath) for fname in fnames]
+
+
+def test_build_leaves_no_object_files(workdir):
+    py_fpath = write_module(workdir, 'square', SQUARE_MODULE)
+    cyth_script.translate_fpath(py_fpath)
+    status = build(py_fpath, use_cache=False)
+    assert status['status'] == 'built'
+    assert [fpath for fpath in list_files(workdir) if fpath.endswith(('.o', '.obj'))] == []
+    assert import_module('square').square_cyth(3.0) == 9.0
+
+
+def test_build_is_up_to_date(workdir):
+    py_fpath = write_module(workdir, 'square', SQUARE_MODULE)
+    cyth_script.translate_fpath(py_fpath)
+    build(py_fpath, use_cache=False)
+    assert build(py_fpath, use_cache=False)['status'] == 'up to date'
+
+
+def test_failed_build_is_reported(workdir):
+    py_fpath = write_module(workdir, 'broken', BROKEN_MODULE)
+    cyth_script.translate_fpath(py_fpath)
+    status = cyth_build.build_pyx(cyth_helpers.get_cyth_path(py_fpath), use_cache=False)
+    assert status['status'] == 'failed'
+    assert cyth_build.count_failed([status]) == 1
+
+
+def test_translate_exits_when_a_build_fails(workdir, monkeypatch):
+    monkeypatch.setattr(cyth_script, 'CYTHON_BUILD', True)
+    monkeypatch.setattr(cyth_script, 'CYTH_EXT_CACHE', False)
+    py_fpath = write_module(workdir, 'broken', BROKEN_MODULE)
+    with pytest.raises(SystemExit) as excinfo:
+        cyth_script.translate(py_fpath, write_runbench=False)
+    assert excinfo.value.code == 1
+    # watch mode keeps going
+    assert cyth_script.translate(py_fpath, write_runbench=False,
+                                 exit_on_failure=False) != []
@@ -0,0 +1,90 @@
+from __future__ import absolute_import, division, print_function
+from cyth import cyth_cache
+from cyth import cyth_helpers
+from cyth import cyth_script
+from conftest import write_module
+
+TAGGED_MODULE = '''
+def square(x):
+    """
+    #if CYTH
+    #CYTH_PARAM_TYPES:
+        double x
+    #CYTH_RETURNS double
+    return x * x
+    #else
+    """
+    return x * x
+    """
+    #endif
+    """
+'''
+
+
+def write_modules(workdir, num):
+    return [write_module(workdir, 'mod%d' % (ix,), TAGGED_MODULE) for ix in range(num)]
+
+
+def count_calls(monkeypatch, module, name):
+    calls = []
+    func = getattr(module, name)
+
+    def wrapper(*args):
+        calls.append(args)
+        return func(*args)
+    monkeypatch.setattr(module, name, wrapper)
+    return calls
+
+
+def test_manifest_skips_unchanged_files(workdir, capsys):
+    py_fpath, = write_modules(workdir, 1)
+    cyth_script.translate(py_fpath, write_runbench=False)
+    capsys.readouterr()
+    cyth_script.translate(py_fpath, write_runbench=False)
+    assert 'up to date' in capsys.readouterr().out
+    # removed or edited outputs are regenerated
+    with open(cyth_helpers.get_cyth_path(py_fpath), 'a') as file_:
+        file_.write('# edited\n')
+    cyth_script.translate(py_fpath, write_runbench=False)
+    assert 'up to date' not in capsys.readouterr().out
+
+
+def test_manifest_is_saved_once_per_translate(workdir, monkeypatch):
+    fpath_list = write_modules(workdir, 3)
+    loads = count_calls(monkeypatch, cyth_cache, 'load_manifest')
+    saves = count_calls(monkeypatch, cyth_cache, 'save_manifest')
+    cyth_script.translate(*fpath_list, write_runbench=False)
+    # one read up front, one for the read-modify-write at the end
+    assert len(loads) == 2
+    assert len(saves) == 1
+    assert sorted(cyth_cache.load_manifest()['translations']) == sorted(fpath_list)
+
+
+def test_pool_translation_matches_serial(workdir, monkeypatch):
+    fpath_list = write_modules(workdir, 3)
+    result_list = cyth_script.translate_fpath_list(fpath_list, jobs=2)
+    assert result_list == list(map(cyth_helpers.get_cyth_bench_path, fpath_list))
+    assert sorted(cyth_cache.load_manifest()['translations']) == sorted(fpath_list)
+    pyx_list = [open(cyth_helpers.get_cyth_path(fpath)).read() for fpath in fpath_list]
+    monkeypatch.setattr(cyth_script, 'CYTH_FORCE', True)
+    cyth_script.translate_fpath_list(fpath_list, jobs=1)
+    assert [open(cyth_helpers.get_cyth_path(fpath)).read() for fpath in fpath_list] == pyx_list
+
+
+def test_unchanged_functions_are_replayed(workdir, monkeypatch):
+    from cyth import cyth_parser
+    two_funcs = TAGGED_MODULE + TAGGED_MODULE.replace('square', 'cube').replace(
+        'x * x', 'x * x * x')
+    py_fpath = write_module(workdir, 'funcs', two_funcs)
+    cyth_script.translate_fpath(py_fpath)
+    # edit cube only
+    write_module(workdir, 'funcs', two_funcs.replace('x * x * x', 'x * x * x + 1'))
+    emitted = count_calls(monkeypatch, cyth_parser.CythVisitor, 'record_function_emission')
+    cyth_script.translate_fpath(py_fpath)
+    assert [node.name for _, node in emitted] == ['cube']
+    pyx_text = open(cyth_helpers.get_cyth_path(py_fpath)).read()
+    # replaying gives the output of a full translation
+    monkeypatch.setattr(cyth_script, 'CYTH_FORCE', True)
+    cyth_script.translate_fpath(py_fpath)
+    assert [node.name for _, node in emitted] == ['cube', 'square', 'cube']
+    assert open(cyth_helpers.get_cyth_path(py_fpath)).read() == pyx_text
@@ -0,0 +1,75 @@
+from __future__ import absolute_import, division, print_function
+import numpy as np
+from cyth import cyth_script
+from conftest import write_module, read_pyx, build, import_module
+
+DEMOTE_MODULE = '''
+import numpy as np
+
+
+def get_mat_trace(mats, ix):
+    """
+    #if CYTH
+    #CYTH_PARAM_TYPES:
+        np.ndarray[np.float64_t, ndim=3] mats
+        Py_ssize_t ix
+    return mats[ix, 0, 0] + mats[ix, 1, 1] + mats[ix, 2, 2]
+    #else
+    """
+    return float(np.trace(mats[ix]))
+    """
+    #endif
+    """
+
+
+def get_traces(mats):
+    """
+    #if CYTH
+    #CYTH_PARAM_TYPES:
+        np.ndarray[np.float64_t, ndim=3] mats
+    cdef:
+        np.ndarray[np.float64_t, ndim=1] out
+    out = np.zeros(mats.shape[0])
+    for ix in range(mats.shape[0]):
+        out[ix] = get_mat_trace(mats, ix)
+    return out
+    #else
+    """
+    return np.array([get_mat_trace(mats, ix) for ix in range(len(mats))])
+    """
+    #endif
+    """
+
+
+import cyth
+exec(cyth.import_cyth_execstr(__name__))
+'''
+
+
+def test_internal_functions_are_demoted(workdir):
+    py_fpath = write_module(workdir, 'demote', DEMOTE_MODULE)
+    cyth_script.translate_fpath(py_fpath)
+    pyx_text = read_pyx(py_fpath)
+    assert 'cdef inline np.float64_t _get_mat_trace_cyth(' in pyx_text
+    assert 'out[ix] = _get_mat_trace_cyth(mats, ix)' in pyx_text
+    assert "CYTH_DEMOTED_FUNCS = ['get_mat_trace']" in pyx_text
+
+
+def test_demotion_can_be_turned_off(workdir, monkeypatch):
+    monkeypatch.setattr(cyth_script, 'CYTH_DEMOTE', False)
+    py_fpath = write_module(workdir, 'demote', DEMOTE_MODULE)
+    cyth_script.translate_fpath(py_fpath)
+    pyx_text = read_pyx(py_fpath)
+    assert 'cpdef np.float64_t _get_mat_trace_cyth(' in pyx_text
+    assert 'CYTH_DEMOTED_FUNCS' not in pyx_text
+
+
+def test_demoted_module_builds(workdir):
+    py_fpath = write_module(workdir, 'demote', DEMOTE_MODULE)
+    cyth_script.translate_fpath(py_fpath)
+    build(py_fpath)
+    module = import_module('demote')
+    mats = np.random.rand(4, 3, 3)
+    assert np.allclose(module.get_traces_cyth(mats), module.get_traces(mats))
+    # python keeps the python version of demoted functions
+    assert module.get_mat_trace_cyth(mats, 1) == module.get_mat_trace(mats, 1)
@@ -0,0 +1,41 @@
+from __future__ import absolute_import, division, print_function
+import os
+from cyth import cyth_build
+from cyth import cyth_helpers
+from cyth import cyth_script
+from test_build import SQUARE_MODULE
+from conftest import write_module, build, import_module
+
+
+def test_extensions_are_shared_between_checkouts(workdir, monkeypatch):
+    py_fpath = write_module(workdir, 'shared', SQUARE_MODULE)
+    cyth_script.translate_fpath(py_fpath)
+    assert build(py_fpath)['status'] == 'built'
+    # a second checkout of the same package
+    other_dpath = os.path.join(workdir, 'other')
+    os.makedirs(os.path.join(other_dpath, 'pkg'))
+    monkeypatch.chdir(other_dpath)
+    monkeypatch.syspath_prepend(other_dpath)
+    write_module(other_dpath, '__init__', '')
+    other_fpath = write_module(other_dpath, 'shared', SQUARE_MODULE)
+    cyth_script.translate_fpath(other_fpath)
+    assert build(other_fpath)['status'] == 'cached'
+    assert import_module('shared').square_cyth(3.0) == 9.0
+
+
+def test_changed_translation_is_rebuilt(workdir):
+    py_fpath = write_module(workdir, 'edited', SQUARE_MODULE)
+    cyth_script.translate_fpath(py_fpath)
+    build(py_fpath)
+    write_module(workdir, 'edited', SQUARE_MODULE.replace('x * x', 'x * x + 1'))
+    cyth_script.translate_fpath(py_fpath)
+    assert build(py_fpath)['status'] == 'built'
+    assert import_module('edited').square_cyth(3.0) == 10.0
+
+
+def test_extension_cache_can_be_bypassed(workdir):
+    py_fpath = write_module(workdir, 'uncached', SQUARE_MODULE)
+    cyth_script.translate_fpath(py_fpath)
+    assert build(py_fpath, use_cache=False)['status'] == 'built'
+    cache_key = cyth_build.get_ext_cache_key(cyth_helpers.get_cyth_path(py_fpath))
+    assert not os.path.exists(cyth_build.get_cached_ext_fpath(cache_key))
@@ -0,0 +1,95 @@
+from __future__ import absolute_import, division, print_function
+import ast
+import numpy as np
+from cyth import cyth_script
+from conftest import write_module, read_pyx, build, import_module
+
+GLOBALS_MODULE = '''
+import numpy as np
+from math import sqrt
+
+TAU = 2 * np.pi
+ROOT2 = sqrt(2)
+UNUSED = np.e
+
+
+def turns(x):
+    """
+    #if CYTH
+    #CYTH_PARAM_TYPES:
+        double x
+    #CYTH_RETURNS double
+    return x * TAU / ROOT2
+    #else
+    """
+    return x * TAU / ROOT2
+    """
+    #endif
+    """
+
+
+import cyth
+exec(cyth.import_cyth_execstr(__name__))
+'''
+
+
+def test_loaded_globals_are_copied_with_their_imports(workdir):
+    py_fpath = write_module(workdir, 'glob', GLOBALS_MODULE)
+    cyth_script.translate_fpath(py_fpath)
+    pyx_text = read_pyx(py_fpath)
+    # compared as syntax trees, as astor versions differ in parentheses
+    tau_lines = [line for line in pyx_text.split('\n') if line.startswith('TAU = ')]
+    assert [ast.dump(ast.parse(line)) for line in tau_lines] == [ast.dump(ast.parse('TAU = 2 * np.pi'))]
+    assert 'import numpy as np' in pyx_text.split('\n')
+    assert 'from math import sqrt' in pyx_text.split('\n')
+    assert 'UNUSED' not in pyx_text
+
+
+def test_loaded_globals_build(workdir):
+    py_fpath = write_module(workdir, 'glob', GLOBALS_MODULE)
+    cyth_script.translate_fpath(py_fpath)
+    build(py_fpath)
+    module = import_module('glob')
+    assert abs(module.turns_cyth(1.0) - module.turns(1.0)) < 1e-12
+
+
+CYTH_CODE_IMPORTS_MODULE = '''
+import numpy as np
+from math import sqrt
+
+
+def get_norms(mats):
+    """
+    #if CYTH
+    #CYTH_PARAM_TYPES:
+        np.ndarray[np.float64_t, ndim=2] mats
+    cdef:
+        np.ndarray[np.float64_t, ndim=1] out
+        Py_ssize_t ix
+    out = np.zeros((mats.shape[0],), dtype=np.float64)
+    for ix in range(mats.shape[0]):
+        out[ix] = sqrt(mats[ix, 0] ** 2 + mats[ix, 1] ** 2)
+    return out
+    #else
+    """
+    return [(row ** 2).sum() ** .5 for row in mats]
+    """
+    #endif
+    """
+
+
+import cyth
+exec(cyth.import_cyth_execstr(__name__))
+'''
+
+
+def test_modules_used_by_cyth_code_are_imported(workdir):
+    py_fpath = write_module(workdir, 'norms', CYTH_CODE_IMPORTS_MODULE)
+    cyth_script.translate_fpath(py_fpath)
+    pyx_lines = read_pyx(py_fpath).split('\n')
+    assert 'import numpy as np' in pyx_lines
+    assert 'from math import sqrt' in pyx_lines
+    build(py_fpath)
+    module = import_module('norms')
+    mats = np.random.rand(5, 2)
+    assert np.allclose(module.get_norms_cyth(mats), module.get_norms(mats))
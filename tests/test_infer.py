@@ -0,0 +1,61 @@
+from __future__ import absolute_import, division, print_function
+from cyth import cyth_script
+from conftest import write_module, read_pyx, build, import_module
+
+INFER_MODULE = '''
+import numpy as np
+
+
+def weighted_total(x, w):
+    """
+    #if CYTH
+    #CYTH_PARAM_TYPES:
+        np.ndarray[np.float64_t, ndim=2] x
+        double w
+    n = x.shape[0]
+    total = 0.0
+    for ix in range(n):
+        rest = x[ix, 1:]
+        total += x[ix, 0] * w + x[ix, 1]
+    return total
+    #else
+    """
+    return (x[:, 0] * w + x[:, 1]).sum()
+    """
+    #endif
+    """
+
+
+import cyth
+exec(cyth.import_cyth_execstr(__name__))
+'''
+
+
+def get_cdef_lines(pyx_text):
+    lines = pyx_text.split('\n')
+    start = lines.index('    cdef:') + 1
+    cdef_lines = []
+    for line in lines[start:]:
+        if not line.startswith(' ' * 8):
+            break
+        cdef_lines.append(line.strip())
+    return sorted(cdef_lines)
+
+
+def test_locals_and_return_are_inferred(workdir):
+    py_fpath = write_module(workdir, 'infer', INFER_MODULE)
+    cyth_script.translate_fpath(py_fpath)
+    pyx_text = read_pyx(py_fpath)
+    # a slice of a buffer is not one of its elements
+    assert get_cdef_lines(pyx_text) == ['Py_ssize_t ix', 'Py_ssize_t n', 'double total']
+    assert 'cpdef double _weighted_total_cyth(' in pyx_text
+
+
+def test_inferred_module_builds(workdir):
+    import numpy as np
+    py_fpath = write_module(workdir, 'infer', INFER_MODULE)
+    cyth_script.translate_fpath(py_fpath)
+    build(py_fpath)
+    module = import_module('infer')
+    x = np.arange(6, dtype=np.float64).reshape(3, 2)
+    assert module.weighted_total_cyth(x, 2.0) == module.weighted_total(x, 2.0)
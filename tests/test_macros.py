@@ -0,0 +1,293 @@
+from __future__ import absolute_import, division, print_function
+import warnings
+import numpy as np
+import pytest
+from cyth import cyth_script
+from conftest import write_module, read_pyx, build, import_module
+
+FANCY_INDEX_MODULE = '''
+import numpy as np
+
+
+def get_picks(mats, k):
+    """
+    #if CYTH
+    #CYTH_PARAM_TYPES:
+        np.ndarray[np.float64_t, ndim=3] mats
+        Py_ssize_t k
+    #macro numpy_fancy_index_macro ndim=3
+    """
+    rev = mats[::-1, 1, k]
+    cols = mats[:, -1, [2, 0, -2]]
+    elem = mats[0, -1, k]
+    """
+    #endmacro
+    #endif
+    """
+    return rev, cols, elem
+
+
+import cyth
+exec(cyth.import_cyth_execstr(__name__))
+'''
+
+
+@pytest.fixture
+def fancy_index(workdir):
+    py_fpath = write_module(workdir, 'fancy', FANCY_INDEX_MODULE)
+    cyth_script.translate_fpath(py_fpath)
+    build(py_fpath)
+    return import_module('fancy')
+
+
+def test_fancy_index_matches_numpy(fancy_index):
+    mats = np.random.rand(5, 4, 3)
+    for k in [0, 2, -1, -3]:
+        for result, expected in zip(fancy_index.get_picks_cyth(mats, k),
+                                    fancy_index.get_picks(mats, k)):
+            assert np.all(np.asarray(result) == expected)
+
+
+def test_fancy_index_checks_scalar_bounds(fancy_index):
+    mats = np.random.rand(5, 4, 3)
+    for k in [3, -4]:
+        with pytest.raises(IndexError):
+            fancy_index.get_picks(mats, k)
+        with pytest.raises(IndexError):
+            fancy_index.get_picks_cyth(mats, k)
+    # the constant 1 is out of bounds of the second axis
+    with pytest.raises(IndexError):
+        fancy_index.get_picks_cyth(np.random.rand(5, 1, 3), 0)
+
+
+REDUCE_MODULE = '''
+import numpy as np
+
+
+def float_reductions(dists):
+    """
+    #if CYTH
+    #CYTH_PARAM_TYPES:
+        np.ndarray[np.float64_t, ndim=2] dists
+    #macro numpy_reduce_macro ndim=2 dtype=np.float64_t
+    """
+    lows = np.min(dists, axis=1)
+    highs = dists.max(axis=0)
+    low_idx = dists.argmin(axis=1)
+    means = dists.mean(axis=-1)
+    total = dists.sum()
+    """
+    #endmacro
+    #endif
+    """
+    return lows, highs, low_idx, means, total
+
+
+def int_reductions(counts):
+    """
+    #if CYTH
+    #CYTH_PARAM_TYPES:
+        np.ndarray[np.int32_t, ndim=2] counts
+    #macro numpy_reduce_macro ndim=2 dtype=np.int32_t
+    """
+    sums = counts.sum(axis=0)
+    total = np.sum(counts)
+    means = counts.mean(axis=1)
+    """
+    #endmacro
+    #endif
+    """
+    return sums, total, means
+
+
+def mean_rows(dists):
+    """
+    #if CYTH
+    #CYTH_PARAM_TYPES:
+        np.ndarray[np.float64_t, ndim=2] dists
+    #macro numpy_reduce_macro ndim=2 dtype=np.float64_t
+    """
+    means = dists.mean(axis=1)
+    """
+    #endmacro
+    #endif
+    """
+    return means
+
+
+def nan_reductions(dists):
+    """
+    #if CYTH
+    #CYTH_PARAM_TYPES:
+        np.ndarray[np.float64_t, ndim=2] dists
+    #macro numpy_reduce_macro ndim=2 dtype=np.float64_t
+    """
+    lows = np.nanmin(dists, axis=1)
+    highs = np.nanmax(dists, 0)
+    low_idx = np.nanargmin(dists, axis=1)
+    """
+    #endmacro
+    #endif
+    """
+    return lows, highs, low_idx
+
+
+import cyth
+exec(cyth.import_cyth_execstr(__name__))
+'''
+
+
+@pytest.fixture
+def reduce_module(workdir):
+    py_fpath = write_module(workdir, 'reduce', REDUCE_MODULE)
+    cyth_script.translate_fpath(py_fpath)
+    build(py_fpath)
+    return import_module('reduce')
+
+
+def test_reductions_match_numpy(reduce_module):
+    dists = np.random.rand(5, 4)
+    for result, expected in zip(reduce_module.float_reductions_cyth(dists),
+                                reduce_module.float_reductions(dists)):
+        assert np.allclose(result, expected)
+
+
+def get_nan_dists():
+    dists = np.random.rand(4, 5)
+    dists[0, 3] = np.nan
+    dists[1, [2, 4]] = np.nan
+    dists[3, :] = np.nan
+    return dists
+
+
+def test_reductions_propagate_nans(reduce_module):
+    dists = get_nan_dists()
+    lows, highs, low_idx, _, _ = reduce_module.float_reductions_cyth(dists)
+    # assert_array_equal treats NaNs as equal
+    np.testing.assert_array_equal(lows, np.min(dists, axis=1))
+    np.testing.assert_array_equal(highs, dists.max(axis=0))
+    # the index of the first NaN
+    assert np.all(np.asarray(low_idx) == dists.argmin(axis=1))
+    assert list(np.asarray(low_idx)[[0, 1, 3]]) == [3, 2, 0]
+
+
+def test_nan_reductions_skip_nans(reduce_module):
+    dists = get_nan_dists()[:3]
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for result, expected in zip(reduce_module.nan_reductions_cyth(dists),
+                                    reduce_module.nan_reductions(dists)):
+            np.testing.assert_array_equal(result, expected)
+    with pytest.raises(ValueError):
+        reduce_module.nan_reductions_cyth(get_nan_dists())
+
+
+def test_mean_of_empty_axis_is_nan(reduce_module):
+    means = reduce_module.mean_rows_cyth(np.zeros((3, 0)))
+    assert np.asarray(means).shape == (3,)
+    assert np.all(np.isnan(means))
+
+
+def test_integer_sums_are_wide(reduce_module):
+    counts = np.full((4, 3), 2 ** 30, dtype=np.int32)
+    sums, total, means = reduce_module.int_reductions_cyth(counts)
+    expected_sums, expected_total, expected_means = reduce_module.int_reductions(counts)
+    assert np.asarray(sums).dtype == np.int64
+    assert np.all(np.asarray(sums) == expected_sums)
+    assert total == expected_total == 12 * 2 ** 30
+    assert np.allclose(means, expected_means)
+
+
+ELEMENTWISE_MODULE = '''
+import numpy as np
+
+
+def get_blend(a, b, c, d, alpha):
+    """
+    #if CYTH
+    #CYTH_PARAM_TYPES:
+        np.ndarray[np.float64_t, ndim=2] a, b, c, d
+        double alpha
+    #macro numpy_elementwise_macro ndim=2 scalars=alpha
+    """
+    out = a * b + c / d
+    out = -out * alpha + 2.5 ** 2 - a
+    diff = out - b
+    """
+    #endmacro
+    #endif
+    """
+    return out, diff
+
+
+import cyth
+exec(cyth.import_cyth_execstr(__name__))
+'''
+
+
+
+@pytest.fixture
+def elementwise_module(workdir):
+    py_fpath = write_module(workdir, 'blend', ELEMENTWISE_MODULE)
+    cyth_script.translate_fpath(py_fpath)
+    build(py_fpath)
+    return import_module('blend')
+
+
+def test_elementwise_matches_numpy(elementwise_module):
+    a, b, c, d = np.random.rand(4, 6, 5) + 1
+    for result, expected in zip(elementwise_module.get_blend_cyth(a, b, c, d, 0.5),
+                                elementwise_module.get_blend(a, b, c, d, 0.5)):
+        assert np.allclose(result, expected)
+
+
+BROADCAST_MODULE = '''
+import numpy as np
+
+
+def get_centered(grid, row_means, col_scale):
+    """
+    #if CYTH
+    #CYTH_PARAM_TYPES:
+        np.ndarray[np.float64_t, ndim=2] grid, row_means, col_scale
+    #macro numpy_elementwise_macro ndim=2
+    """
+    centered = (grid - row_means) * col_scale
+    """
+    #endmacro
+    #endif
+    """
+    return centered
+
+
+import cyth
+exec(cyth.import_cyth_execstr(__name__))
+'''
+
+
+def test_elementwise_broadcasts_axes_of_length_one(workdir):
+    py_fpath = write_module(workdir, 'bcast', BROADCAST_MODULE)
+    cyth_script.translate_fpath(py_fpath)
+    build(py_fpath)
+    module = import_module('bcast')
+    grid = np.random.rand(4, 3)
+    row_means = grid.mean(axis=1)[:, None]
+    col_scale = np.random.rand(1, 3)
+    for args in [(grid, row_means, col_scale), (row_means, grid, col_scale),
+                 (col_scale, row_means, np.ones((1, 1)))]:
+        result = np.asarray(module.get_centered_cyth(*args))
+        expected = module.get_centered(*args)
+        assert result.shape == expected.shape
+        assert np.allclose(result, expected)
+    with pytest.raises(ValueError):
+        module.get_centered_cyth(grid, np.random.rand(2, 1), col_scale)
+
+
+def test_elementwise_loop_nests_are_fused(workdir):
+    py_fpath = write_module(workdir, 'fused', ELEMENTWISE_MODULE)
+    cyth_script.translate_fpath(py_fpath)
+    pyx_text = read_pyx(py_fpath)
+    # diff is computed in the loop nest of the out it reads, but out cannot
+    # be rebound in the loop that reads its old value
+    assert pyx_text.count('for ix0') == 2
+    assert pyx_text.count('for ix1') == 2
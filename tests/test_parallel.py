@@ -0,0 +1,51 @@
+from __future__ import absolute_import, division, print_function
+import numpy as np
+from cyth import cyth_script
+from conftest import write_module, read_pyx, build, import_module
+
+PARALLEL_MODULE = '''
+import numpy as np
+
+
+def get_dets(mats):
+    """
+    #if CYTH
+    #CYTH_PARAM_TYPES:
+        np.ndarray[np.float64_t, ndim=3] mats
+    cdef:
+        np.ndarray[np.float64_t, ndim=1] out
+        Py_ssize_t ix
+    out = np.zeros((mats.shape[0],), dtype=np.float64)
+    #CYTH_PARALLEL num_threads=2 schedule=static
+    for ix in range(mats.shape[0]):
+        out[ix] = mats[ix, 0, 0] * mats[ix, 1, 1] - mats[ix, 0, 1] * mats[ix, 1, 0]
+    return out
+    #else
+    """
+    return np.linalg.det(mats[:, 0:2, 0:2])
+    """
+    #endif
+    """
+
+
+import cyth
+exec(cyth.import_cyth_execstr(__name__))
+'''
+
+
+def test_parallel_loops_use_prange(workdir):
+    py_fpath = write_module(workdir, 'par', PARALLEL_MODULE)
+    cyth_script.translate_fpath(py_fpath)
+    pyx_text = read_pyx(py_fpath)
+    assert pyx_text.startswith('# distutils: extra_compile_args = -fopenmp\n')
+    assert 'from cython.parallel cimport prange' in pyx_text
+    assert "for ix in prange(mats.shape[0], num_threads=2, schedule='static'):" in pyx_text
+
+
+def test_parallel_module_builds(workdir):
+    py_fpath = write_module(workdir, 'par', PARALLEL_MODULE)
+    cyth_script.translate_fpath(py_fpath)
+    build(py_fpath)
+    module = import_module('par')
+    mats = np.random.rand(50, 2, 2)
+    assert np.allclose(module.get_dets_cyth(mats), module.get_dets(mats))
@@ -0,0 +1,22 @@
+from __future__ import absolute_import, division, print_function
+import json
+from cyth import cyth_profile
+from cyth import cyth_script
+from test_cache import TAGGED_MODULE
+from conftest import write_module
+
+
+def test_each_translate_reports_its_own_timings(workdir, monkeypatch):
+    monkeypatch.setattr(cyth_profile, 'PROFILE', True)
+    fpath1 = write_module(workdir, 'mod1', TAGGED_MODULE)
+    fpath2 = write_module(workdir, 'mod2', TAGGED_MODULE)
+    cyth_script.translate(fpath1, write_runbench=False)
+    with open(cyth_profile.PROFILE_FNAME) as file_:
+        profile = json.load(file_)
+    assert list(profile['files']) == [fpath1]
+    assert set(['read', 'parse', 'emit', 'write']) <= set(profile['phases'])
+    cyth_script.translate(fpath2, write_runbench=False)
+    with open(cyth_profile.PROFILE_FNAME) as file_:
+        profile = json.load(file_)
+    assert list(profile['files']) == [fpath2]
+    assert cyth_profile.pop_timings() == {}
@@ -0,0 +1,67 @@
+from __future__ import absolute_import, division, print_function
+import sys
+import numpy as np
+from cyth import cyth_record
+from cyth import cyth_script
+from conftest import write_module, read_pyx, build, import_module
+
+UNMARKED_MODULE = '''
+def get_weighted(x, w, n):
+    total = 0.0
+    for ix in range(n):
+        total += x[ix] * w[ix]
+    return total
+
+
+def untouched(x):
+    return x
+
+
+import cyth
+exec(cyth.import_cyth_execstr(__name__))
+'''
+
+
+def record_workload(module):
+    with cyth_record.record_types(module.get_weighted):
+        module.get_weighted(np.ones(3), np.arange(3.0), 3)
+        module.get_weighted(np.ones(5), np.arange(5.0), 4)
+
+
+def test_recorded_types_are_declared(workdir):
+    py_fpath = write_module(workdir, 'recorded', UNMARKED_MODULE)
+    record_workload(import_module('recorded'))
+    assert cyth_record.load_recorded_types(py_fpath) == {'get_weighted': {
+        'x': 'np.ndarray[np.float64_t, ndim=1, mode="c"]',
+        'w': 'np.ndarray[np.float64_t, ndim=1, mode="c"]',
+        'n': 'Py_ssize_t'}}
+    cyth_script.translate_fpath(py_fpath)
+    pyx_text = read_pyx(py_fpath)
+    assert ('_get_weighted_cyth(np.ndarray[np.float64_t, ndim=1, mode="c"] x, '
+            'np.ndarray[np.float64_t, ndim=1, mode="c"] w, Py_ssize_t n)') in pyx_text
+    # functions without markup or recorded types are left alone
+    assert '_untouched_cyth' not in pyx_text
+
+
+def test_observations_of_workloads_add_up(workdir):
+    py_fpath = write_module(workdir, 'merged', UNMARKED_MODULE)
+    module = import_module('merged')
+    record_workload(module)
+    with cyth_record.record_types(module.get_weighted):
+        module.get_weighted(np.ones(4)[::2], np.arange(2.0), 2)
+    # seen both contiguous and strided, so declared without a mode
+    recorded = cyth_record.load_recorded_types(py_fpath)['get_weighted']
+    assert recorded['x'] == 'np.ndarray[np.float64_t, ndim=1]'
+    assert recorded['w'] == 'np.ndarray[np.float64_t, ndim=1, mode="c"]'
+
+
+def test_recorded_module_builds(workdir):
+    py_fpath = write_module(workdir, 'recorded_build', UNMARKED_MODULE)
+    record_workload(import_module('recorded_build'))
+    cyth_script.translate_fpath(py_fpath)
+    build(py_fpath)
+    # the python module was imported to record it
+    del sys.modules['pkg.recorded_build']
+    module = import_module('recorded_build')
+    x, w = np.random.rand(2, 6)
+    assert np.isclose(module.get_weighted_cyth(x, w, 6), np.dot(x, w))
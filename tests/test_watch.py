@@ -0,0 +1,88 @@
+from __future__ import absolute_import, division, print_function
+import time
+from cyth import cyth_helpers
+from cyth import cyth_record
+from cyth import cyth_script
+from cyth import cyth_watch
+from test_cache import TAGGED_MODULE
+from conftest import write_module, build, import_module
+
+real_sleep = time.sleep
+
+PLAIN_MODULE = '''
+def scale(x, alpha):
+    return x * alpha
+'''
+
+
+def run_watch(monkeypatch, actions, bench_log=None):
+    """
+    Runs cyth_watch.watch, doing one of actions before each poll, and
+    returns the lists of files it retranslated (and appends the benchmark
+    results each retranslation starts from to bench_log)
+    """
+    retranslated = []
+
+    def retranslate(fpath_list, bench_results):
+        retranslated.append(fpath_list)
+        if bench_log is not None:
+            bench_log.append(dict(bench_results))
+    monkeypatch.setattr(cyth_watch, 'retranslate', retranslate)
+    actions = list(actions)
+
+    def sleep(interval):
+        if len(actions) == 0:
+            raise KeyboardInterrupt()
+        actions.pop(0)()
+        # make sure rewritten files get a new mtime
+        real_sleep(0.01)
+    monkeypatch.setattr(cyth_watch.time, 'sleep', sleep)
+    cyth_watch.watch(interval=0, debounce=0)
+    return retranslated
+
+
+def test_watch_retranslates_on_recorded_types(workdir, monkeypatch):
+    py_fpath = write_module(workdir, 'plain', PLAIN_MODULE)
+    module = import_module('plain')
+
+    def record():
+        with cyth_record.record_types(module.scale):
+            module.scale(2.0, 3)
+
+    noop = lambda: None
+    retranslated = run_watch(monkeypatch, [noop, record, noop, noop])
+    assert retranslated == [[py_fpath]]
+
+
+def test_watch_ignores_untagged_changes(workdir, monkeypatch):
+    py_fpath = write_module(workdir, 'plain', PLAIN_MODULE)
+    edit = lambda: write_module(workdir, 'plain', PLAIN_MODULE + '\n\nFOO = 1\n')
+    tag = lambda: write_module(workdir, 'plain', PLAIN_MODULE + '\n\n# CYTH\n')
+    noop = lambda: None
+    retranslated = run_watch(monkeypatch, [edit, noop, tag, noop])
+    assert retranslated == [[py_fpath]]
+
+
+def test_watch_starts_from_the_built_benchmarks(workdir, monkeypatch):
+    py_fpath = write_module(workdir, 'built', TAGGED_MODULE)
+    unbuilt_fpath = write_module(workdir, 'unbuilt', TAGGED_MODULE)
+    cyth_script.translate(py_fpath, unbuilt_fpath, write_runbench=False)
+    build(py_fpath)
+    monkeypatch.setattr(cyth_script, 'CYTHON_BUILD', True)
+    monkeypatch.setattr(cyth_watch, 'run_benchmark_module', lambda cy_benchpath: [(2.0, 1.0)])
+    edit = lambda: write_module(workdir, 'built', TAGGED_MODULE.replace('x * x', 'x ** 2'))
+    bench_log = []
+    retranslated = run_watch(monkeypatch, [edit, lambda: None], bench_log)
+    assert retranslated == [[py_fpath]]
+    assert bench_log == [{cyth_helpers.get_cyth_bench_path(py_fpath): [(2.0, 1.0)]}]
+
+
+def test_watch_ignores_untagged_code_of_tagged_files(workdir, monkeypatch):
+    py_fpath = write_module(workdir, 'mixed', TAGGED_MODULE + PLAIN_MODULE)
+    edit_plain = lambda: write_module(workdir, 'mixed', TAGGED_MODULE + PLAIN_MODULE.replace(
+        'x * alpha', 'alpha * x'))
+    edit_tagged = lambda: write_module(workdir, 'mixed', TAGGED_MODULE.replace(
+        'return x * x\n    #else', 'return x ** 2\n    #else') + PLAIN_MODULE)
+    noop = lambda: None
+    retranslated = run_watch(monkeypatch, [edit_plain, noop, edit_tagged, noop])
+    assert retranslated == [[py_fpath]]